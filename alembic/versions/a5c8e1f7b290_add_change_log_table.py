@@ -0,0 +1,42 @@
+"""Add change_log table for delta sync
+
+Revision ID: a5c8e1f7b290
+Revises: f1b7d3e9a402
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "a5c8e1f7b290"
+down_revision: Union[str, None] = "f1b7d3e9a402"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "change_log",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("event", sa.String(length=32), nullable=False),
+        sa.Column("message_id", sa.Integer(), nullable=True),
+        sa.Column("conversation_id", sa.Integer(), nullable=True),
+        sa.Column("room_id", sa.Integer(), nullable=True),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("data", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("(CURRENT_TIMESTAMP)"), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_change_log_conversation_id", "change_log", ["conversation_id", "id"], unique=False)
+    op.create_index("ix_change_log_room_id", "change_log", ["room_id", "id"], unique=False)
+    op.create_index("ix_change_log_user_id", "change_log", ["user_id", "id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_change_log_user_id", table_name="change_log")
+    op.drop_index("ix_change_log_room_id", table_name="change_log")
+    op.drop_index("ix_change_log_conversation_id", table_name="change_log")
+    op.drop_table("change_log")
@@ -0,0 +1,36 @@
+"""Add upload_object table for content-addressed uploads
+
+Revision ID: b9e4d2a7c613
+Revises: a5c8e1f7b290
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "b9e4d2a7c613"
+down_revision: Union[str, None] = "a5c8e1f7b290"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "upload_object",
+        sa.Column("sha256", sa.String(length=64), nullable=False),
+        sa.Column("filename", sa.String(length=80), nullable=False),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("content_type", sa.String(), nullable=True),
+        sa.Column("ref_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("(CURRENT_TIMESTAMP)"), nullable=True),
+        sa.Column("last_uploaded_at", sa.DateTime(timezone=True), server_default=sa.text("(CURRENT_TIMESTAMP)"), nullable=True),
+        sa.PrimaryKeyConstraint("sha256"),
+        sa.UniqueConstraint("filename"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("upload_object")
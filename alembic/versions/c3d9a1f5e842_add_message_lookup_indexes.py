@@ -0,0 +1,53 @@
+"""Add composite and partial indexes for message lookups
+
+Revision ID: c3d9a1f5e842
+Revises: b7c4e2a9f310
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "c3d9a1f5e842"
+down_revision: Union[str, None] = "b7c4e2a9f310"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY keeps the message table writable on Postgres while the
+    # indexes build; it cannot run inside a transaction.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_message_room_id_timestamp",
+            "message",
+            ["room_id", "timestamp", "id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_message_sender_receiver_timestamp",
+            "message",
+            ["sender_id", "receiver_id", "timestamp", "id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_message_unread_receiver",
+            "message",
+            ["receiver_id", "sender_id"],
+            unique=False,
+            postgresql_where=sa.text("is_read = false"),
+            sqlite_where=sa.text("is_read = 0"),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_message_unread_receiver", table_name="message", postgresql_concurrently=True)
+        op.drop_index("ix_message_sender_receiver_timestamp", table_name="message", postgresql_concurrently=True)
+        op.drop_index("ix_message_room_id_timestamp", table_name="message", postgresql_concurrently=True)
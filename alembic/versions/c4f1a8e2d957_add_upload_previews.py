@@ -0,0 +1,32 @@
+"""Add image preview columns to upload_object
+
+Revision ID: c4f1a8e2d957
+Revises: b9e4d2a7c613
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "c4f1a8e2d957"
+down_revision: Union[str, None] = "b9e4d2a7c613"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("upload_object", sa.Column("width", sa.Integer(), nullable=True))
+    op.add_column("upload_object", sa.Column("height", sa.Integer(), nullable=True))
+    op.add_column("upload_object", sa.Column("thumbnail", sa.String(length=96), nullable=True))
+    op.add_column("upload_object", sa.Column("blurhash", sa.String(length=64), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("upload_object") as batch_op:
+        batch_op.drop_column("blurhash")
+        batch_op.drop_column("thumbnail")
+        batch_op.drop_column("height")
+        batch_op.drop_column("width")
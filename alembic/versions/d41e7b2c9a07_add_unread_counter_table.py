@@ -0,0 +1,53 @@
+"""Add unread_counter table
+
+Revision ID: d41e7b2c9a07
+Revises: c3d9a1f5e842
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "d41e7b2c9a07"
+down_revision: Union[str, None] = "c3d9a1f5e842"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "unread_counter",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("conversation_key", sa.String(length=32), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"]),
+        sa.PrimaryKeyConstraint("user_id", "conversation_key"),
+    )
+    # Backfill from the current unread state
+    op.execute(
+        """
+        INSERT INTO unread_counter (user_id, conversation_key, count)
+        SELECT receiver_id, 'u:' || sender_id, COUNT(*)
+        FROM message
+        WHERE receiver_id IS NOT NULL AND is_read = false
+        GROUP BY receiver_id, sender_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO unread_counter (user_id, conversation_key, count)
+        SELECT m.user_id, 'r:' || m.chatroom_id, COUNT(msg.id)
+        FROM chatroom_member m
+        JOIN message msg ON msg.room_id = m.chatroom_id
+            AND msg.timestamp > m.last_read_at
+            AND msg.sender_id != m.user_id
+        GROUP BY m.user_id, m.chatroom_id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("unread_counter")
@@ -0,0 +1,31 @@
+"""Add writing transaction id to change_log
+
+Revision ID: d7a3c9e1b562
+Revises: c4f1a8e2d957
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "d7a3c9e1b562"
+down_revision: Union[str, None] = "c4f1a8e2d957"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("change_log", sa.Column("txid", sa.BigInteger(), nullable=True))
+    if op.get_bind().dialect.name == "postgresql":
+        # Existing rows sort before any new transaction, in id order, so old cursors stay valid
+        op.execute("UPDATE change_log SET txid = 0")
+    op.create_index("ix_change_log_txid", "change_log", ["txid", "id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_change_log_txid", table_name="change_log")
+    with op.batch_alter_table("change_log") as batch_op:
+        batch_op.drop_column("txid")
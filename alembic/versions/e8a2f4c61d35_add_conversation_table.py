@@ -0,0 +1,78 @@
+"""Add conversation table for DM pairs
+
+Revision ID: e8a2f4c61d35
+Revises: d41e7b2c9a07
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "e8a2f4c61d35"
+down_revision: Union[str, None] = "d41e7b2c9a07"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+LOW_ID = "CASE WHEN sender_id < receiver_id THEN sender_id ELSE receiver_id END"
+HIGH_ID = "CASE WHEN sender_id < receiver_id THEN receiver_id ELSE sender_id END"
+
+
+def upgrade() -> None:
+    op.create_table(
+        "conversation",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("low_id", sa.Integer(), nullable=False),
+        sa.Column("high_id", sa.Integer(), nullable=False),
+        sa.Column("last_message_id", sa.Integer(), nullable=True),
+        sa.Column("last_activity", sa.DateTime(timezone=True), server_default=sa.text("(CURRENT_TIMESTAMP)"), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("(CURRENT_TIMESTAMP)"), nullable=True),
+        sa.ForeignKeyConstraint(["low_id"], ["user.id"]),
+        sa.ForeignKeyConstraint(["high_id"], ["user.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("low_id", "high_id", name="uq_conversation_pair"),
+    )
+    op.create_index(op.f("ix_conversation_id"), "conversation", ["id"], unique=False)
+    op.create_index("ix_conversation_high_id", "conversation", ["high_id"], unique=False)
+
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.add_column(sa.Column("conversation_id", sa.Integer(), nullable=True))
+        batch_op.create_foreign_key("fk_message_conversation_id", "conversation", ["conversation_id"], ["id"])
+
+    # Backfill: one conversation per existing DM pair, then point messages at it
+    op.execute(
+        f"""
+        INSERT INTO conversation (low_id, high_id, last_message_id, last_activity)
+        SELECT {LOW_ID}, {HIGH_ID}, MAX(id), MAX(timestamp)
+        FROM message
+        WHERE receiver_id IS NOT NULL AND room_id IS NULL
+        GROUP BY {LOW_ID}, {HIGH_ID}
+        """
+    )
+    op.execute(
+        f"""
+        UPDATE message SET conversation_id = (
+            SELECT c.id FROM conversation c
+            WHERE c.low_id = {LOW_ID} AND c.high_id = {HIGH_ID}
+        )
+        WHERE receiver_id IS NOT NULL AND room_id IS NULL
+        """
+    )
+    op.create_index(
+        "ix_message_conversation_id_timestamp",
+        "message",
+        ["conversation_id", "timestamp", "id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_message_conversation_id_timestamp", table_name="message")
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.drop_constraint("fk_message_conversation_id", type_="foreignkey")
+        batch_op.drop_column("conversation_id")
+    op.drop_index("ix_conversation_high_id", table_name="conversation")
+    op.drop_index(op.f("ix_conversation_id"), table_name="conversation")
+    op.drop_table("conversation")
@@ -0,0 +1,39 @@
+"""Add last message pointer to chatroom
+
+Revision ID: f1b7d3e9a402
+Revises: e8a2f4c61d35
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "f1b7d3e9a402"
+down_revision: Union[str, None] = "e8a2f4c61d35"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # New rooms get last_activity from the model's default (now())
+    op.add_column("chatroom", sa.Column("last_message_id", sa.Integer(), nullable=True))
+    op.add_column("chatroom", sa.Column("last_activity", sa.DateTime(timezone=True), nullable=True))
+    op.execute(
+        """
+        UPDATE chatroom SET
+            last_message_id = (SELECT MAX(id) FROM message WHERE message.room_id = chatroom.id),
+            last_activity = COALESCE(
+                (SELECT MAX(timestamp) FROM message WHERE message.room_id = chatroom.id),
+                CURRENT_TIMESTAMP
+            )
+        """
+    )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("chatroom") as batch_op:
+        batch_op.drop_column("last_activity")
+        batch_op.drop_column("last_message_id")
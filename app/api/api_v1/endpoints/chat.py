@@ -1,14 +1,29 @@
-from typing import Any, List, Dict
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from typing import Any, List, Dict, Optional
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, or_, and_, func
+from sqlalchemy import select, or_, and_, func, false
 
 from app.api import deps
+from app.core.metrics import metrics
 from app.db.session import get_db
 from app.models.chat import ChatRoom, ChatRoomMember
+from app.models.conversation import Conversation
 from app.models.message import Message
-from app.models.user import User
 from app.schemas.message import Message as MessageSchema
+from app.services.changes import (
+    MESSAGE_DELETE, MESSAGE_UPDATE, ROOM_CREATED, change, changes_since, message_change, record_changes,
+)
+from app.services.conversations import get_conversation_id, retreat
+from app.services.export import export_messages, exports_busy, user_scope
+from app.services.inbox import inbox_page
+from app.services.membership import room_members
+from app.services.pagination import MAX_PAGE_SIZE, encode_cursor, keyset_page
+from app.services.previews import previews
+from app.services.recent import Key, conversation_key, entry_for, recent_messages
+from app.services.unread import query_unread_counts, unread_counters
+from app.services.uploads import add_references
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -25,6 +40,22 @@ class RoomRead(BaseModel):
     class Config:
         from_attributes = True
 
+class InboxItem(BaseModel):
+    kind: str # "user" (DM peer) or "room"
+    id: int
+    name: Optional[str] = None
+    last_activity: Optional[datetime] = None
+    last_message: Optional[MessageSchema] = None
+    unread: int = 0
+
+class SyncResponse(BaseModel):
+    cursor: str
+    has_more: bool
+    messages: List[MessageSchema] # Created or edited since the cursor, current state
+    deleted_ids: List[int]
+    receipts: List[Dict[str, Any]]
+    rooms: List[Dict[str, Any]]
+
 class UnreadCount(BaseModel):
     user_id: int
     count: int
@@ -32,59 +63,58 @@ class UnreadCount(BaseModel):
 @router.get("/unread", response_model=Dict[str, Any])
 async def get_unread_counts(
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     """
     Get unread message counts for all conversations.
     Returns: { "users": { "1": 5 }, "rooms": { "2": 3 } }
     """
-    
-    # Unread from Users (Direct Messages)
-    stmt_users = (
-        select(Message.sender_id, func.count(Message.id))
-        .where(
-            and_(
-                Message.receiver_id == current_user.id,
-                Message.is_read == False
-            )
-        )
-        .group_by(Message.sender_id)
-    )
-    result_users = await db.execute(stmt_users)
-    unread_users = {str(row[0]): row[1] for row in result_users.all()}
-    
-    # Unread from Rooms
-    # 1. Get user's membership info (last_read_at for each room)
-    stmt_memberships = select(ChatRoomMember).where(ChatRoomMember.user_id == current_user.id)
-    result_memberships = await db.execute(stmt_memberships)
-    memberships = result_memberships.scalars().all()
-    
-    unread_rooms = {}
-    for membership in memberships:
-        # Count messages in room sent AFTER last_read_at
-        stmt_count = (
-            select(func.count(Message.id))
-            .where(
-                and_(
-                    Message.room_id == membership.chatroom_id,
-                    Message.timestamp > membership.last_read_at
-                )
-            )
-        )
-        count = await db.scalar(stmt_count)
-        if count > 0:
-            unread_rooms[str(membership.chatroom_id)] = count
-    
-    return {
-        "users": unread_users,
-        "rooms": unread_rooms 
-    }
+    if unread_counters is not None:
+        return await unread_counters.get(db, current_user.id)
+    return await query_unread_counts(db, current_user.id)
+
+@router.get("/inbox", response_model=List[InboxItem])
+async def get_inbox(
+    response: Response,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    DM and room conversations, most recently active first, each with its last
+    message and unread count. The next page's cursor is in `X-Next-Cursor`.
+    """
+    try:
+        items, next_cursor = await inbox_page(db, current_user.id, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
+
+@router.get("/sync", response_model=SyncResponse)
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = 500,
+    db: AsyncSession = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Everything that changed in the user's conversations after `since`.
+    Call without `since` to get the current cursor; while `has_more` is
+    true, call again with the returned cursor.
+    """
+    try:
+        return await changes_since(db, current_user.id, since, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 @router.post("/rooms", response_model=RoomRead)
 async def create_room(
     room_in: RoomCreate,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     """
     Create a new chat room (group).
@@ -99,16 +129,18 @@ async def create_room(
     # Add other members
     for member_id in room_in.member_ids:
         db.add(ChatRoomMember(chatroom_id=room.id, user_id=member_id))
-        
-    await db.commit()
-    await db.refresh(room)
-    
-    # Broadcast Room Creation
+
     room_data = {
         "id": room.id,
         "name": room.name,
         "is_group": room.is_group
     }
+    await record_changes(db, [change(ROOM_CREATED, room_id=room.id, data=room_data)])
+    await db.commit()
+    await db.refresh(room)
+    await room_members.changed(room.id, added=[current_user.id, *room_in.member_ids])
+    
+    # Broadcast Room Creation
     event = WSEvent(
         event="room.created",
         data=room_data,
@@ -121,7 +153,7 @@ async def create_room(
 @router.get("/rooms", response_model=List[RoomRead])
 async def list_rooms(
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     """
     List rooms current user is member of.
@@ -130,39 +162,137 @@ async def list_rooms(
     result = await db.execute(stmt)
     return result.scalars().all()
 
+async def _history_page(
+    db: AsyncSession,
+    stmt,
+    response: Response,
+    skip: int,
+    limit: int,
+    before_id: Optional[int],
+    after_id: Optional[int],
+    cursor: Optional[str],
+    key: Optional[Key] = None,
+) -> Any:
+    """
+    Run a history query one keyset page at a time and expose the cursor for
+    the next (older) page as `X-Next-Cursor`. Plain `skip` paging is kept for
+    old clients. First pages of a conversation (`key`) are served from, or
+    seed, the recent-messages buffer.
+    """
+    first_page = before_id is None and after_id is None and cursor is None and not skip
+    page_size = max(1, min(limit, MAX_PAGE_SIZE))
+    version = None
+    if first_page and key is not None and recent_messages is not None:
+        entries = await recent_messages.page(key, page_size)
+        if entries is not None:
+            metrics.inc("recent_messages_hits_total")
+            frames = await previews.attach_frames([frame for _, frame in entries], db)
+            cached = Response(
+                content="[" + ",".join(frames) + "]",
+                media_type="application/json",
+            )
+            if len(entries) >= page_size:
+                cached.headers["X-Next-Cursor"] = encode_cursor(*entries[0][0])
+            return cached
+        metrics.inc("recent_messages_misses_total")
+        # Read before the query: a write that lands while it runs voids the fill
+        version = await recent_messages.version(key)
+
+    if before_id is None and after_id is None and cursor is None and skip:
+        stmt = stmt.order_by(Message.timestamp.desc(), Message.id.desc()).offset(skip).limit(limit)
+        ascending = False
+    else:
+        try:
+            stmt, ascending = keyset_page(stmt, limit, before_id=before_id, after_id=after_id, cursor=cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    result = await db.execute(stmt)
+    messages = result.scalars().all()
+    if not ascending:
+        messages = messages[::-1] # Return oldest first
+
+    await previews.attach(db, messages)
+    if messages and not ascending and len(messages) >= page_size:
+        response.headers["X-Next-Cursor"] = encode_cursor(messages[0].timestamp, messages[0].id)
+    if first_page and key is not None and recent_messages is not None:
+        await recent_messages.fill(
+            key, [entry_for(m) for m in messages], exhausted=len(messages) < page_size, version=version
+        )
+    return messages
+
 @router.get("/history/room/{room_id}", response_model=List[MessageSchema])
 async def get_room_history(
     room_id: int,
+    response: Response,
     skip: int = 0,
     limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    cursor: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     # Check access
     # ... (omitted for brevity, assume access if they know ID or check membership)
     
-    stmt = select(Message).where(Message.room_id == room_id).order_by(Message.timestamp.desc()).offset(skip).limit(limit)
-    result = await db.execute(stmt)
-    messages = result.scalars().all()
-    return messages[::-1] # Return oldest first
+    stmt = select(Message).where(Message.room_id == room_id)
+    return await _history_page(db, stmt, response, skip, limit, before_id, after_id, cursor, ("room", room_id))
 
 @router.get("/history/user/{user_id}", response_model=List[MessageSchema])
 async def get_private_history(
     user_id: int,
+    response: Response,
     skip: int = 0,
     limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    cursor: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
-    stmt = select(Message).where(
-        or_(
-            and_(Message.sender_id == current_user.id, Message.receiver_id == user_id),
-            and_(Message.sender_id == user_id, Message.receiver_id == current_user.id)
-        )
-    ).order_by(Message.timestamp.desc()).offset(skip).limit(limit)
-    result = await db.execute(stmt)
-    messages = result.scalars().all()
-    return messages[::-1]
+    conversation_id = await get_conversation_id(db, current_user.id, user_id)
+    if conversation_id is None:
+        return []
+    stmt = select(Message).where(Message.conversation_id == conversation_id)
+    return await _history_page(db, stmt, response, skip, limit, before_id, after_id, cursor, ("dm", conversation_id))
+
+def _export_response(scope, after_id: int) -> StreamingResponse:
+    if exports_busy():
+        raise HTTPException(status_code=429, detail="Too many exports in progress")
+    return StreamingResponse(export_messages(scope, after_id), media_type="application/x-ndjson")
+
+@router.get("/export")
+async def export_history(
+    after_id: int = 0,
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Stream every message the user can see as NDJSON, oldest id first.
+    Resume an interrupted export with `after_id` set to the last id received.
+    """
+    return _export_response(user_scope(current_user.id), after_id)
+
+@router.get("/export/room/{room_id}")
+async def export_room_history(
+    room_id: int,
+    after_id: int = 0,
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    if current_user.id not in await room_members.get(room_id):
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    return _export_response(Message.room_id == room_id, after_id)
+
+@router.get("/export/user/{user_id}")
+async def export_private_history(
+    user_id: int,
+    after_id: int = 0,
+    db: AsyncSession = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    conversation_id = await get_conversation_id(db, current_user.id, user_id)
+    scope = Message.conversation_id == conversation_id if conversation_id is not None else false()
+    return _export_response(scope, after_id)
     
 from app.ws.manager import manager
 from app.schemas.ws_events import WSEvent
@@ -175,7 +305,7 @@ async def update_message(
     message_id: int,
     message_in: MessageUpdate,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     stmt = select(Message).where(Message.id == message_id)
     result = await db.execute(stmt)
@@ -187,9 +317,18 @@ async def update_message(
     if message.sender_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to edit this message")
 
+    await add_references(db, [message.content], -1)
+    await add_references(db, [message_in.content])
     message.content = message_in.content
+    await record_changes(db, [
+        message_change(MESSAGE_UPDATE, message.id, message.conversation_id, message.room_id)
+    ])
     await db.commit()
     await db.refresh(message)
+    await previews.attach(db, [message])
+    key = conversation_key(message.conversation_id, message.room_id)
+    if recent_messages is not None and key is not None:
+        await recent_messages.replace(key, message.id, entry_for(message))
 
     # Broadcast Update
     update_event = WSEvent(
@@ -210,7 +349,7 @@ async def update_message(
 async def delete_message(
     message_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     stmt = select(Message).where(Message.id == message_id)
     result = await db.execute(stmt)
@@ -234,7 +373,18 @@ async def delete_message(
     )
 
     await db.delete(message)
+    await add_references(db, [message.content], -1)
+    if message.conversation_id is not None:
+        await retreat(db, Conversation, message.conversation_id, message.id)
+    elif message.room_id is not None:
+        await retreat(db, ChatRoom, message.room_id, message.id)
+    await record_changes(db, [
+        message_change(MESSAGE_DELETE, message.id, message.conversation_id, message.room_id, delete_event.data)
+    ])
     await db.commit()
+    key = conversation_key(message.conversation_id, message.room_id)
+    if recent_messages is not None and key is not None:
+        await recent_messages.replace(key, message.id, None)
 
     # Broadcast Delete
     await manager.broadcast(delete_event)
@@ -1,43 +1,179 @@
-import shutil
-import os
-import uuid
-from typing import Any
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from typing import Any, Dict, Optional
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import BaseModel, Field
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+from app.api import deps
+from app.db.session import get_db
+from app.models.upload import UploadObject
+from app.services import upload_sessions
+from app.services.previews import previews
+from app.services.uploads import UPLOAD_URL_PREFIX, UploadTooLarge, body_limit, capped, collect_garbage, store_upload
 from app.core.config import settings
+from app.core.metrics import metrics
 
 router = APIRouter()
 
-UPLOAD_DIR = "app/static/uploads"
+def _too_large() -> HTTPException:
+    metrics.inc("uploads_rejected_too_large_total")
+    return HTTPException(status_code=413, detail="File too large")
 
-@router.post("/upload", response_model=Any)
-async def upload_file(
-    file: UploadFile = File(...)
-) -> Any:
+UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "properties": {"file": {"type": "string", "format": "binary"}},
+                "required": ["file"],
+            }
+        }
+    },
+}
+
+@router.post("/upload", response_model=Any, openapi_extra={"requestBody": UPLOAD_REQUEST_BODY})
+async def upload_file(request: Request, db: AsyncSession = Depends(get_db)) -> Any:
+    """
+    Upload a file (image) and return the URL. Identical content always gets
+    the same URL, which is safe to cache forever. Images also get a
+    thumbnail and blurhash `preview`.
     """
-    Upload a file (image) and return the URL.
-    """
-    # Verify file type (basic check)
-    # Allow images and basic docs
-    # if not file.content_type.startswith("image/"):
-    #    raise HTTPException(status_code=400, detail="Only image files are allowed")
-    
-    # Generate unique filename
-    file_ext = os.path.splitext(file.filename)[1]
-    filename = f"{uuid.uuid4()}{file_ext}"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    
-    # Save file
+    # Parsed here rather than with File(...) so the size cap applies while
+    # the body streams in, not after all of it has been spooled
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > body_limit():
+        raise _too_large()
+    if "multipart/form-data" not in request.headers.get("content-type", ""):
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
-        
+        form = await MultiPartParser(request.headers, capped(request.stream(), body_limit()), max_files=1).parse()
+    except UploadTooLarge:
+        raise _too_large()
+    except MultiPartException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+
+    file = form.get("file")
+    try:
+        if not isinstance(file, UploadFile):
+            raise HTTPException(status_code=400, detail="Missing file")
+        if file.size is not None and file.size > settings.UPLOAD_MAX_BYTES:
+            raise _too_large()
+
+        # Verify file type (basic check)
+        # Allow images and basic docs
+        # if not file.content_type.startswith("image/"):
+        #    raise HTTPException(status_code=400, detail="Only image files are allowed")
+
+        try:
+            stored = await store_upload(db, file)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
+    finally:
+        await form.close()
+
+    return await _upload_response(stored, file.filename, file.content_type)
+
+async def _upload_response(stored: UploadObject, filename: Optional[str], content_type: Optional[str]) -> Dict[str, Any]:
     # Return URL (Assuming local serving)
     # In production, this would be an S3 URL
     return {
-        "filename": file.filename, # Return original filename
-        "url": f"/static/uploads/{filename}",
-        "content_type": file.content_type,
-        "size": file.size
+        "filename": filename, # Return original filename
+        "url": f"{UPLOAD_URL_PREFIX}{stored.filename}",
+        "content_type": content_type,
+        "size": stored.size,
+        "sha256": stored.sha256,
+        "preview": await previews.for_upload(stored), # Images only; null if not ready in time
     }
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    content_type: Optional[str] = None
+    size: int = Field(ge=0)
+
+class UploadSessionStatus(BaseModel):
+    upload_id: str
+    filename: str
+    content_type: Optional[str] = None
+    size: int
+    offset: int # Bytes received so far; the next PUT starts here
+
+@router.post("/uploads", response_model=UploadSessionStatus)
+async def create_upload_session(
+    session_in: UploadSessionCreate,
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Start a resumable upload: PUT the bytes to /uploads/{upload_id}?offset=N
+    in one or more requests, then POST /uploads/{upload_id}/complete.
+    """
+    try:
+        return await upload_sessions.create_session(
+            current_user.id, session_in.filename, session_in.content_type, session_in.size
+        )
+    except UploadTooLarge:
+        raise _too_large()
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionStatus)
+async def get_upload_session(
+    upload_id: str,
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Progress of a resumable upload; resume from `offset` after a failure.
+    """
+    try:
+        return await upload_sessions.session_status(upload_id, current_user.id)
+    except upload_sessions.UploadSessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+@router.put("/uploads/{upload_id}", response_model=UploadSessionStatus)
+async def put_upload_chunk(
+    upload_id: str,
+    offset: int,
+    request: Request,
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Append the raw request body at `offset`, which must equal the upload's
+    current offset (409 with the current one otherwise).
+    """
+    try:
+        return await upload_sessions.append_chunk(upload_id, current_user.id, offset, request.stream())
+    except upload_sessions.UploadSessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except upload_sessions.OffsetMismatch as e:
+        raise HTTPException(status_code=409, detail={"message": "Offset mismatch", "offset": e.offset})
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Chunk exceeds the declared size")
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload_session(
+    upload_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Store a fully uploaded file; returns the same fields as /upload.
+    """
+    try:
+        status = await upload_sessions.session_status(upload_id, current_user.id)
+        stored = await upload_sessions.complete_session(db, upload_id, current_user.id)
+    except upload_sessions.UploadSessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except upload_sessions.OffsetMismatch as e:
+        raise HTTPException(status_code=409, detail={"message": "Upload incomplete", "offset": e.offset})
+    return await _upload_response(stored, status["filename"], status["content_type"])
+
+@router.post("/uploads/gc")
+async def collect_upload_garbage(
+    db: AsyncSession = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Delete uploaded files no message links to (superusers only).
+    """
+    if not current_user.is_superuser:
+        raise HTTPException(status_code=403, detail="Not enough privileges")
+    return {"deleted": await collect_garbage(db)}
@@ -1,5 +1,5 @@
 from typing import Any, List
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
@@ -7,6 +7,7 @@ from app.api import deps
 from app.db.session import get_db
 from app.models.user import User
 from app.schemas.user import User as UserSchema
+from app.services.principals import principals
 
 router = APIRouter()
 
@@ -15,7 +16,7 @@ async def read_users(
     skip: int = 0,
     limit: int = 100,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     """
     Retrieve users.
@@ -26,9 +27,29 @@ async def read_users(
 
 @router.get("/me", response_model=UserSchema)
 async def read_user_me(
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Any:
     """
     Get current user.
     """
     return current_user
+
+@router.post("/{user_id}/deactivate", response_model=UserSchema)
+async def deactivate_user(
+    user_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_user),
+) -> Any:
+    """
+    Deactivate a user (superusers only). Their tokens stop working immediately.
+    """
+    if not current_user.is_superuser:
+        raise HTTPException(status_code=403, detail="Not enough privileges")
+    user = await db.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    user.is_active = False
+    await db.commit()
+    await db.refresh(user)
+    await principals.invalidate(user_id)
+    return user
@@ -5,14 +5,13 @@ from fastapi import APIRouter, Depends
 
 from app.api import deps
 from app.core.config import settings
-from app.models.user import User
 
 router = APIRouter()
 
 
 @router.get("/ice-servers", response_model=Dict[str, Any])
 async def get_ice_servers(
-    current_user: User = Depends(deps.get_current_user),
+    current_user: deps.Principal = Depends(deps.get_current_user),
 ) -> Dict[str, Any]:
     ice_servers: List[Dict[str, Any]] = [{"urls": ["stun:stun.l.google.com:19302"]}]
 
@@ -1,14 +1,18 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, status
+from typing import Optional
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import update, select
-from sqlalchemy.orm import selectinload
 from app.api import deps
+from app.ws.coalesce import coalescer
 from app.ws.manager import manager
 from app.schemas.ws_events import WSEvent
 from app.models.message import Message, MessageType
-from app.models.chat import ChatRoom
-from app.models.call import CallSession
+from app.services.call_state import ACTIVE, END_STATUSES, CallState, call_recorder, call_states
 from app.services.calls import can_initiate_call
+from app.services.membership import room_members
+from app.services.persistence import message_writer
+from app.services.previews import previews
+from app.services.receipts import DELIVERED, READ, receipt_aggregator
+from app.services.uploads import upload_filename
 from app.db.session import AsyncSessionLocal
 import json
 from datetime import datetime
@@ -22,13 +26,14 @@ logger = logging.getLogger(__name__)
 @router.websocket("/chat")
 async def websocket_endpoint(
     websocket: WebSocket,
+    cursor: Optional[str] = Query(None),
     current_user = Depends(deps.get_current_user_ws),
 ):
     if not current_user:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    await manager.connect(websocket, current_user.id)
+    connection = await manager.connect(websocket, current_user.id, cursor)
     invite_timestamps = deque()
     
     try:
@@ -42,7 +47,7 @@ async def websocket_endpoint(
                 event_data = json.loads(data)
                 event = WSEvent(**event_data)
             except Exception:
-                await websocket.send_json({"error": "Invalid JSON format"})
+                connection.send(json.dumps({"error": "Invalid JSON format"}))
                 continue
 
             if event.event == "message.send":
@@ -54,114 +59,85 @@ async def websocket_endpoint(
                 if not content:
                     continue
 
-                # Save to DB
-                async with AsyncSessionLocal() as db:
-                    msg = Message(
+                message_type = MessageType.IMAGE if content.startswith("/static/") or payload.get("message_type") == "image" else MessageType.TEXT
+                timestamp = datetime.utcnow()
+
+                # Save to DB (batched with other connections' inserts)
+                try:
+                    message_id = await message_writer.save(
                         content=content,
                         sender_id=current_user.id,
                         receiver_id=receiver_id,
                         room_id=room_id,
-                        message_type=MessageType.IMAGE if content.startswith("/static/") or payload.get("message_type") == "image" else MessageType.TEXT,
-                        timestamp=datetime.utcnow(),
-                        is_read=False
+                        message_type=message_type,
+                        timestamp=timestamp,
+                        is_read=False,
+                        status="sent",
                     )
-                    db.add(msg)
-                    await db.commit()
-                    await db.refresh(msg)
+                except Exception as e:
+                    logger.warning(f"Message from user {current_user.id} not saved: {e}")
+                    connection.send(json.dumps({"error": "Message could not be saved"}))
+                    continue
+                # Thumbnail and blurhash of a linked image upload, if generated
+                try:
+                    preview = (await previews.lookup([content])).get(upload_filename(content))
+                except Exception as e:
+                    # The message is stored; it just goes out without a preview
+                    logger.warning(f"Preview lookup for message {message_id} failed: {e}")
+                    preview = None
+                
+                # Construct event for recipient
+                receive_event = WSEvent(
+                    event="message.receive",
+                    data={
+                        "id": message_id,
+                        "content": content,
+                        "sender_id": current_user.id,
+                        "receiver_id": receiver_id,
+                        "room_id": room_id,
+                        "message_type": message_type.value, # Pass type to client
+                        "timestamp": timestamp.isoformat(),
+                        "preview": preview,
+                    }
+                )
+                
+                # Send to receiver or room
+                if receiver_id:
+                    # Publish to Redis for cross-instance delivery
+                    await manager.broadcast(receive_event)
                     
-                    # Construct event for recipient
-                    receive_event = WSEvent(
-                        event="message.receive",
+                    # Send Ack to Sender
+                    ack_event = WSEvent(
+                        event="message.ack",
                         data={
-                            "id": msg.id,
-                            "content": msg.content,
-                            "sender_id": msg.sender_id,
-                            "receiver_id": msg.receiver_id,
-                            "room_id": msg.room_id,
-                            "message_type": msg.message_type.value, # Pass type to client
-                            "timestamp": msg.timestamp.isoformat()
+                            "message_id": message_id,
+                            "status": "sent",
+                            "timestamp": timestamp.isoformat()
                         }
                     )
+                    connection.send(ack_event.model_dump_json())
                     
-                    # Send to receiver or room
-                    if receiver_id:
-                        # Publish to Redis for cross-instance delivery
+                elif room_id:
+                    # Only the room's members receive it (cached, see services.membership)
+                    member_ids = await room_members.get(room_id)
+                    if member_ids:
+                        receive_event.recipient_ids = list(member_ids)
                         await manager.broadcast(receive_event)
-                        
-                        # Send Ack to Sender
-                        ack_event = WSEvent(
-                            event="message.ack",
-                            data={
-                                "message_id": msg.id,
-                                "status": "sent",
-                                "timestamp": msg.timestamp.isoformat()
-                            }
-                        )
-                        await websocket.send_text(ack_event.model_dump_json())
-                        
-                    elif room_id:
-                        # Fetch room members to ensure privacy
-                        stmt = select(ChatRoom).where(ChatRoom.id == room_id).options(selectinload(ChatRoom.members))
-                        result = await db.execute(stmt)
-                        room = result.scalar_one_or_none()
-                        
-                        if room:
-                            receive_event.recipient_ids = [m.id for m in room.members]
-                            await manager.broadcast(receive_event)
 
-            elif event.event == "message.delivered":
+            elif event.event in ("message.delivered", "message.read"):
+                kind = READ if event.event == "message.read" else DELIVERED
+                up_to_id = event.data.get("up_to_id")
                 message_id = event.data.get("message_id")
                 sender_id = event.data.get("sender_id")
-                
-                if message_id:
-                    async with AsyncSessionLocal() as db:
-                        stmt = (
-                            update(Message)
-                            .where(Message.id == message_id)
-                            .values(status="delivered")
-                        )
-                        await db.execute(stmt)
-                        await db.commit()
-                    
-                    if sender_id:
-                        delivery_receipt = WSEvent(
-                            event="message.delivery_receipt",
-                            data={
-                                "message_id": message_id,
-                                "receiver_id": sender_id,
-                                "timestamp": datetime.utcnow().isoformat()
-                            }
-                        )
-                        await manager.broadcast(delivery_receipt)
 
-            elif event.event == "message.read":
-                message_id = event.data.get("message_id")
-                sender_id = event.data.get("sender_id")
-                
-                if message_id:
-                    # Update DB
-                    async with AsyncSessionLocal() as db:
-                        stmt = (
-                            update(Message)
-                            .where(Message.id == message_id)
-                            .values(is_read=True, status="read")
-                        )
-                        await db.execute(stmt)
-                        await db.commit()
-                    
-                    # Notify original sender that message was read
-                    if sender_id:
-                        read_receipt = WSEvent(
-                            event="message.read_receipt",
-                            data={
-                                "message_id": message_id,
-                                "reader_id": current_user.id,
-                                "receiver_id": sender_id, # Targeted to original sender
-                                "timestamp": datetime.utcnow().isoformat()
-                            }
-                        )
-                        # Broadcast to find the sender
-                        await manager.broadcast(read_receipt)
+                # Applied in batches; receipts are sent to the original senders
+                if up_to_id:
+                    receipt_aggregator.add_watermark(
+                        kind, current_user.id, up_to_id,
+                        peer_id=sender_id, room_id=event.data.get("room_id"),
+                    )
+                elif message_id:
+                    receipt_aggregator.add(kind, current_user.id, message_id, sender_id)
 
             elif event.event == "typing.start":
                 receiver_id = event.data.get("receiver_id")
@@ -170,7 +146,7 @@ async def websocket_endpoint(
                          event="typing.start",
                          data={"sender_id": current_user.id, "receiver_id": receiver_id}
                      )
-                     await manager.broadcast(typing_event)
+                     await coalescer.typing_event(typing_event)
 
             elif event.event == "typing.stop":
                 receiver_id = event.data.get("receiver_id")
@@ -179,90 +155,88 @@ async def websocket_endpoint(
                          event="typing.stop",
                          data={"sender_id": current_user.id, "receiver_id": receiver_id}
                      )
-                     await manager.broadcast(typing_event)
+                     await coalescer.typing_event(typing_event)
 
             elif event.event.startswith("call."):
                 payload = event.data if isinstance(event.data, dict) else None
                 if not payload:
-                    await websocket.send_json({"event": "call.error", "data": {"message": "Invalid call payload", "context_event": event.event}})
+                    connection.send(json.dumps({"event": "call.error", "data": {"message": "Invalid call payload", "context_event": event.event}}))
                     continue
 
-                async with AsyncSessionLocal() as db:
-                    if event.event == "call.invite":
-                        target_user_id = payload.get("to_user_id") or payload.get("receiver_id") or payload.get("peer_user_id")
-                        if not target_user_id:
-                            await websocket.send_json({"event": "call.error", "data": {"message": "Missing call recipient", "context_event": event.event}})
-                            continue
-
-                        now = datetime.utcnow()
-                        recent = [t for t in invite_timestamps if (now - t).total_seconds() < 30]
-                        recent.append(now)
-                        invite_timestamps = deque(recent)
-                        if len(invite_timestamps) > 3:
-                            await websocket.send_json({"event": "call.error", "data": {"message": "Too many call invites", "context_event": event.event}})
-                            continue
-
-                        room_id = payload.get("room_id")
+                if event.event == "call.invite":
+                    target_user_id = payload.get("to_user_id") or payload.get("receiver_id") or payload.get("peer_user_id")
+                    if not target_user_id:
+                        connection.send(json.dumps({"event": "call.error", "data": {"message": "Missing call recipient", "context_event": event.event}}))
+                        continue
+
+                    now = datetime.utcnow()
+                    recent = [t for t in invite_timestamps if (now - t).total_seconds() < 30]
+                    recent.append(now)
+                    invite_timestamps = deque(recent)
+                    if len(invite_timestamps) > 3:
+                        connection.send(json.dumps({"event": "call.error", "data": {"message": "Too many call invites", "context_event": event.event}}))
+                        continue
+
+                    room_id = payload.get("room_id")
+                    async with AsyncSessionLocal() as db:
                         allowed = await can_initiate_call(db, current_user.id, target_user_id, room_id)
-                        if not allowed:
-                            await websocket.send_json({"event": "call.error", "data": {"message": "Not allowed to call this user", "context_event": event.event}})
-                            continue
-
-                        call_id = payload.get("call_id") or str(uuid4())
-                        existing_call = await db.get(CallSession, call_id)
-                        if existing_call is not None:
-                            await websocket.send_json({"event": "call.error", "data": {"message": "Call already exists", "context_event": event.event, "call_id": call_id}})
-                            continue
-
-                        call = CallSession(
-                            call_id=call_id,
-                            room_id=room_id,
-                            caller_id=current_user.id,
-                            callee_id=target_user_id,
-                            status="ringing",
-                        )
-                        db.add(call)
-                        await db.commit()
-
-                        recipient_ids = [target_user_id]
-                        outgoing_payload = {**payload, "call_id": call_id}
-                    else:
-                        call_id = payload.get("call_id")
-                        if not call_id:
-                            await websocket.send_json({"event": "call.error", "data": {"message": "Missing call_id", "context_event": event.event}})
-                            continue
-
-                        call = await db.get(CallSession, call_id)
+                    if not allowed:
+                        connection.send(json.dumps({"event": "call.error", "data": {"message": "Not allowed to call this user", "context_event": event.event}}))
+                        continue
+
+                    call_id = payload.get("call_id") or str(uuid4())
+                    call = CallState(call_id=call_id, caller_id=current_user.id, callee_id=target_user_id, room_id=room_id)
+                    if not await call_states.create(call):
+                        connection.send(json.dumps({"event": "call.error", "data": {"message": "Call already exists", "context_event": event.event, "call_id": call_id}}))
+                        continue
+                    call_recorder.record(call)
+
+                    recipient_ids = [target_user_id]
+                    outgoing_payload = {**payload, "call_id": call_id}
+                else:
+                    call_id = payload.get("call_id")
+                    if not call_id:
+                        connection.send(json.dumps({"event": "call.error", "data": {"message": "Missing call_id", "context_event": event.event}}))
+                        continue
+
+                    # Signaling (offer/answer/ICE) is relayed from the call state store alone
+                    call = await call_states.get(call_id)
+                    if call is None:
+                        connection.send(json.dumps({"event": "call.error", "data": {"message": "Unknown call", "context_event": event.event, "call_id": call_id}}))
+                        continue
+
+                    other_user_id = call.peer_of(current_user.id)
+                    if other_user_id is None:
+                        connection.send(json.dumps({"event": "call.error", "data": {"message": "Not authorized for this call", "context_event": event.event, "call_id": call_id}}))
+                        continue
+
+                    recipient_ids = [other_user_id]
+                    outgoing_payload = payload
+
+                    if event.event == "call.accept" or event.event in END_STATUSES:
+                        new_status = ACTIVE if event.event == "call.accept" else END_STATUSES[event.event]
+                        call = await call_states.set_status(call, new_status)
                         if call is None:
-                            await websocket.send_json({"event": "call.error", "data": {"message": "Unknown call", "context_event": event.event, "call_id": call_id}})
+                            # Ended meanwhile, e.g. by the peer on another instance
+                            connection.send(json.dumps({"event": "call.error", "data": {"message": "Unknown call", "context_event": event.event, "call_id": call_id}}))
                             continue
+                        call_recorder.record(call)
 
-                        if current_user.id not in {call.caller_id, call.callee_id}:
-                            await websocket.send_json({"event": "call.error", "data": {"message": "Not authorized for this call", "context_event": event.event, "call_id": call_id}})
-                            continue
-
-                        other_user_id = call.callee_id if current_user.id == call.caller_id else call.caller_id
-                        recipient_ids = [other_user_id]
-                        outgoing_payload = payload
-
-                        if event.event == "call.accept":
-                            call.status = "active"
-                            call.started_at = datetime.utcnow()
-                            await db.commit()
-                        elif event.event in {"call.reject", "call.hangup", "call.busy"}:
-                            call.status = "rejected" if event.event == "call.reject" else ("busy" if event.event == "call.busy" else "ended")
-                            call.ended_at = datetime.utcnow()
-                            await db.commit()
+                outgoing_data = {**outgoing_payload, "from_user_id": current_user.id}
+                if event.event == "call.ice":
+                    # Trickled candidates are relayed in batches per call and sender
+                    coalescer.add_ice(call_id, current_user.id, recipient_ids, outgoing_data)
+                    continue
 
                 outgoing_event = WSEvent(
                     event=event.event,
-                    data={**outgoing_payload, "from_user_id": current_user.id},
+                    data=outgoing_data,
                     recipient_ids=recipient_ids,
                 )
                 await manager.broadcast(outgoing_event)
 
     except WebSocketDisconnect:
-        await manager.disconnect(current_user.id)
+        await manager.disconnect(connection)
     except Exception as e:
         logger.exception("Unhandled websocket error")
-        await manager.disconnect(current_user.id)
+        await manager.disconnect(connection)
@@ -1,4 +1,4 @@
-from typing import Generator, Optional
+from typing import Generator, Optional, Tuple
 from fastapi import Depends, HTTPException, status, WebSocket, Query
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
@@ -7,52 +7,62 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.core import security
 from app.core.config import settings
 from app.db.session import get_db
-from app.models.user import User
 from app.schemas.token import TokenPayload
-from sqlalchemy import select
+from app.services.principals import Principal, principals
 
 reusable_oauth2 = OAuth2PasswordBearer(
     tokenUrl=f"{settings.API_V1_STR}/login/access-token"
 )
 
-async def get_current_user(
-    db: AsyncSession = Depends(get_db),
-    token: str = Depends(reusable_oauth2)
-) -> User:
+def decode_token(token: str) -> Optional[Tuple[int, float]]:
+    """Verify a JWT and return its (user id, expiry timestamp), or None."""
     try:
         payload = jwt.decode(
             token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]
         )
         token_data = TokenPayload(**payload)
     except (JWTError, ValidationError):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Could not validate credentials",
-        )
-    
-    result = await db.execute(select(User).filter(User.id == token_data.sub))
-    user = result.scalars().first()
-    
-    if not user:
+        return None
+    if token_data.sub is None:
+        return None
+    return token_data.sub, payload.get("exp", 0)
+
+async def get_current_user(
+    db: AsyncSession = Depends(get_db),
+    token: str = Depends(reusable_oauth2)
+) -> Principal:
+    # Tokens verified before resolve from the cache without a query
+    principal = await principals.get(token)
+    if principal is None:
+        claims = decode_token(token)
+        if claims is None:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Could not validate credentials",
+            )
+        principal = await principals.load(db, token, *claims)
+
+    if not principal:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    if not principal.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return principal
 
 async def get_current_user_ws(
     websocket: WebSocket,
     token: str = Query(...),
     db: AsyncSession = Depends(get_db)
-) -> Optional[User]:
+) -> Optional[Principal]:
     """
     Authenticate WebSocket connection via query parameter token.
     """
-    try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]
-        )
-        token_data = TokenPayload(**payload)
-    except (JWTError, ValidationError):
+    principal = await principals.get(token)
+    if principal is None:
+        claims = decode_token(token)
+        if claims is None:
+            return None
+        principal = await principals.load(db, token, *claims)
+
+    if principal is None or not principal.is_active:
         return None
-        
-    result = await db.execute(select(User).filter(User.id == token_data.sub))
-    user = result.scalars().first()
-    return user
+    return principal
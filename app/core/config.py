@@ -11,11 +11,103 @@ class Settings(BaseSettings):
     
     # REDIS
     REDIS_URL: str = ""
+    # Identifies this instance in the user -> node registry (default: host-pid)
+    NODE_ID: str = ""
+    PRESENCE_TTL_SECONDS: int = 30
+
+    # EVENT BUS
+    # memory | redis (pub/sub) | streams (Redis Streams with replay) | ipc
+    # (Unix sockets between workers on one host). Empty picks redis when
+    # REDIS_URL is set, otherwise memory.
+    BROKER_BACKEND: str = ""
+    IPC_SOCKET_DIR: str = "/tmp/fastsock-ipc"
+    # Frames buffered per peer worker before the oldest are dropped
+    IPC_PEER_QUEUE_SIZE: int = 10_000
+    # Approximate number of events the streams backend retains for replay
+    EVENT_STREAM_MAXLEN: int = 100_000
+    # Most events replayed to a reconnecting client before it must resync
+    WS_REPLAY_LIMIT: int = 1000
+
+    # WEBSOCKETS
+    # Outbound frames buffered per connection before the overflow policy kicks in
+    WS_SEND_QUEUE_SIZE: int = 256
+    # drop_oldest | coalesce | disconnect
+    WS_SEND_OVERFLOW_POLICY: str = "drop_oldest"
+    # call.ice candidates from one sender are batched over this window, and
+    # typing events go out at most once per (sender, target) per interval
+    ICE_COALESCE_WINDOW_MS: int = 20
+    TYPING_COALESCE_INTERVAL_MS: int = 1000
+    # Event loop lag sampling for /metrics (0 disables)
+    EVENT_LOOP_MONITOR_INTERVAL_MS: int = 100
+    
+    # MESSAGE PERSISTENCE
+    # message.send rows are batched into one INSERT per window or batch size
+    MESSAGE_FLUSH_INTERVAL_MS: int = 5
+    MESSAGE_BATCH_SIZE: int = 200
+    # Delivery/read receipts arriving within this window share one transaction
+    RECEIPT_FLUSH_INTERVAL_MS: int = 50
+    # "" (count with grouped queries) | "table" | "redis": maintain unread
+    # counters incrementally instead
+    UNREAD_COUNTER_BACKEND: str = ""
+    # Room member ids cached for message fan-out; "redis" adds a tier shared
+    # by all instances behind the in-process LRU
+    ROOM_MEMBERS_CACHE_SIZE: int = 10_000
+    ROOM_MEMBERS_CACHE_TTL_SECONDS: int = 300
+    ROOM_MEMBERS_CACHE_BACKEND: str = ""
+    
+    # Newest messages per conversation kept serialized for first-page history.
+    # "" picks redis when REDIS_URL is set, memory for a single in-process
+    # instance, otherwise off; or set memory | redis | off explicitly.
+    RECENT_MESSAGES_BACKEND: str = ""
+    RECENT_MESSAGES_PER_CONVERSATION: int = 100
+    RECENT_MESSAGES_MAX_BYTES: int = 64 * 1024 * 1024
+    RECENT_MESSAGES_TTL_SECONDS: int = 3600
+    # Ringing/active WebRTC calls for signaling; "" picks redis when
+    # REDIS_URL is set, otherwise memory (refused when the broker spans
+    # several processes). Lifecycle transitions are written to call_session
+    # in the background.
+    CALL_STATE_BACKEND: str = ""
+    CALL_STATE_CACHE_SIZE: int = 10_000
+    CALL_STATE_TTL_SECONDS: int = 4 * 3600
+    CALL_RECORD_FLUSH_INTERVAL_MS: int = 100
+    
+    # UPLOADS
+    # Largest accepted file; the body is cut off while streaming past it
+    UPLOAD_MAX_BYTES: int = 10 * 1024 * 1024
+    # Bytes per read/write when moving an upload into place (worker thread)
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+    # Unreferenced uploads younger than this are kept by garbage collection
+    UPLOAD_GC_GRACE_SECONDS: int = 24 * 3600
+    # Resumable uploads (/utils/uploads): largest file, where partial data is
+    # kept, and how long an idle session survives the background sweep
+    RESUMABLE_UPLOAD_MAX_BYTES: int = 512 * 1024 * 1024
+    UPLOAD_SESSION_DIR: str = "upload_sessions"
+    UPLOAD_SESSION_TTL_SECONDS: int = 24 * 3600
+    UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS: int = 600
+    # Image previews: worker processes (0 disables), longest thumbnail side,
+    # how long an upload response waits for its preview, and cached lookups
+    PREVIEW_WORKERS: int = 2
+    PREVIEW_MAX_SIDE: int = 320
+    PREVIEW_WAIT_MS: int = 1000
+    PREVIEW_CACHE_SIZE: int = 10_000
+    
+    # NDJSON history exports: concurrent streams per process, rows fetched
+    # per server-side cursor batch and the pause between batches
+    EXPORT_MAX_CONCURRENT: int = 2
+    EXPORT_BATCH_SIZE: int = 1000
+    EXPORT_BATCH_PAUSE_MS: int = 10
     
     # SECURITY
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    # Verified tokens -> principal, so authenticated requests skip the user
+    # SELECT. "redis" (picked by "" when REDIS_URL is set, otherwise memory)
+    # shares the per-user auth version (used to invalidate cached tokens,
+    # e.g. on deactivation) across instances.
+    PRINCIPAL_CACHE_SIZE: int = 10_000
+    PRINCIPAL_CACHE_TTL_SECONDS: int = 300
+    PRINCIPAL_CACHE_BACKEND: str = ""
     
     # CORS
     BACKEND_CORS_ORIGINS: List[AnyHttpUrl] = []
@@ -0,0 +1,51 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    """
+    Minimal in-process counter/gauge registry, rendered in the Prometheus
+    text format by the /metrics endpoint.
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.gauges: Dict[str, float] = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        self.counters[name] += value
+
+    def gauge_add(self, name: str, value: float) -> None:
+        self.gauges[name] += value
+
+    def gauge_set(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted(self.counters):
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {self.counters[name]:g}")
+        for name in sorted(self.gauges):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {self.gauges[name]:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+async def monitor_event_loop(interval: float) -> None:
+    """
+    Sleep `interval` seconds in a loop and record how late each wakeup is:
+    time the loop spent blocked by synchronous work (file I/O, CPU-bound
+    code) instead of serving sockets.
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        metrics.gauge_set("event_loop_lag_seconds", lag)
+        metrics.inc("event_loop_blocked_seconds_total", lag)
@@ -3,5 +3,9 @@
 from app.db.base_class import Base  # noqa
 from app.models.user import User  # noqa
 from app.models.message import Message  # noqa
+from app.models.conversation import Conversation  # noqa
 from app.models.chat import ChatRoom  # noqa
 from app.models.call import CallSession  # noqa
+from app.models.unread import UnreadCounter  # noqa
+from app.models.change import ChangeLog  # noqa
+from app.models.upload import UploadObject  # noqa
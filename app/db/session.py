@@ -13,3 +13,11 @@ AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=F
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+def upsert(db: AsyncSession, model):
+    """INSERT for the session's dialect that supports ON CONFLICT clauses."""
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
@@ -1,5 +1,7 @@
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -8,6 +10,14 @@ from slowapi.errors import RateLimitExceeded
 
 from app.api.api_v1.api import api_router
 from app.core.config import settings
+from app.core.metrics import metrics, monitor_event_loop
+from app.services.call_state import call_recorder
+from app.services.persistence import message_writer
+from app.services.previews import previews
+from app.services.upload_sessions import sweep_upload_sessions
+from app.services.uploads import UPLOAD_DIR, UploadFiles
+from app.services.receipts import receipt_aggregator
+from app.ws.coalesce import coalescer
 from app.ws.manager import manager
 
 limiter = Limiter(key_func=get_remote_address)
@@ -15,11 +25,22 @@ limiter = Limiter(key_func=get_remote_address)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    await manager.start_redis()
+    await manager.start()
+    loop_monitor = None
+    if settings.EVENT_LOOP_MONITOR_INTERVAL_MS:
+        loop_monitor = asyncio.create_task(monitor_event_loop(settings.EVENT_LOOP_MONITOR_INTERVAL_MS / 1000))
+    session_sweeper = asyncio.create_task(sweep_upload_sessions(settings.UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS))
     yield
     # Shutdown
-    if manager.redis:
-        await manager.redis.close()
+    await message_writer.close()
+    await receipt_aggregator.close()
+    await call_recorder.close()
+    await coalescer.close()
+    await previews.close()
+    await manager.stop()
+    if loop_monitor is not None:
+        loop_monitor.cancel()
+    session_sweeper.cancel()
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -30,6 +51,7 @@ app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 # Mount Static Files
+app.mount("/static/uploads", UploadFiles(directory=UPLOAD_DIR), name="uploads")
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 # Set all CORS enabled origins
@@ -41,6 +63,7 @@ app.add_middleware(
     allow_credentials=True, 
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -49,3 +72,7 @@ app.include_router(api_router, prefix=settings.API_V1_STR)
 @app.get("/")
 def root():
     return {"message": "Welcome to FastSock Real-time Chat API"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    return metrics.render()
@@ -0,0 +1,32 @@
+from sqlalchemy import BigInteger, Column, Integer, String, Text, DateTime, Index
+from sqlalchemy.sql import func
+from app.db.base_class import Base
+
+
+class ChangeLog(Base):
+    """
+    Append-only log of chat mutations; `id` (with `txid` on Postgres) is
+    the sequence /chat/sync cursors point into. An entry is visible to the conversation's pair, the
+    room's members or a single user, whichever scope column is set.
+    """
+    __tablename__ = "change_log"
+
+    id = Column(Integer, primary_key=True)
+    # The WS event the change was announced with, e.g. "message.update"
+    event = Column(String(32), nullable=False)
+    message_id = Column(Integer, nullable=True)
+    conversation_id = Column(Integer, nullable=True)
+    room_id = Column(Integer, nullable=True)
+    user_id = Column(Integer, nullable=True)
+    # JSON event data for changes that cannot be rebuilt from `message`
+    data = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Writing transaction on Postgres, which orders the log there (see app.services.changes)
+    txid = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        Index("ix_change_log_conversation_id", "conversation_id", "id"),
+        Index("ix_change_log_room_id", "room_id", "id"),
+        Index("ix_change_log_user_id", "user_id", "id"),
+        Index("ix_change_log_txid", "txid", "id"),
+    )
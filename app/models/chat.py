@@ -20,6 +20,9 @@ class ChatRoom(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     is_group = Column(Boolean, default=True)
+    # Denormalized pointer to the newest message, for the inbox
+    last_message_id = Column(Integer, nullable=True)
+    last_activity = Column(DateTime(timezone=True), default=func.now())
     
     # Updated relationship via Association Object
     memberships = relationship("ChatRoomMember", back_populates="room", cascade="all, delete-orphan")
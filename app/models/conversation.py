@@ -0,0 +1,24 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.sql import func
+from app.db.base_class import Base
+
+
+class Conversation(Base):
+    """
+    A direct-message pair. Users are stored normalized (low_id < high_id) so
+    each pair has exactly one row, created with its first message.
+    """
+
+    id = Column(Integer, primary_key=True, index=True)
+    low_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    high_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    # Denormalized pointer to the newest message (no FK: message references us)
+    last_message_id = Column(Integer, nullable=True)
+    last_activity = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("low_id", "high_id", name="uq_conversation_pair"),
+        # Conversations where the user is the higher id (low_id is covered above)
+        Index("ix_conversation_high_id", "high_id"),
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Enum as SqlEnum
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Index, Enum as SqlEnum
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
@@ -15,6 +15,7 @@ class Message(Base):
     sender_id = Column(Integer, ForeignKey("user.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("user.id"), nullable=True) # For 1-1 chat
     room_id = Column(Integer, ForeignKey("chatroom.id"), nullable=True) # For group chat
+    conversation_id = Column(Integer, ForeignKey("conversation.id"), nullable=True) # Set for 1-1 chat
     
     message_type = Column(SqlEnum(MessageType), default=MessageType.TEXT)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
@@ -23,3 +24,20 @@ class Message(Base):
     
     sender = relationship("User", foreign_keys=[sender_id])
     receiver = relationship("User", foreign_keys=[receiver_id])
+
+    __table_args__ = (
+        # Room history (room_id + ORDER BY timestamp) and room unread counts
+        Index("ix_message_room_id_timestamp", "room_id", "timestamp", "id"),
+        # Per-direction DM lookups (read watermarks)
+        Index("ix_message_sender_receiver_timestamp", "sender_id", "receiver_id", "timestamp", "id"),
+        # DM history by conversation
+        Index("ix_message_conversation_id_timestamp", "conversation_id", "timestamp", "id"),
+        # Unread DMs per receiver; only unread rows are indexed
+        Index(
+            "ix_message_unread_receiver",
+            "receiver_id",
+            "sender_id",
+            postgresql_where=(is_read == False),
+            sqlite_where=(is_read == False),
+        ),
+    )
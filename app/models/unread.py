@@ -0,0 +1,12 @@
+from sqlalchemy import Column, Integer, String, ForeignKey
+from app.db.base_class import Base
+
+
+class UnreadCounter(Base):
+    """Denormalized unread count per user and conversation."""
+    __tablename__ = "unread_counter"
+
+    user_id = Column(Integer, ForeignKey("user.id"), primary_key=True)
+    # "u:<peer user id>" for DMs, "r:<room id>" for rooms
+    conversation_key = Column(String(32), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,29 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime
+from sqlalchemy.sql import func
+from app.db.base_class import Base
+
+
+class UploadObject(Base):
+    """
+    An uploaded file stored once per distinct content, keyed by its SHA-256.
+    `ref_count` counts the messages that link to it; objects nobody
+    references (or re-uploads) for a grace period are garbage collected.
+    """
+    __tablename__ = "upload_object"
+
+    sha256 = Column(String(64), primary_key=True)
+    # Name under UPLOAD_DIR and in the URL: "<sha256><ext>"
+    filename = Column(String(80), nullable=False, unique=True)
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String, nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Bumped when the same content is uploaded again, so GC spares it
+    last_uploaded_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Image previews, filled in by the preview pipeline after upload
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    # Name under UPLOAD_DIR: "<sha256>.thumb.webp"
+    thumbnail = Column(String(96), nullable=True)
+    blurhash = Column(String(64), nullable=True)
@@ -12,6 +12,12 @@ class MessageBase(BaseModel):
 class MessageCreate(MessageBase):
     pass
 
+class Preview(BaseModel):
+    thumbnail_url: str
+    blurhash: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
 class Message(MessageBase):
     id: int
     sender_id: int
@@ -20,6 +26,7 @@ class Message(MessageBase):
     timestamp: datetime
     is_read: bool
     message_type: str = "text"
+    preview: Optional[Preview] = None # Image uploads, once their preview is generated
 
     class Config:
         from_attributes = True
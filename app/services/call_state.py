@@ -0,0 +1,205 @@
+"""
+State of ringing and active WebRTC calls, kept off the database.
+
+`call.*` signaling looks calls up in a CallStateStore: an in-process TTL
+cache in front of `chat:call:<call_id>` keys in Redis (whenever REDIS_URL is
+set) that every instance can read, so offers, answers and ICE candidates are
+relayed without a query. Participants never change, so a local copy that
+lags an end on another instance at worst relays a stray signal.
+
+Lifecycle transitions (invite, accept, reject/busy/hangup) always go to the
+shared copy, so one for a call that already ended elsewhere is refused. They
+are still stored in `call_session`, by CallRecorder in the background.
+"""
+import asyncio
+import json
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import update
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal, upsert
+from app.models.call import CallSession
+from app.ws.brokers import broker_backend
+
+RINGING = "ringing"
+ACTIVE = "active"
+# Events that end a call -> the status it ends with
+END_STATUSES = {"call.reject": "rejected", "call.busy": "busy", "call.hangup": "ended"}
+
+
+@dataclass(frozen=True)
+class CallState:
+    call_id: str
+    caller_id: int
+    callee_id: int
+    room_id: Optional[int] = None
+    status: str = RINGING
+
+    def peer_of(self, user_id: int) -> Optional[int]:
+        """The other participant, or None if `user_id` is not in the call."""
+        if user_id == self.caller_id:
+            return self.callee_id
+        if user_id == self.callee_id:
+            return self.caller_id
+        return None
+
+
+class CallStateStore:
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[int] = None, redis=None):
+        self.ttl = ttl if ttl is not None else settings.CALL_STATE_TTL_SECONDS
+        self.local = TTLCache(max_size if max_size is not None else settings.CALL_STATE_CACHE_SIZE, self.ttl)
+        self.redis = redis
+
+    @staticmethod
+    def _key(call_id: str) -> str:
+        return f"chat:call:{call_id}"
+
+    async def create(self, call: CallState) -> bool:
+        """Register a new call; False if the id is already in use."""
+        if self.redis is not None:
+            if not await self.redis.set(self._key(call.call_id), json.dumps(asdict(call)), nx=True, ex=self.ttl):
+                return False
+        elif self.local.get(call.call_id) is not None:
+            return False
+        self.local.set(call.call_id, call)
+        return True
+
+    async def get(self, call_id: str) -> Optional[CallState]:
+        call = self.local.get(call_id)
+        if call is None and self.redis is not None:
+            raw = await self.redis.get(self._key(call_id))
+            if raw is not None:
+                call = CallState(**json.loads(raw))
+                self.local.set(call_id, call)
+        return call
+
+    async def set_status(self, call: CallState, status: str) -> Optional[CallState]:
+        """
+        Move the call to `status`; ended calls are dropped from the store.
+        None if the call is gone (ended, possibly on another instance, or expired).
+        """
+        call = replace(call, status=status)
+        ended = status in END_STATUSES.values()
+        if self.redis is not None:
+            if ended:
+                found = await self.redis.delete(self._key(call.call_id))
+            else:
+                found = await self.redis.set(self._key(call.call_id), json.dumps(asdict(call)), xx=True, ex=self.ttl)
+            if not found:
+                self.local.pop(call.call_id)
+                return None
+        elif self.local.get(call.call_id) is None:
+            return None
+        if ended:
+            self.local.pop(call.call_id)
+        else:
+            self.local.set(call.call_id, call)
+        return call
+
+
+class CallRecorder:
+    """
+    Write-behind `call_session` persistence. Transitions queued within
+    CALL_RECORD_FLUSH_INTERVAL_MS are applied in order in one transaction,
+    and each flush waits for the previous one, so an accept never runs
+    before the invite's INSERT has committed.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal, flush_interval_ms: Optional[int] = None):
+        self.session_factory = session_factory
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None else settings.CALL_RECORD_FLUSH_INTERVAL_MS) / 1000
+        self.pending: List[Tuple[CallState, datetime]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set[asyncio.Task] = set()
+        self._last: Optional[asyncio.Task] = None
+
+    def record(self, call: CallState) -> None:
+        self.pending.append((call, datetime.utcnow()))
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self._write(batch, self._last))
+        self._last = task
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch: List[Tuple[CallState, datetime]], previous: Optional[asyncio.Task] = None) -> None:
+        if previous is not None:
+            await asyncio.wait((previous,))
+        try:
+            async with self.session_factory() as db:
+                for call, at in batch:
+                    if call.status == RINGING:
+                        # A reused id keeps its original row
+                        await db.execute(
+                            upsert(db, CallSession).values(
+                                call_id=call.call_id,
+                                room_id=call.room_id,
+                                caller_id=call.caller_id,
+                                callee_id=call.callee_id,
+                                status=call.status,
+                            ).on_conflict_do_nothing(index_elements=["call_id"])
+                        )
+                        continue
+                    # Only ringing calls are accepted, and an ended call stays ended
+                    if call.status == ACTIVE:
+                        values, guard = {"started_at": at}, CallSession.status == RINGING
+                    else:
+                        values, guard = {"ended_at": at}, CallSession.status.not_in(END_STATUSES.values())
+                    await db.execute(
+                        update(CallSession)
+                        .where(CallSession.call_id == call.call_id, guard)
+                        .values(status=call.status, **values)
+                    )
+                await db.commit()
+        except Exception as e:
+            # Signaling already went through; only the call history is missing
+            print(f"Call session write failed: {e}")
+            metrics.inc("call_record_failures_total", len(batch))
+            return
+        metrics.inc("call_transitions_persisted_total", len(batch))
+
+    async def close(self) -> None:
+        """Flush whatever is still queued (on shutdown)."""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+def create_call_states() -> CallStateStore:
+    backend = settings.CALL_STATE_BACKEND
+    if not backend:
+        # Callers and callees may be connected to different instances
+        backend = "redis" if settings.REDIS_URL else "memory"
+    if backend == "memory":
+        broker = broker_backend()
+        # Without Redis only ipc (workers on one host) spans processes
+        if broker == "ipc" or (broker != "memory" and settings.REDIS_URL):
+            # Calls set up in one worker would be unknown to the others
+            raise ValueError(
+                f"CALL_STATE_BACKEND=memory is per process, but the {broker!r} broker "
+                "runs several; use CALL_STATE_BACKEND=redis"
+            )
+        return CallStateStore()
+    if backend == "redis":
+        if not settings.REDIS_URL:
+            raise ValueError("CALL_STATE_BACKEND=redis requires REDIS_URL")
+        from redis.asyncio import Redis
+        return CallStateStore(redis=Redis.from_url(settings.REDIS_URL, decode_responses=True))
+    raise ValueError(f"Unknown CALL_STATE_BACKEND: {backend!r}")
+
+
+call_states = create_call_states()
+call_recorder = CallRecorder()
@@ -1,8 +1,8 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, or_
+from sqlalchemy import select, and_
 
 from app.models.chat import ChatRoomMember
-from app.models.message import Message
+from app.services.conversations import get_conversation_id
 
 
 async def can_initiate_call(
@@ -25,15 +25,5 @@ async def can_initiate_call(
         member_ids = {row[0] for row in result.all()}
         return caller_id in member_ids and callee_id in member_ids
 
-    stmt = (
-        select(Message.id)
-        .where(
-            or_(
-                and_(Message.sender_id == caller_id, Message.receiver_id == callee_id),
-                and_(Message.sender_id == callee_id, Message.receiver_id == caller_id),
-            )
-        )
-        .limit(1)
-    )
-    result = await db.execute(stmt)
-    return result.scalar_one_or_none() is not None
+    # A prior DM is a conversation row for the pair
+    return await get_conversation_id(db, caller_id, callee_id) is not None
@@ -0,0 +1,165 @@
+"""
+Change log behind GET /chat/sync.
+
+Every mutation a client would otherwise only learn about over the WebSocket
+(new, edited and deleted messages, read receipts, room creation) appends a
+`change_log` row in the same transaction as the change itself. A client
+that was away asks for everything after the last sequence number it saw.
+
+On SQLite writers are serialized, so ids commit in order and the cursor is
+the last id seen. On Postgres overlapping transactions can commit out of id
+order, so each row also records the id of the transaction that wrote it
+and sync only returns rows of transactions older than the oldest one still
+in flight (the snapshot xmin). The cursor is then "<txid>.<id>", and a row
+whose transaction is still running is picked up by a later sync instead of
+being stepped over.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.change import ChangeLog
+from app.models.chat import ChatRoomMember
+from app.models.conversation import Conversation
+from app.models.message import Message
+from app.services.previews import previews
+
+MESSAGE_NEW = "message.receive"
+MESSAGE_UPDATE = "message.update"
+MESSAGE_DELETE = "message.delete"
+READ_RECEIPT = "message.read_receipt"
+ROOM_CREATED = "room.created"
+
+# Upper bound for the entries covered by one sync response
+MAX_SYNC_LIMIT = 1000
+
+
+def change(
+    event: str,
+    message_id: Optional[int] = None,
+    conversation_id: Optional[int] = None,
+    room_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    data: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """A change_log row; set exactly one of conversation_id, room_id, user_id."""
+    return {
+        "event": event,
+        "message_id": message_id,
+        "conversation_id": conversation_id,
+        "room_id": room_id,
+        "user_id": user_id,
+        "data": json.dumps(data) if data is not None else None,
+    }
+
+
+def message_change(
+    event: str,
+    message_id: int,
+    conversation_id: Optional[int],
+    room_id: Optional[int],
+    data: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """A change to a message, visible to its conversation or room."""
+    if conversation_id is not None:
+        return change(event, message_id, conversation_id=conversation_id, data=data)
+    return change(event, message_id, room_id=room_id, data=data)
+
+
+async def record_changes(db: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+    """Append rows built with `change` (one multi-row INSERT)."""
+    if not rows:
+        return
+    stmt = insert(ChangeLog)
+    if _ordered_by_txid(db):
+        stmt = stmt.values(txid=func.txid_current())
+    await db.execute(stmt, rows)
+
+
+def _ordered_by_txid(db: AsyncSession) -> bool:
+    return db.bind.dialect.name == "postgresql"
+
+
+def _parse_cursor(since: str) -> Tuple[int, int]:
+    """(txid, id) of a cursor; plain ids (SQLite, or issued before txids) sort first."""
+    if "." in since:
+        txid, position = since.split(".", 1)
+        return int(txid), int(position)
+    return 0, int(since)
+
+
+async def changes_since(db: AsyncSession, user_id: int, since: Optional[str], limit: int) -> Dict[str, Any]:
+    """
+    Collapse the user's changes after `since` into current message state,
+    deleted ids, receipts and created rooms. Without `since` only the
+    current cursor is returned. Raises ValueError for a malformed cursor.
+    """
+    empty: Dict[str, Any] = {"has_more": False, "messages": [], "deleted_ids": [], "receipts": [], "rooms": []}
+    by_txid = _ordered_by_txid(db)
+    horizon = None
+    if by_txid:
+        # Transactions below this have all committed or rolled back
+        horizon = await db.scalar(select(func.txid_snapshot_xmin(func.txid_current_snapshot())))
+    if since is None:
+        if by_txid:
+            return {"cursor": f"{horizon}.0", **empty}
+        head = await db.scalar(select(func.max(ChangeLog.id)))
+        return {"cursor": str(head or 0), **empty}
+
+    txid, position = _parse_cursor(since)
+    limit = max(1, min(limit, MAX_SYNC_LIMIT))
+    conversations = select(Conversation.id).where(
+        or_(Conversation.low_id == user_id, Conversation.high_id == user_id)
+    )
+    rooms = select(ChatRoomMember.chatroom_id).where(ChatRoomMember.user_id == user_id)
+    stmt = select(ChangeLog).where(
+        or_(
+            ChangeLog.conversation_id.in_(conversations),
+            ChangeLog.room_id.in_(rooms),
+            ChangeLog.user_id == user_id,
+        ),
+    )
+    if by_txid:
+        stmt = stmt.where(
+            tuple_(ChangeLog.txid, ChangeLog.id) > tuple_(txid, position),
+            ChangeLog.txid < horizon,
+        ).order_by(ChangeLog.txid, ChangeLog.id)
+    else:
+        stmt = stmt.where(ChangeLog.id > position).order_by(ChangeLog.id)
+    entries = (await db.execute(stmt.limit(limit + 1))).scalars().all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    if not entries:
+        return {"cursor": since, **empty}
+
+    changed: Dict[int, None] = {}
+    deleted = set()
+    receipts, created_rooms = [], []
+    for entry in entries:
+        if entry.event in (MESSAGE_NEW, MESSAGE_UPDATE):
+            changed[entry.message_id] = None
+        elif entry.event == MESSAGE_DELETE:
+            deleted.add(entry.message_id)
+        elif entry.event == READ_RECEIPT:
+            receipts.append(json.loads(entry.data))
+        elif entry.event == ROOM_CREATED:
+            created_rooms.append(json.loads(entry.data))
+
+    # Current state of every message created or edited in the window
+    message_ids = [message_id for message_id in changed if message_id not in deleted]
+    messages = []
+    if message_ids:
+        result = await db.execute(select(Message).where(Message.id.in_(message_ids)).order_by(Message.id))
+        messages = result.scalars().all()
+        await previews.attach(db, messages)
+
+    return {
+        "cursor": f"{entries[-1].txid}.{entries[-1].id}" if by_txid else str(entries[-1].id),
+        "has_more": has_more,
+        "messages": messages,
+        "deleted_ids": sorted(deleted),
+        "receipts": receipts,
+        "rooms": created_rooms,
+    }
@@ -0,0 +1,115 @@
+"""
+Direct-message conversations: one `conversation` row per user pair.
+
+`MessageWriter` calls `ensure_conversations` for each batch (creating rows
+for first DMs) and `touch` once the batch's messages have ids (rooms carry
+the same last-message pointer); deleting a message calls `retreat`. Committed
+pair -> id lookups are cached in process because a pair's row never changes.
+"""
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import bindparam, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.cache import TTLCache
+from app.db.session import upsert
+from app.models.conversation import Conversation
+from app.models.message import Message
+
+Pair = Tuple[int, int]
+
+_ids = TTLCache(max_size=100_000, ttl=3600)
+
+
+def pair(user_id: int, peer_id: int) -> Pair:
+    """The normalized (low_id, high_id) key of a DM pair."""
+    return (user_id, peer_id) if user_id < peer_id else (peer_id, user_id)
+
+
+async def get_conversation_id(db: AsyncSession, user_id: int, peer_id: int) -> Optional[int]:
+    key = pair(user_id, peer_id)
+    conversation_id = _ids.get(key)
+    if conversation_id is None:
+        conversation_id = await db.scalar(
+            select(Conversation.id).where(Conversation.low_id == key[0], Conversation.high_id == key[1])
+        )
+        if conversation_id is not None:
+            _ids.set(key, conversation_id)
+    return conversation_id
+
+
+async def ensure_conversations(db: AsyncSession, pairs: Iterable[Pair]) -> Dict[Pair, int]:
+    """
+    Return conversation ids for the pairs, creating missing rows. Pass the
+    result to `remember` once the transaction has committed.
+    """
+    ids: Dict[Pair, int] = {}
+    missing = set()
+    for key in pairs:
+        conversation_id = _ids.get(key)
+        if conversation_id is None:
+            missing.add(key)
+        else:
+            ids[key] = conversation_id
+    if not missing:
+        return ids
+
+    await db.execute(
+        upsert(db, Conversation)
+        .values([{"low_id": low, "high_id": high} for low, high in missing])
+        .on_conflict_do_nothing(index_elements=["low_id", "high_id"])
+    )
+    result = await db.execute(
+        select(Conversation.low_id, Conversation.high_id, Conversation.id)
+        .where(tuple_(Conversation.low_id, Conversation.high_id).in_(missing))
+    )
+    for low, high, conversation_id in result.all():
+        ids[(low, high)] = conversation_id
+    return ids
+
+
+def remember(ids: Dict[Pair, int]) -> None:
+    for key, conversation_id in ids.items():
+        _ids.set(key, conversation_id)
+
+
+async def touch(db: AsyncSession, model, latest: Dict[int, Tuple[int, datetime]]) -> None:
+    """
+    Advance last_message_id/last_activity of `model` rows (Conversation or
+    ChatRoom) to the newest message each one just received.
+    """
+    if not latest:
+        return
+    table = model.__table__
+    await db.execute(
+        table.update()
+        .where(
+            table.c.id == bindparam("target_id"),
+            or_(table.c.last_message_id.is_(None), table.c.last_message_id < bindparam("message_id")),
+        )
+        .values(last_message_id=bindparam("message_id"), last_activity=bindparam("activity")),
+        [
+            {"target_id": target_id, "message_id": message_id, "activity": activity}
+            for target_id, (message_id, activity) in latest.items()
+        ],
+    )
+
+
+async def retreat(db: AsyncSession, model, target_id: int, deleted_id: int) -> None:
+    """
+    Point a Conversation or ChatRoom whose last message was `deleted_id` at
+    the newest one left. Call in the transaction that deletes it.
+    """
+    column = Message.conversation_id if model is Conversation else Message.room_id
+    newest = (await db.execute(
+        select(Message.id, Message.timestamp)
+        .where(column == target_id, Message.id != deleted_id)
+        .order_by(Message.id.desc())
+        .limit(1)
+    )).first()
+    # Without messages left the conversation keeps its last activity
+    values = {"last_message_id": newest.id, "last_activity": newest.timestamp} if newest else {"last_message_id": None}
+    await db.execute(
+        update(model).where(model.id == target_id, model.last_message_id == deleted_id).values(**values)
+    )
@@ -0,0 +1,60 @@
+"""
+NDJSON export of message history behind GET /chat/export.
+
+An export streams one JSON message per line in id order from a server-side
+cursor (`yield_per`), so memory stays flat however long the history is. A
+client that loses the connection resumes with `after_id` set to the last id
+it received.
+
+Exports run on their own session, take one of EXPORT_MAX_CONCURRENT slots
+per process and pause EXPORT_BATCH_PAUSE_MS between batches of
+EXPORT_BATCH_SIZE rows, so bulk jobs leave database time for live traffic.
+"""
+import asyncio
+from typing import AsyncIterator
+
+from sqlalchemy import or_, select
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models.chat import ChatRoomMember
+from app.models.message import Message
+from app.schemas.message import Message as MessageSchema
+
+_slots = asyncio.Semaphore(settings.EXPORT_MAX_CONCURRENT)
+
+
+def user_scope(user_id: int):
+    """Every message the user sent, received or can see in a room."""
+    rooms = select(ChatRoomMember.chatroom_id).where(ChatRoomMember.user_id == user_id)
+    return or_(Message.sender_id == user_id, Message.receiver_id == user_id, Message.room_id.in_(rooms))
+
+
+def exports_busy() -> bool:
+    """True when every export slot is taken (the endpoint answers 429)."""
+    return _slots.locked()
+
+
+async def export_messages(scope, after_id: int = 0) -> AsyncIterator[str]:
+    """NDJSON lines for the messages matching `scope` with id > `after_id`."""
+    columns = Message.__table__.c
+    stmt = (
+        select(columns.id, columns.content, columns.sender_id, columns.receiver_id, columns.room_id,
+               columns.message_type, columns.timestamp, columns.is_read)
+        .where(scope, Message.id > after_id)
+        .order_by(Message.id)
+        .execution_options(yield_per=settings.EXPORT_BATCH_SIZE)
+    )
+    pause = settings.EXPORT_BATCH_PAUSE_MS / 1000
+    # The slot is held for the whole stream; a request that raced past
+    # `exports_busy` waits for one here
+    async with _slots, AsyncSessionLocal() as db:
+        result = await db.stream(stmt)
+        async for rows in result.partitions():
+            yield "".join(
+                MessageSchema.model_validate(row._mapping).model_dump_json() + "\n" for row in rows
+            )
+            metrics.inc("export_messages_total", len(rows))
+            if pause:
+                await asyncio.sleep(pause)
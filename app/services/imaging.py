@@ -0,0 +1,95 @@
+"""
+Image work for upload previews, run in worker processes.
+
+Kept free of app imports so spawned workers load only Pillow and this file.
+"""
+import math
+import os
+from typing import List, Optional, Tuple
+
+_BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+# Blurhash components (horizontal, vertical) and the size it is computed at
+BLURHASH_COMPONENTS = (4, 3)
+BLURHASH_SAMPLE_SIDE = 32
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(_BASE83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def _to_linear(value: int) -> float:
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _to_srgb(value: float) -> int:
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value: float, exponent: float) -> float:
+    return math.copysign(abs(value) ** exponent, value)
+
+
+def blurhash(width: int, height: int, pixels: List[Tuple[int, int, int]]) -> str:
+    """Encode RGB pixels (row-major) as a blurhash (https://blurha.sh) string."""
+    x_components, y_components = BLURHASH_COMPONENTS
+    linear = [(_to_linear(r), _to_linear(g), _to_linear(b)) for r, g, b in pixels]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(x_components)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(y_components)]
+
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                for x in range(width):
+                    basis = cos_x[i][x] * cos_y[j][y]
+                    pr, pg, pb = linear[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = (1 if i == 0 and j == 0 else 2) / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    actual_max = max(abs(c) for factor in ac for c in factor)
+    quantised_max = max(0, min(82, int(math.floor(actual_max * 166 - 0.5))))
+    max_value = (quantised_max + 1) / 166
+    result += _base83(quantised_max, 1)
+    result += _base83((_to_srgb(dc[0]) << 16) + (_to_srgb(dc[1]) << 8) + _to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(math.floor(_sign_pow(c / max_value, 0.5) * 9 + 9.5)))) for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def derive_preview(source: str, thumbnail: str, max_side: int) -> Optional[Tuple[int, int, str]]:
+    """
+    Write a WebP thumbnail of `source` (longest side `max_side`) to
+    `thumbnail` and return (width, height, blurhash), or None if `source`
+    is not an image Pillow can read.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(source) as opened:
+            image = ImageOps.exif_transpose(opened)
+            width, height = image.size
+            image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+            thumb = image.copy()
+            thumb.thumbnail((max_side, max_side))
+            partial = thumbnail + ".part"
+            thumb.save(partial, "WEBP", quality=80)
+            os.replace(partial, thumbnail)
+
+            sample = image.convert("RGB")
+            sample.thumbnail((BLURHASH_SAMPLE_SIDE, BLURHASH_SAMPLE_SIDE))
+            return width, height, blurhash(sample.width, sample.height, list(sample.getdata()))
+    except (OSError, Image.DecompressionBombError):
+        return None
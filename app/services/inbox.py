@@ -0,0 +1,120 @@
+"""
+The conversation list (DMs and rooms) behind GET /chat/inbox.
+
+Both kinds carry a denormalized last_message_id/last_activity, so a page is
+one UNION ordered by (last_activity, kind, id), one lookup of the page's last
+messages and one unread-count read, however many conversations the user has.
+"""
+import base64
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, case, literal, or_, select, tuple_, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.chat import ChatRoom, ChatRoomMember
+from app.models.conversation import Conversation
+from app.models.message import Message
+from app.models.user import User
+from app.services.pagination import MAX_PAGE_SIZE
+from app.services.previews import previews
+from app.services.unread import query_unread_counts, unread_counters
+
+# Position of a conversation in the inbox: (last_activity, kind, id)
+Position = Tuple[datetime, str, int]
+
+
+def encode_inbox_cursor(position: Position) -> str:
+    last_activity, kind, target_id = position
+    raw = f"{last_activity.isoformat()}|{kind}|{target_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_inbox_cursor(cursor: str) -> Position:
+    """Inverse of `encode_inbox_cursor`; raises ValueError for malformed input."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        last_activity, kind, target_id = raw.rsplit("|", 2)
+        if kind not in ("user", "room"):
+            raise ValueError(kind)
+        return datetime.fromisoformat(last_activity), kind, int(target_id)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _inbox_rows(user_id: int):
+    peer_id = case((Conversation.low_id == user_id, Conversation.high_id), else_=Conversation.low_id)
+    dms = (
+        select(
+            literal("user").label("kind"),
+            peer_id.label("target_id"),
+            User.full_name.label("name"),
+            Conversation.last_message_id.label("last_message_id"),
+            Conversation.last_activity.label("last_activity"),
+        )
+        .join(User, User.id == peer_id)
+        .where(or_(Conversation.low_id == user_id, Conversation.high_id == user_id))
+    )
+    rooms = (
+        select(
+            literal("room").label("kind"),
+            ChatRoom.id.label("target_id"),
+            ChatRoom.name.label("name"),
+            ChatRoom.last_message_id.label("last_message_id"),
+            ChatRoom.last_activity.label("last_activity"),
+        )
+        .join(ChatRoomMember, and_(ChatRoomMember.chatroom_id == ChatRoom.id, ChatRoomMember.user_id == user_id))
+    )
+    return union_all(dms, rooms).subquery("inbox")
+
+
+async def inbox_page(
+    db: AsyncSession,
+    user_id: int,
+    limit: int,
+    cursor: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    One page of the user's conversations, most recently active first, and
+    the cursor of the next page (None on the last one).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    inbox = _inbox_rows(user_id)
+    stmt = select(inbox).order_by(
+        inbox.c.last_activity.desc(), inbox.c.kind.desc(), inbox.c.target_id.desc()
+    ).limit(limit)
+    if cursor is not None:
+        stmt = stmt.where(
+            tuple_(inbox.c.last_activity, inbox.c.kind, inbox.c.target_id) < tuple_(*decode_inbox_cursor(cursor))
+        )
+    rows = (await db.execute(stmt)).all()
+
+    message_ids = [row.last_message_id for row in rows if row.last_message_id is not None]
+    messages = {}
+    if message_ids:
+        result = await db.execute(select(Message).where(Message.id.in_(message_ids)))
+        messages = {m.id: m for m in result.scalars().all()}
+        await previews.attach(db, messages.values())
+
+    if unread_counters is not None:
+        unread = await unread_counters.get(db, user_id)
+    else:
+        unread = await query_unread_counts(db, user_id)
+
+    items = [
+        {
+            "kind": row.kind,
+            "id": row.target_id,
+            "name": row.name,
+            "last_activity": row.last_activity,
+            "last_message": messages.get(row.last_message_id),
+            "unread": unread["users" if row.kind == "user" else "rooms"].get(str(row.target_id), 0),
+        }
+        for row in rows
+    ]
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_inbox_cursor((last.last_activity, last.kind, last.target_id))
+    return items, next_cursor
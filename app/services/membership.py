@@ -0,0 +1,162 @@
+"""
+Room id -> member ids, cached for message fan-out.
+
+Lookups hit an in-process LRU first, then (with ROOM_MEMBERS_CACHE_BACKEND=redis)
+a Redis set shared by all instances, and only then `chatroom_member`.
+Whoever changes a room's membership calls `room_members.changed(...)`, which
+drops the shared copy and publishes a `room.members_changed` control event so
+every instance evicts its local entry. It also bumps the room's version key
+in Redis; a load only writes the shared set (under WATCH) if the version is
+still the one it saw before querying, so a load that raced a change cannot
+put the old members back.
+"""
+import asyncio
+from typing import Dict, Iterable, Optional, Tuple
+
+from redis.exceptions import WatchError
+from sqlalchemy import select
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models.chat import ChatRoomMember
+from app.schemas.ws_events import WSEvent
+from app.ws.envelope import ROOM_MEMBERS_CHANGED, Route
+from app.ws.manager import manager
+
+# Room version keys outlive any load that could race them
+VERSION_TTL_SECONDS = 24 * 3600
+
+
+class RoomMembershipCache:
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = None,
+        redis=None,
+        bus=manager,
+    ):
+        self.session_factory = session_factory
+        self.local = TTLCache(
+            max_size if max_size is not None else settings.ROOM_MEMBERS_CACHE_SIZE,
+            ttl if ttl is not None else settings.ROOM_MEMBERS_CACHE_TTL_SECONDS,
+        )
+        self.redis = redis
+        self.bus = bus
+        # Concurrent misses for one room share a single load
+        self._loading: Dict[int, asyncio.Future] = {}
+        # Bumped on every eviction; a load that raced one is not cached
+        self._epoch = 0
+        bus.add_listener(ROOM_MEMBERS_CHANGED, self._on_changed)
+        bus.add_listener("room.created", self._on_changed)
+
+    @staticmethod
+    def _key(room_id: int) -> str:
+        return f"chat:room_members:{room_id}"
+
+    @staticmethod
+    def _version_key(room_id: int) -> str:
+        return f"chat:room_members:{room_id}:version"
+
+    async def get(self, room_id: int) -> Tuple[int, ...]:
+        """Member ids of the room; empty if it has none or does not exist."""
+        members = self.local.get(room_id)
+        if members is not None:
+            metrics.inc("room_members_cache_hits_total")
+            return members
+        metrics.inc("room_members_cache_misses_total")
+
+        pending = self._loading.get(room_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[room_id] = future
+        epoch = self._epoch
+        try:
+            members = await self._load(room_id)
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception retrieved in case no one else was waiting
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(room_id, None)
+        if members and epoch == self._epoch:
+            self.local.set(room_id, members)
+        future.set_result(members)
+        return members
+
+    async def _load(self, room_id: int) -> Tuple[int, ...]:
+        version = None
+        if self.redis is not None:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.smembers(self._key(room_id))
+                pipe.get(self._version_key(room_id))
+                cached, version = await pipe.execute()
+            if cached:
+                return tuple(sorted(int(uid) for uid in cached))
+
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(ChatRoomMember.user_id).where(ChatRoomMember.chatroom_id == room_id)
+            )
+            members = tuple(sorted(result.scalars().all()))
+
+        if self.redis is not None and members:
+            await self._share(room_id, members, version)
+        return members
+
+    async def _share(self, room_id: int, members: Tuple[int, ...], version: Optional[str]) -> None:
+        """Write the shared set unless the room changed since `version` was read."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self._version_key(room_id))
+                if await pipe.get(self._version_key(room_id)) != version:
+                    metrics.inc("room_members_stale_loads_total")
+                    return
+                pipe.multi()
+                pipe.sadd(self._key(room_id), *members)
+                pipe.expire(self._key(room_id), max(int(self.local.ttl), 1))
+                await pipe.execute()
+            except WatchError:
+                metrics.inc("room_members_stale_loads_total")
+
+    def evict(self, room_id: int) -> None:
+        self._epoch += 1
+        self.local.pop(room_id)
+
+    async def changed(self, room_id: int, added: Iterable[int] = (), removed: Iterable[int] = ()) -> None:
+        """Call after committing a membership change to `room_id`."""
+        self.evict(room_id)
+        if self.redis is not None:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.incr(self._version_key(room_id))
+                pipe.expire(self._version_key(room_id), VERSION_TTL_SECONDS)
+                pipe.delete(self._key(room_id))
+                await pipe.execute()
+        await self.bus.broadcast(WSEvent(
+            event=ROOM_MEMBERS_CHANGED,
+            data={"room_id": room_id, "added": list(added), "removed": list(removed)},
+        ))
+
+    def _on_changed(self, route: Route, payload: str) -> None:
+        if route.room_id:
+            self.evict(route.room_id)
+
+
+def create_room_members() -> RoomMembershipCache:
+    backend = settings.ROOM_MEMBERS_CACHE_BACKEND
+    if not backend:
+        return RoomMembershipCache()
+    if backend == "redis":
+        if not settings.REDIS_URL:
+            raise ValueError("ROOM_MEMBERS_CACHE_BACKEND=redis requires REDIS_URL")
+        from redis.asyncio import Redis
+        return RoomMembershipCache(redis=Redis.from_url(settings.REDIS_URL, decode_responses=True))
+    raise ValueError(f"Unknown ROOM_MEMBERS_CACHE_BACKEND: {backend!r}")
+
+
+room_members = create_room_members()
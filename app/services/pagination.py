@@ -0,0 +1,64 @@
+import base64
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import Select, select, tuple_
+from sqlalchemy.orm import aliased
+
+from app.models.message import Message
+
+# Upper bound for a single history page
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(timestamp: datetime, message_id: int) -> str:
+    """Opaque cursor for the (timestamp, id) position of a message."""
+    raw = f"{timestamp.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of `encode_cursor`; raises ValueError for malformed input."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, _, message_id = raw.rpartition("|")
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def keyset_page(
+    stmt: Select,
+    limit: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[Select, bool]:
+    """
+    Restrict a message query to one page ordered by (timestamp, id).
+
+    Pages go backwards in time (newest first) from `cursor` or `before_id`,
+    or forwards (oldest first) from `after_id`. Returns the statement and
+    whether rows come back in ascending order. Each page is a bounded range
+    scan on the (..., timestamp, id) indexes regardless of depth.
+    """
+    position = tuple_(Message.timestamp, Message.id)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    if after_id is not None:
+        stmt = stmt.where(position > _anchor(after_id))
+        return stmt.order_by(Message.timestamp.asc(), Message.id.asc()).limit(limit), True
+
+    if cursor is not None:
+        stmt = stmt.where(position < tuple_(*decode_cursor(cursor)))
+    elif before_id is not None:
+        stmt = stmt.where(position < _anchor(before_id))
+    return stmt.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit), False
+
+
+def _anchor(message_id: int):
+    """(timestamp, id) of an existing message, resolved inside the same query."""
+    anchor = aliased(Message)
+    timestamp = select(anchor.timestamp).where(anchor.id == message_id).scalar_subquery()
+    return tuple_(timestamp, message_id)
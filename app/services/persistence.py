@@ -0,0 +1,168 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models.chat import ChatRoom
+from app.models.conversation import Conversation
+from app.models.message import Message
+from app.services.changes import MESSAGE_NEW, message_change, record_changes
+from app.services.conversations import ensure_conversations, pair, remember, touch
+from app.services.previews import previews
+from app.services.recent import RecentMessageStore, conversation_key, entry_for, recent_messages
+from app.services.unread import UnreadCounterStore, unread_counters
+from app.services.uploads import add_references, upload_filename
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for `message.send` (group commit).
+
+    Inserts from every connection are collected for up to
+    MESSAGE_FLUSH_INTERVAL_MS or MESSAGE_BATCH_SIZE rows, then written as one
+    multi-row INSERT ... RETURNING in a single transaction. Each caller gets
+    its own row's id back once the batch has committed.
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        flush_interval_ms: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        counters: Optional[UnreadCounterStore] = unread_counters,
+        recent: Optional[RecentMessageStore] = recent_messages,
+    ):
+        self.session_factory = session_factory
+        self.counters = counters
+        self.recent = recent
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None else settings.MESSAGE_FLUSH_INTERVAL_MS) / 1000
+        self.batch_size = batch_size or settings.MESSAGE_BATCH_SIZE
+        self.pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set[asyncio.Task] = set()
+
+    async def save(self, **values: Any) -> int:
+        """Queue one message row and wait for its id."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((values, future))
+        if len(self.pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+        return await future
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self._write(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        started = time.perf_counter()
+        committed = False
+        try:
+            rows = [values for values, _ in batch]
+            async with self.session_factory() as db:
+                # DMs carry their pair's conversation, created with the first one
+                dm_pairs = [
+                    pair(row["sender_id"], row["receiver_id"])
+                    if row.get("receiver_id") and not row.get("room_id") else None
+                    for row in rows
+                ]
+                conversations = await ensure_conversations(db, {p for p in dm_pairs if p})
+                for row, dm_pair in zip(rows, dm_pairs):
+                    row["conversation_id"] = conversations.get(dm_pair)
+
+                result = await db.execute(
+                    insert(Message).returning(Message.id, sort_by_parameter_order=True),
+                    rows,
+                )
+                ids = result.scalars().all()
+
+                # Newest message per conversation/room, for the inbox
+                latest_dm: Dict[int, Tuple[int, datetime]] = {}
+                latest_room: Dict[int, Tuple[int, datetime]] = {}
+                for row, message_id in zip(rows, ids):
+                    newest = (message_id, row.get("timestamp") or datetime.utcnow())
+                    if row["conversation_id"] is not None:
+                        latest_dm[row["conversation_id"]] = newest
+                    elif row.get("room_id"):
+                        latest_room[row["room_id"]] = newest
+                await touch(db, Conversation, latest_dm)
+                await touch(db, ChatRoom, latest_room)
+                await record_changes(db, [
+                    message_change(MESSAGE_NEW, message_id, row["conversation_id"], row.get("room_id"))
+                    for row, message_id in zip(rows, ids)
+                ])
+                await add_references(db, [row["content"] for row in rows])
+                if self.counters is not None:
+                    await self.counters.record_messages(db, rows)
+                await db.commit()
+                committed = True
+            remember(conversations)
+        except Exception as e:
+            if len(batch) > 1 and not committed:
+                # One bad row (e.g. a receiver or room that does not exist) fails
+                # the whole INSERT; retry row by row so only its sender gets the error
+                metrics.inc("message_insert_batch_retries_total")
+                for entry in batch:
+                    await self._write([entry])
+                return
+            metrics.inc("message_insert_failures_total", len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        elapsed = time.perf_counter() - started
+        metrics.inc("messages_persisted_total", len(batch))
+        metrics.inc("message_insert_batches_total")
+        metrics.inc("message_insert_seconds_total", elapsed)
+        metrics.gauge_set("message_insert_last_batch_size", len(batch))
+        metrics.gauge_set("message_insert_rows_per_second", len(batch) / elapsed if elapsed else 0)
+        for (_, future), message_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(message_id)
+        # After the acks, so buffering never delays them
+        await self._write_through(rows, ids)
+
+    async def _write_through(self, rows: List[Dict[str, Any]], ids: List[int]) -> None:
+        """Append the committed messages to the recent-history buffers."""
+        if self.recent is None:
+            return
+        try:
+            # A preview generated after this point is attached when the buffer is read
+            found = {}
+            if any(upload_filename(row["content"]) for row in rows):
+                # Opens a session only for uploads not in the preview cache
+                found = await previews.lookup([row["content"] for row in rows])
+            for row, message_id in zip(rows, ids):
+                key = conversation_key(row["conversation_id"], row.get("room_id"))
+                if key is not None:
+                    preview = found.get(upload_filename(row["content"]))
+                    await self.recent.add(key, entry_for(
+                        {"receiver_id": None, "room_id": None, **row, "id": message_id, "preview": preview}
+                    ))
+        except Exception as e:
+            # The messages are stored; the buffers just refill on a later read
+            print(f"Recent message write-through failed: {e}")
+            metrics.inc("recent_messages_errors_total")
+
+    async def close(self) -> None:
+        """Flush whatever is still queued (on shutdown)."""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+message_writer = MessageWriter()
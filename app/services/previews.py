@@ -0,0 +1,225 @@
+"""
+Thumbnails and blurhash placeholders for uploaded images.
+
+After an image is stored, PreviewPipeline decodes it in a process pool
+(decoding and resizing are CPU-bound and would stall the event loop, and
+threads would serialize on the GIL), writes a WebP thumbnail of at most
+PREVIEW_MAX_SIDE pixels next to it as `<sha256>.thumb.webp`, and records the
+dimensions, thumbnail and blurhash on its `upload_object` row. Previews
+belong to the content, so a re-upload of the same bytes reuses them.
+
+Messages linking to an upload carry `preview` ({thumbnail_url, blurhash,
+width, height}) in `message.receive` and the history APIs once it exists;
+until then clients show the full image. Messages buffered for first-page
+history before their preview existed get it when the buffer is read. Lookups
+go through a TTL cache in front of `upload_object`, which also remembers
+links to files it has no row for. Needs Pillow; without it (or with PREVIEW_WORKERS
+set to 0) uploads get no previews.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models.upload import UploadObject
+from app.services.imaging import derive_preview
+from app.services.uploads import UPLOAD_DIR, UPLOAD_URL_PREFIX, upload_filename
+
+try:
+    import PIL  # noqa: F401
+except ImportError:  # pragma: no cover - optional dependency
+    PIL = None
+
+# Cached for uploads that will not get a preview
+_NO_PREVIEW: Dict[str, Any] = {}
+
+
+def thumbnail_name(sha256: str) -> str:
+    return f"{sha256}.thumb.webp"
+
+
+def _preview(thumbnail: str, blurhash: str, width: int, height: int) -> Dict[str, Any]:
+    return {"thumbnail_url": f"{UPLOAD_URL_PREFIX}{thumbnail}", "blurhash": blurhash, "width": width, "height": height}
+
+
+def preview_of(stored: UploadObject) -> Optional[Dict[str, Any]]:
+    """The preview advertised for an upload, if it has one."""
+    if not stored.thumbnail:
+        return None
+    return _preview(stored.thumbnail, stored.blurhash, stored.width, stored.height)
+
+
+def _is_image(content_type: Optional[str]) -> bool:
+    return (content_type or "").startswith("image/")
+
+
+class PreviewPipeline:
+    def __init__(self, workers: Optional[int] = None, session_factory=AsyncSessionLocal):
+        self.workers = workers if workers is not None else settings.PREVIEW_WORKERS
+        self.session_factory = session_factory
+        self.enabled = PIL is not None and self.workers > 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # sha256 -> generation in progress
+        self.pending: Dict[str, asyncio.Task] = {}
+        # stored filename -> preview, or _NO_PREVIEW
+        self.ready = TTLCache(max_size=settings.PREVIEW_CACHE_SIZE, ttl=3600)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Spawned, not forked: a fork would copy the event loop and open sockets
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def generate(self, stored: UploadObject) -> Optional["asyncio.Task[Optional[Dict[str, Any]]]"]:
+        """
+        Start deriving the preview of a stored image, unless it has one or
+        is not an image. The returned task resolves to the preview (or None).
+        """
+        if not self.enabled or stored.thumbnail or not _is_image(stored.content_type):
+            return None
+        task = self.pending.get(stored.sha256)
+        if task is None:
+            task = asyncio.create_task(self._generate(stored.sha256, stored.filename))
+            self.pending[stored.sha256] = task
+            task.add_done_callback(lambda _: self.pending.pop(stored.sha256, None))
+        return task
+
+    async def _generate(self, sha256: str, filename: str) -> Optional[Dict[str, Any]]:
+        thumbnail = thumbnail_name(sha256)
+        loop = asyncio.get_running_loop()
+        try:
+            derived = await loop.run_in_executor(
+                self._pool(),
+                derive_preview,
+                os.path.join(UPLOAD_DIR, filename),
+                os.path.join(UPLOAD_DIR, thumbnail),
+                settings.PREVIEW_MAX_SIDE,
+            )
+            if derived is None:
+                # Labelled as an image but not decodable
+                metrics.inc("upload_previews_skipped_total")
+                self.ready.set(filename, _NO_PREVIEW)
+                return None
+            width, height, blurhash = derived
+            async with self.session_factory() as db:
+                await db.execute(
+                    update(UploadObject)
+                    .where(UploadObject.sha256 == sha256)
+                    .values(width=width, height=height, thumbnail=thumbnail, blurhash=blurhash)
+                )
+                await db.commit()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # A worker died (e.g. killed for memory); start a fresh pool next time
+                self._executor = None
+            print(f"Preview generation failed for {filename}: {e}")
+            metrics.inc("upload_preview_failures_total")
+            return None
+        preview = _preview(thumbnail, blurhash, width, height)
+        self.ready.set(filename, preview)
+        metrics.inc("upload_previews_generated_total")
+        return preview
+
+    async def for_upload(self, stored: UploadObject) -> Optional[Dict[str, Any]]:
+        """
+        Preview of a just-stored upload, generating it if needed and waiting
+        up to PREVIEW_WAIT_MS; None if there is none (yet).
+        """
+        task = self.generate(stored)
+        if task is None:
+            return preview_of(stored)
+        try:
+            # Shielded: a slow generation keeps going after the response
+            return await asyncio.wait_for(asyncio.shield(task), settings.PREVIEW_WAIT_MS / 1000)
+        except asyncio.TimeoutError:
+            metrics.inc("upload_preview_wait_timeouts_total")
+            return None
+
+    async def lookup(self, contents: Iterable[str], db: Optional[AsyncSession] = None) -> Dict[str, Dict[str, Any]]:
+        """Previews of the uploads messages with `contents` link to, by stored filename."""
+        found: Dict[str, Dict[str, Any]] = {}
+        missing = set()
+        for filename in map(upload_filename, contents):
+            if not filename or filename in found:
+                continue
+            preview = self.ready.get(filename)
+            if preview is None:
+                missing.add(filename)
+            elif preview is not _NO_PREVIEW:
+                found[filename] = preview
+        if not missing:
+            return found
+
+        stmt = select(UploadObject).where(UploadObject.filename.in_(missing))
+        if db is not None:
+            rows = (await db.execute(stmt)).scalars().all()
+        else:
+            async with self.session_factory() as session:
+                rows = (await session.execute(stmt)).scalars().all()
+        for filename in missing - {stored.filename for stored in rows}:
+            # Not a tracked upload (older uploads, or a made-up link); it never gets one
+            self.ready.set(filename, _NO_PREVIEW)
+        for stored in rows:
+            preview = preview_of(stored)
+            # An image's preview may still be on its way (here or on another instance)
+            if preview is not None or not _is_image(stored.content_type):
+                self.ready.set(stored.filename, preview or _NO_PREVIEW)
+            if preview is not None:
+                found[stored.filename] = preview
+        return found
+
+    async def attach(self, db: AsyncSession, messages: Iterable[Any]) -> None:
+        """Set `preview` on message rows that link to an upload with one."""
+        messages = [m for m in messages if upload_filename(m.content)]
+        if not messages:
+            return
+        found = await self.lookup([m.content for m in messages], db)
+        for message in messages:
+            message.preview = found.get(upload_filename(message.content))
+
+    async def attach_frames(self, frames: List[str], db: Optional[AsyncSession] = None) -> List[str]:
+        """
+        Serialized messages (as the recent-messages buffer holds them), with
+        `preview` set on those buffered before their upload had one.
+        """
+        waiting: Dict[int, Dict[str, Any]] = {}
+        for index, frame in enumerate(frames):
+            # Only parse frames that can qualify
+            if '"preview":null' not in frame or UPLOAD_URL_PREFIX not in frame:
+                continue
+            data = json.loads(frame)
+            if data.get("preview") is None and upload_filename(data.get("content") or ""):
+                waiting[index] = data
+        if not waiting:
+            return frames
+        found = await self.lookup([data["content"] for data in waiting.values()], db)
+        if not found:
+            return frames
+        frames = list(frames)
+        for index, data in waiting.items():
+            preview = found.get(upload_filename(data["content"]))
+            if preview is not None:
+                frames[index] = json.dumps({**data, "preview": preview}, separators=(",", ":"))
+        return frames
+
+    async def close(self) -> None:
+        """Let running generations finish, then stop the workers (on shutdown)."""
+        if self.pending:
+            await asyncio.gather(*self.pending.values(), return_exceptions=True)
+        if self._executor is not None:
+            await run_in_threadpool(self._executor.shutdown)
+            self._executor = None
+
+
+previews = PreviewPipeline()
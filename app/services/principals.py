@@ -0,0 +1,112 @@
+"""
+Verified access token -> authenticated principal, cached so steady-state
+auth (HTTP dependencies and WebSocket connects) needs no database query.
+
+Each entry remembers the user's auth version when it was cached. Bumping the
+version (`principals.invalidate(user_id)`, e.g. on deactivation) makes every
+cached token of that user miss. With the redis backend (the default when
+REDIS_URL is set) the version lives in `chat:auth_version:<user_id>`, so an
+invalidation on one instance is seen by all of them; with memory it is per
+process.
+"""
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.models.user import User
+
+
+@dataclass(frozen=True)
+class Principal:
+    """The fields of `User` that request handlers need."""
+
+    id: int
+    email: str
+    full_name: Optional[str]
+    is_active: bool
+    is_superuser: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        return cls(
+            id=user.id,
+            email=user.email,
+            full_name=user.full_name,
+            is_active=bool(user.is_active),
+            is_superuser=bool(user.is_superuser),
+        )
+
+
+class PrincipalCache:
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[float] = None, redis=None):
+        # token -> (principal, token expiry, auth version)
+        self.entries = TTLCache(
+            max_size if max_size is not None else settings.PRINCIPAL_CACHE_SIZE,
+            ttl if ttl is not None else settings.PRINCIPAL_CACHE_TTL_SECONDS,
+        )
+        self.redis = redis
+        self.versions: Dict[int, int] = {}
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"chat:auth_version:{user_id}"
+
+    async def _version(self, user_id: int) -> int:
+        if self.redis is not None:
+            return int(await self.redis.get(self._key(user_id)) or 0)
+        return self.versions.get(user_id, 0)
+
+    async def get(self, token: str) -> Optional[Principal]:
+        entry = self.entries.get(token)
+        if entry is None:
+            metrics.inc("principal_cache_misses_total")
+            return None
+        principal, expires_at, version = entry
+        if expires_at <= time.time() or version != await self._version(principal.id):
+            self.entries.pop(token)
+            metrics.inc("principal_cache_misses_total")
+            return None
+        metrics.inc("principal_cache_hits_total")
+        return principal
+
+    async def load(self, db: AsyncSession, token: str, user_id: int, expires_at: float) -> Optional[Principal]:
+        """Read the user and cache its principal for this (already verified) token."""
+        # Read the version first so an invalidation racing the SELECT wins
+        version = await self._version(user_id)
+        user = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
+        if user is None:
+            return None
+        principal = Principal.from_user(user)
+        self.entries.set(token, (principal, expires_at, version))
+        return principal
+
+    async def invalidate(self, user_id: int) -> None:
+        """Drop every cached token of the user (call after changing the user row)."""
+        if self.redis is not None:
+            await self.redis.incr(self._key(user_id))
+        else:
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+
+def create_principal_cache() -> PrincipalCache:
+    backend = settings.PRINCIPAL_CACHE_BACKEND
+    if not backend:
+        # Deactivating a user must reach every instance
+        backend = "redis" if settings.REDIS_URL else "memory"
+    if backend == "memory":
+        return PrincipalCache()
+    if backend == "redis":
+        if not settings.REDIS_URL:
+            raise ValueError("PRINCIPAL_CACHE_BACKEND=redis requires REDIS_URL")
+        from redis.asyncio import Redis
+        return PrincipalCache(redis=Redis.from_url(settings.REDIS_URL, decode_responses=True))
+    raise ValueError(f"Unknown PRINCIPAL_CACHE_BACKEND: {backend!r}")
+
+
+principals = create_principal_cache()
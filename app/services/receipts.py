@@ -0,0 +1,287 @@
+import asyncio
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import or_, select, update
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models.chat import ChatRoomMember
+from app.models.message import Message
+from app.schemas.ws_events import WSEvent
+from app.services.changes import READ_RECEIPT, change, record_changes
+from app.services.recent import RecentMessageStore, conversation_key, recent_messages
+from app.services.unread import UnreadCounterStore, unread_counters
+from app.ws.manager import manager
+
+READ = "read"
+DELIVERED = "delivered"
+
+RECEIPT_EVENTS = {READ: "message.read_receipt", DELIVERED: "message.delivery_receipt"}
+
+# Consecutive failed flushes whose receipts are re-queued before they are dropped
+MAX_FLUSH_RETRIES = 3
+
+
+class ReceiptAggregator:
+    """
+    Coalesces `message.delivered` / `message.read` into set-based UPDATEs.
+
+    Clients may acknowledge single messages (`message_id`) or a watermark,
+    "everything up to `up_to_id`" in a DM (`sender_id`) or room (`room_id`).
+    Everything received within RECEIPT_FLUSH_INTERVAL_MS is written in one
+    transaction, and each (reader, original sender) pair gets a single
+    aggregated receipt event instead of one per message.
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        flush_interval_ms: Optional[int] = None,
+        publish: Optional[Callable[[WSEvent], Awaitable[None]]] = None,
+        counters: Optional[UnreadCounterStore] = unread_counters,
+        recent: Optional[RecentMessageStore] = recent_messages,
+    ):
+        self.session_factory = session_factory
+        self.counters = counters
+        self.recent = recent
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None else settings.RECEIPT_FLUSH_INTERVAL_MS) / 1000
+        self.publish = publish
+        # (kind, reader_id, sender_id) -> acknowledged message ids
+        self.messages: Dict[Tuple[str, int, Optional[int]], Set[int]] = defaultdict(set)
+        # (kind, reader_id, "user" | "room", peer or room id) -> highest acknowledged id
+        self.watermarks: Dict[Tuple[str, int, str, int], int] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set[asyncio.Task] = set()
+        self._failures = 0
+        self._closed = False
+
+    def add(self, kind: str, reader_id: int, message_id: int, sender_id: Optional[int] = None) -> None:
+        self.messages[(kind, reader_id, sender_id)].add(message_id)
+        self._schedule()
+
+    def add_watermark(self, kind: str, reader_id: int, up_to_id: int, peer_id: Optional[int] = None, room_id: Optional[int] = None) -> None:
+        key = (kind, reader_id, "room", room_id) if room_id else (kind, reader_id, "user", peer_id)
+        if key[3] is None:
+            return
+        self.watermarks[key] = max(up_to_id, self.watermarks.get(key, 0))
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._timer = None
+        task = asyncio.create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task) -> None:
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # Stored already (a failed transaction is re-queued in `flush`)
+            print(f"Receipt delivery failed: {task.exception()}")
+            metrics.inc("receipt_delivery_failures_total")
+
+    def _requeue(self, messages, watermarks) -> None:
+        """Put a batch whose transaction failed back in front of newer receipts."""
+        self._failures += 1
+        count = sum(len(ids) for ids in messages.values()) + len(watermarks)
+        if self._closed or self._failures > MAX_FLUSH_RETRIES:
+            metrics.inc("receipts_dropped_total", count)
+            return
+        for key, ids in messages.items():
+            self.messages[key] |= ids
+        for key, up_to_id in watermarks.items():
+            self.watermarks[key] = max(up_to_id, self.watermarks.get(key, 0))
+        self._schedule()
+
+    async def flush(self) -> None:
+        messages, self.messages = self.messages, defaultdict(set)
+        watermarks, self.watermarks = self.watermarks, {}
+        if not messages and not watermarks:
+            return
+        try:
+            events, read_rows = await self._write(messages, watermarks)
+        except Exception as e:
+            print(f"Receipt flush failed: {e}")
+            metrics.inc("receipt_flush_failures_total")
+            self._requeue(messages, watermarks)
+            return
+        self._failures = 0
+        try:
+            await self._patch_recent(read_rows)
+        except Exception as e:
+            # The receipts are stored; the buffers just refill on a later read
+            print(f"Recent message receipt patch failed: {e}")
+            metrics.inc("recent_messages_errors_total")
+
+        metrics.inc("receipt_flushes_total")
+        metrics.inc("receipts_coalesced_total", sum(len(ids) for ids in messages.values()) + len(watermarks))
+        publish = self.publish or manager.broadcast
+        for event in events:
+            await publish(event)
+
+    async def _write(self, messages, watermarks) -> Tuple[List[WSEvent], list]:
+        """Apply a batch in one transaction; returns its receipt events and the rows marked read."""
+        # One UPDATE per (kind, reader) for individually acknowledged messages
+        by_reader: Dict[Tuple[str, int], Set[int]] = defaultdict(set)
+        for (kind, reader_id, _), ids in messages.items():
+            by_reader[(kind, reader_id)] |= ids
+
+        read_rows = []
+        async with self.session_factory() as db:
+            # Room watermarks only count for members, up to a message of that room
+            read_at: Dict[Tuple[str, int, str, int], datetime] = {}
+            for key, up_to_id in list(watermarks.items()):
+                kind, reader_id, scope, target_id = key
+                if scope != "room":
+                    continue
+                timestamp = (await db.execute(
+                    select(Message.timestamp)
+                    .join(ChatRoomMember, ChatRoomMember.chatroom_id == Message.room_id)
+                    .where(Message.id == up_to_id, Message.room_id == target_id, ChatRoomMember.user_id == reader_id)
+                )).scalar_one_or_none()
+                if timestamp is None:
+                    metrics.inc("receipts_rejected_total")
+                    del watermarks[key]
+                else:
+                    read_at[key] = timestamp
+
+            # Receipts go to the senders of the rows actually changed, not to whoever the client named
+            acked: Dict[Tuple[str, int, int], List[int]] = defaultdict(list)
+            for (kind, reader_id), ids in by_reader.items():
+                rows = await self._update(
+                    db, kind,
+                    Message.id.in_(ids),
+                    or_(
+                        Message.receiver_id == reader_id,
+                        # Room messages only for rooms the reader belongs to
+                        Message.room_id.in_(select(ChatRoomMember.chatroom_id).where(ChatRoomMember.user_id == reader_id)),
+                    ),
+                )
+                for row in rows:
+                    acked[(kind, reader_id, row.sender_id)].append(row.id)
+                if kind != READ:
+                    continue
+                if self.counters is not None:
+                    # Lower the DM counters by exactly what was marked read per sender
+                    senders = Counter(row.sender_id for row in rows if row.room_id is None)
+                    for sender_id, count in senders.items():
+                        await self.counters.dm_read(db, reader_id, sender_id, count)
+                read_rows += rows
+            for (kind, reader_id, scope, target_id), up_to_id in list(watermarks.items()):
+                if scope == "user":
+                    rows = await self._update(
+                        db, kind,
+                        Message.receiver_id == reader_id,
+                        Message.sender_id == target_id,
+                        Message.id <= up_to_id,
+                    )
+                    if not rows:
+                        # Nothing from that sender was left to acknowledge
+                        del watermarks[(kind, reader_id, scope, target_id)]
+                        continue
+                    if kind != READ:
+                        continue
+                    if self.counters is not None:
+                        await self.counters.dm_read(db, reader_id, target_id, len(rows))
+                    read_rows += rows
+                elif kind == READ:
+                    timestamp = read_at[(kind, reader_id, scope, target_id)]
+                    await db.execute(
+                        update(ChatRoomMember)
+                        .where(
+                            ChatRoomMember.chatroom_id == target_id,
+                            ChatRoomMember.user_id == reader_id,
+                            or_(ChatRoomMember.last_read_at.is_(None), ChatRoomMember.last_read_at < timestamp),
+                        )
+                        .values(last_read_at=timestamp)
+                    )
+                    if self.counters is not None:
+                        await self.counters.room_read(db, reader_id, target_id)
+            events = self._receipts(acked, watermarks)
+            await record_changes(db, self._changes(events))
+            await db.commit()
+        return events, read_rows
+
+    def _receipts(self, acked, watermarks) -> List[WSEvent]:
+        timestamp = datetime.utcnow().isoformat()
+        events = []
+        for (kind, reader_id, sender_id), ids in acked.items():
+            message_ids = sorted(ids)
+            events.append(WSEvent(
+                event=RECEIPT_EVENTS[kind],
+                data={
+                    "message_id": message_ids[-1],
+                    "message_ids": message_ids,
+                    "reader_id": reader_id,
+                    "receiver_id": sender_id,  # Targeted to original sender
+                    "timestamp": timestamp,
+                },
+            ))
+        for (kind, reader_id, scope, target_id), up_to_id in watermarks.items():
+            data = {"message_id": up_to_id, "up_to_id": up_to_id, "reader_id": reader_id, "timestamp": timestamp}
+            if scope == "user":
+                data["receiver_id"] = target_id
+            else:
+                data["room_id"] = target_id
+            events.append(WSEvent(event=RECEIPT_EVENTS[kind], data=data))
+        return events
+
+    @staticmethod
+    def _changes(events: List[WSEvent]) -> List[dict]:
+        """change_log rows for read receipts: the room, or both users of a DM."""
+        rows = []
+        for event in events:
+            if event.event != READ_RECEIPT:
+                continue
+            if event.data.get("room_id"):
+                rows.append(change(READ_RECEIPT, room_id=event.data["room_id"], data=event.data))
+            else:
+                rows.append(change(READ_RECEIPT, user_id=event.data["reader_id"], data=event.data))
+                rows.append(change(READ_RECEIPT, user_id=event.data["receiver_id"], data=event.data))
+        return rows
+
+    async def _update(self, db, kind: str, *where) -> list:
+        """Apply a receipt to matching messages; returns the rows it changed."""
+        stmt = update(Message).where(*where, *self._not_yet(kind)).values(**self._values(kind))
+        result = await db.execute(
+            stmt.returning(Message.id, Message.conversation_id, Message.room_id, Message.sender_id)
+        )
+        return result.all()
+
+    async def _patch_recent(self, rows) -> None:
+        if self.recent is None or not rows:
+            return
+        by_key = defaultdict(list)
+        for row in rows:
+            key = conversation_key(row.conversation_id, row.room_id)
+            if key is not None:
+                by_key[key].append(row.id)
+        for key, ids in by_key.items():
+            await self.recent.mark_read(key, ids)
+
+    @staticmethod
+    def _values(kind: str) -> dict:
+        return {"is_read": True, "status": "read"} if kind == READ else {"status": "delivered"}
+
+    @staticmethod
+    def _not_yet(kind: str) -> tuple:
+        # Never downgrade a read message back to delivered
+        return (Message.is_read == False,) if kind == READ else (Message.status == "sent",)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+receipt_aggregator = ReceiptAggregator()
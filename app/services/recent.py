@@ -0,0 +1,338 @@
+"""
+Recent messages per conversation, kept serialized for first-page history.
+
+Each DM conversation ("dm", conversation_id) or room ("room", room_id) has a
+buffer of its newest RECENT_MESSAGES_PER_CONVERSATION messages as response
+JSON, ordered like history (timestamp, id). `message.send` writes through,
+edits and deletes patch the buffer, and read receipts flip `is_read`.
+
+A buffer only answers reads once a history query has filled it, since until
+then it may lack older messages. First pages are then built without touching
+the database; deeper pages always go to SQL. Every write bumps the
+conversation's version, and a fill whose query raced a write (the version
+changed since it was read) is dropped, so it cannot put back a message as
+it was before an edit, delete or read receipt.
+
+The in-process store only sees writes made by its own process. Deployments
+with several instances use the Redis store, which all of them share.
+"""
+import bisect
+import json
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Iterable, List, Optional, Tuple
+
+from redis.exceptions import WatchError
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.schemas.message import Message as MessageSchema
+
+Key = Tuple[str, int]
+# (sort position, response JSON); position is (naive UTC timestamp, id)
+Entry = Tuple[Tuple[datetime, int], str]
+
+# Conversations whose last write the in-process store remembers
+MAX_TRACKED_VERSIONS = 10_000
+
+
+def conversation_key(conversation_id: Optional[int], room_id: Optional[int]) -> Optional[Key]:
+    if conversation_id is not None:
+        return ("dm", conversation_id)
+    if room_id is not None:
+        return ("room", room_id)
+    return None
+
+
+def entry_for(message) -> Entry:
+    """Serialize a message (ORM row or dict of its columns) for the buffer."""
+    message = MessageSchema.model_validate(message, from_attributes=True)
+    timestamp = message.timestamp
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp, message.id), message.model_dump_json()
+
+
+class RecentMessageStore(ABC):
+    @abstractmethod
+    async def page(self, key: Key, limit: int) -> Optional[List[Entry]]:
+        """The newest `limit` entries, oldest first, or None if not cached."""
+
+    @abstractmethod
+    async def version(self, key: Key) -> Any:
+        """Read before a first-page query and passed on to `fill`."""
+
+    @abstractmethod
+    async def fill(self, key: Key, entries: List[Entry], exhausted: bool, version: Any) -> None:
+        """
+        Seed from a first-page query; `exhausted` if it returned everything.
+        Ignored if the conversation was written since `version`.
+        """
+
+    @abstractmethod
+    async def add(self, key: Key, entry: Entry) -> None:
+        ...
+
+    @abstractmethod
+    async def replace(self, key: Key, message_id: int, entry: Optional[Entry]) -> None:
+        """Swap the message's entry for `entry`, or drop it when None."""
+
+    @abstractmethod
+    async def mark_read(self, key: Key, message_ids: Iterable[int]) -> None:
+        ...
+
+
+def _mark_read(frame: str) -> str:
+    data = json.loads(frame)
+    data["is_read"] = True
+    return json.dumps(data, separators=(",", ":"))
+
+
+class _Buffer:
+    __slots__ = ("entries", "ready", "exhausted", "size")
+
+    def __init__(self):
+        self.entries: List[Entry] = []
+        self.ready = False
+        self.exhausted = False
+        self.size = 0
+
+
+class MemoryRecentMessages(RecentMessageStore):
+    """Buffers in an LRU bounded by the total size of their JSON."""
+
+    def __init__(self, per_conversation: int, max_bytes: int):
+        self.per_conversation = per_conversation
+        self.max_bytes = max_bytes
+        self.buffers: "OrderedDict[Key, _Buffer]" = OrderedDict()
+        self.size = 0
+        # Writes are numbered; key -> number of its last write, oldest first
+        self._clock = 0
+        self._written: "OrderedDict[Key, int]" = OrderedDict()
+        # Last write of any key no longer tracked
+        self._forgotten = 0
+
+    def _wrote(self, key: Key) -> None:
+        self._clock += 1
+        self._written[key] = self._clock
+        self._written.move_to_end(key)
+        if len(self._written) > MAX_TRACKED_VERSIONS:
+            _, self._forgotten = self._written.popitem(last=False)
+
+    def _buffer(self, key: Key) -> _Buffer:
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = _Buffer()
+        self.buffers.move_to_end(key)
+        return buffer
+
+    def _insert(self, buffer: _Buffer, entry: Entry) -> None:
+        positions = [position for position, _ in buffer.entries]
+        index = bisect.bisect_left(positions, entry[0])
+        if index < len(positions) and positions[index] == entry[0]:
+            self._resize(buffer, -len(buffer.entries[index][1]))
+            buffer.entries[index] = entry
+        else:
+            buffer.entries.insert(index, entry)
+        self._resize(buffer, len(entry[1]))
+        while len(buffer.entries) > self.per_conversation:
+            _, frame = buffer.entries.pop(0)
+            self._resize(buffer, -len(frame))
+            buffer.exhausted = False
+
+    def _resize(self, buffer: _Buffer, delta: int) -> None:
+        buffer.size += delta
+        self.size += delta
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self.buffers:
+            _, buffer = self.buffers.popitem(last=False)
+            self.size -= buffer.size
+            metrics.inc("recent_messages_evictions_total")
+
+    async def page(self, key: Key, limit: int) -> Optional[List[Entry]]:
+        buffer = self.buffers.get(key)
+        if buffer is None or not buffer.ready or (len(buffer.entries) < limit and not buffer.exhausted):
+            return None
+        self.buffers.move_to_end(key)
+        return buffer.entries[-limit:]
+
+    async def version(self, key: Key) -> int:
+        return self._clock
+
+    async def fill(self, key: Key, entries: List[Entry], exhausted: bool, version: int) -> None:
+        if self._written.get(key, self._forgotten) > version:
+            metrics.inc("recent_messages_stale_fills_total")
+            return
+        buffer = self._buffer(key)
+        for entry in entries:
+            self._insert(buffer, entry)
+        buffer.ready = True
+        buffer.exhausted = exhausted and len(buffer.entries) < self.per_conversation
+        self._evict()
+
+    async def add(self, key: Key, entry: Entry) -> None:
+        self._wrote(key)
+        self._insert(self._buffer(key), entry)
+        self._evict()
+
+    async def replace(self, key: Key, message_id: int, entry: Optional[Entry]) -> None:
+        self._wrote(key)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            return
+        for index, ((_, entry_id), frame) in enumerate(buffer.entries):
+            if entry_id == message_id:
+                del buffer.entries[index]
+                self._resize(buffer, -len(frame))
+                if entry is not None:
+                    self._insert(buffer, entry)
+                return
+
+    async def mark_read(self, key: Key, message_ids: Iterable[int]) -> None:
+        self._wrote(key)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            return
+        ids = set(message_ids)
+        for index, (position, frame) in enumerate(buffer.entries):
+            if position[1] in ids:
+                patched = _mark_read(frame)
+                self._resize(buffer, len(patched) - len(frame))
+                buffer.entries[index] = (position, patched)
+
+
+class RedisRecentMessages(RecentMessageStore):
+    """
+    One sorted set per conversation (`chat:recent:<kind>:<id>`, scored by
+    message id) plus a `:state` key saying whether it is ready/exhausted
+    and a `:version` counter every write increments. All expire after
+    RECENT_MESSAGES_TTL_SECONDS without writes; a fill writes under WATCH
+    of the version.
+    """
+
+    def __init__(self, redis, per_conversation: int, ttl: int):
+        self.redis = redis
+        self.per_conversation = per_conversation
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key: Key) -> str:
+        return f"chat:recent:{key[0]}:{key[1]}"
+
+    @staticmethod
+    def _decode(member: str) -> Entry:
+        data = json.loads(member)
+        timestamp = datetime.fromisoformat(data["timestamp"])
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return (timestamp, data["id"]), member
+
+    async def page(self, key: Key, limit: int) -> Optional[List[Entry]]:
+        name = self._key(key)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(name + ":state")
+            pipe.zrange(name, -limit, -1)
+            state, members = await pipe.execute()
+        if not state or (len(members) < limit and state != "exhausted"):
+            return None
+        return sorted(self._decode(member) for member in members)
+
+    def _queue(self, pipe, key: Key, entries: List[Entry], state: Optional[str] = None) -> None:
+        """Queue the commands writing `entries`; a write without `state` bumps the version."""
+        name = self._key(key)
+        for (_, message_id), frame in entries:
+            pipe.zremrangebyscore(name, message_id, message_id)
+            pipe.zadd(name, {frame: message_id})
+        pipe.zremrangebyrank(name, 0, -self.per_conversation - 1)
+        pipe.expire(name, self.ttl)
+        if state is not None:
+            pipe.set(name + ":state", state, ex=self.ttl)
+        else:
+            pipe.expire(name + ":state", self.ttl)
+            self._bump(pipe, key)
+
+    def _bump(self, pipe, key: Key) -> None:
+        pipe.incr(self._key(key) + ":version")
+        pipe.expire(self._key(key) + ":version", self.ttl)
+
+    async def _trimmed(self, key: Key, entries: List[Entry], results: list) -> None:
+        if results[2 * len(entries)]:
+            # Older messages fell off, so the set no longer holds all of them
+            await self.redis.set(self._key(key) + ":state", "ready", xx=True, ex=self.ttl)
+
+    async def _write(self, key: Key, entries: List[Entry]) -> None:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue(pipe, key, entries)
+            results = await pipe.execute()
+        await self._trimmed(key, entries, results)
+
+    async def version(self, key: Key) -> Optional[str]:
+        return await self.redis.get(self._key(key) + ":version")
+
+    async def fill(self, key: Key, entries: List[Entry], exhausted: bool, version: Optional[str]) -> None:
+        version_key = self._key(key) + ":version"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(version_key)
+                if await pipe.get(version_key) != version:
+                    metrics.inc("recent_messages_stale_fills_total")
+                    return
+                pipe.multi()
+                self._queue(pipe, key, entries, "exhausted" if exhausted else "ready")
+                results = await pipe.execute()
+            except WatchError:
+                metrics.inc("recent_messages_stale_fills_total")
+                return
+        await self._trimmed(key, entries, results)
+
+    async def add(self, key: Key, entry: Entry) -> None:
+        await self._write(key, [entry])
+
+    async def replace(self, key: Key, message_id: int, entry: Optional[Entry]) -> None:
+        if entry is not None:
+            await self._write(key, [entry])
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(self._key(key), message_id, message_id)
+            self._bump(pipe, key)
+            await pipe.execute()
+
+    async def mark_read(self, key: Key, message_ids: Iterable[int]) -> None:
+        name = self._key(key)
+        ids = set(message_ids)
+        members = await self.redis.zrangebyscore(name, min(ids), max(ids)) if ids else []
+        patched = [self._decode(_mark_read(m)) for m in members if json.loads(m)["id"] in ids]
+        if patched:
+            await self._write(key, patched)
+            return
+        # The receipt may concern rows a running fill is about to write
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._bump(pipe, key)
+            await pipe.execute()
+
+
+def create_recent_store() -> Optional[RecentMessageStore]:
+    backend = settings.RECENT_MESSAGES_BACKEND
+    if not backend:
+        # In process only when this is the only process writing messages
+        single = settings.BROKER_BACKEND in ("", "memory") and not settings.REDIS_URL
+        backend = "redis" if settings.REDIS_URL else "memory" if single else "off"
+    if backend == "off":
+        return None
+    if backend == "memory":
+        return MemoryRecentMessages(settings.RECENT_MESSAGES_PER_CONVERSATION, settings.RECENT_MESSAGES_MAX_BYTES)
+    if backend == "redis":
+        if not settings.REDIS_URL:
+            raise ValueError("RECENT_MESSAGES_BACKEND=redis requires REDIS_URL")
+        from redis.asyncio import Redis
+        return RedisRecentMessages(
+            Redis.from_url(settings.REDIS_URL, decode_responses=True),
+            settings.RECENT_MESSAGES_PER_CONVERSATION,
+            settings.RECENT_MESSAGES_TTL_SECONDS,
+        )
+    raise ValueError(f"Unknown RECENT_MESSAGES_BACKEND: {backend!r}")
+
+
+recent_messages = create_recent_store()
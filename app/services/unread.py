@@ -0,0 +1,231 @@
+"""
+Unread counts per user and conversation.
+
+`get_unread_counts` answers from one grouped query per conversation kind by
+default. With UNREAD_COUNTER_BACKEND set, counts are instead maintained
+incrementally (bumped when messages are persisted, lowered when they are
+read) in the `unread_counter` table or a Redis hash per user, so reading
+them is a single lookup with no scans over `message`.
+"""
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import Integer, String, and_, case, func, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.session import upsert
+from app.models.chat import ChatRoomMember
+from app.models.message import Message
+from app.models.unread import UnreadCounter
+
+
+def dm_key(peer_id: int) -> str:
+    return f"u:{peer_id}"
+
+
+def room_key(room_id: int) -> str:
+    return f"r:{room_id}"
+
+
+def split_counts(pairs: Iterable[Tuple[str, int]]) -> Dict[str, Dict[str, int]]:
+    """Turn (conversation_key, count) pairs into the /chat/unread response shape."""
+    counts: Dict[str, Dict[str, int]] = {"users": {}, "rooms": {}}
+    for key, count in pairs:
+        if count > 0:
+            kind, _, target = key.partition(":")
+            counts["users" if kind == "u" else "rooms"][target] = count
+    return counts
+
+
+async def query_unread_counts(db: AsyncSession, user_id: int) -> Dict[str, Dict[str, int]]:
+    """Unread counts computed from `message`: one grouped query per kind."""
+    stmt_users = (
+        select(Message.sender_id, func.count(Message.id))
+        .where(and_(Message.receiver_id == user_id, Message.is_read == False))
+        .group_by(Message.sender_id)
+    )
+    stmt_rooms = (
+        select(ChatRoomMember.chatroom_id, func.count(Message.id))
+        .join(
+            Message,
+            and_(
+                Message.room_id == ChatRoomMember.chatroom_id,
+                Message.timestamp > ChatRoomMember.last_read_at,
+                Message.sender_id != user_id,
+            ),
+        )
+        .where(ChatRoomMember.user_id == user_id)
+        .group_by(ChatRoomMember.chatroom_id)
+    )
+    users = (await db.execute(stmt_users)).all()
+    rooms = (await db.execute(stmt_rooms)).all()
+    return split_counts(
+        [(dm_key(sender_id), count) for sender_id, count in users]
+        + [(room_key(room_id), count) for room_id, count in rooms]
+    )
+
+
+def remaining_room_unread(user_id: int, room_id: int):
+    """Scalar subquery: room messages from others after the member's last_read_at."""
+    return (
+        select(func.count(Message.id))
+        .join(
+            ChatRoomMember,
+            and_(ChatRoomMember.chatroom_id == Message.room_id, ChatRoomMember.user_id == user_id),
+        )
+        .where(
+            Message.room_id == room_id,
+            Message.timestamp > ChatRoomMember.last_read_at,
+            Message.sender_id != user_id,
+        )
+        .scalar_subquery()
+    )
+
+
+def _batch_counts(rows: Iterable[Dict[str, Any]]) -> Tuple[Counter, Counter]:
+    dms: Counter = Counter()
+    rooms: Counter = Counter()
+    for row in rows:
+        if row.get("room_id"):
+            rooms[(row["room_id"], row["sender_id"])] += 1
+        elif row.get("receiver_id"):
+            dms[(row["receiver_id"], row["sender_id"])] += 1
+    return dms, rooms
+
+
+class UnreadCounterStore(ABC):
+    """Incrementally maintained unread counters."""
+
+    @abstractmethod
+    async def record_messages(self, db: AsyncSession, rows: Iterable[Dict[str, Any]]) -> None:
+        """Count newly inserted message rows (called inside the insert transaction)."""
+
+    @abstractmethod
+    async def dm_read(self, db: AsyncSession, user_id: int, peer_id: int, count: int) -> None:
+        """`count` DMs from `peer_id` were just marked read."""
+
+    @abstractmethod
+    async def room_read(self, db: AsyncSession, user_id: int, room_id: int) -> None:
+        """The member's last_read_at moved; recount what is left unread."""
+
+    @abstractmethod
+    async def get(self, db: AsyncSession, user_id: int) -> Dict[str, Dict[str, int]]:
+        ...
+
+
+class TableUnreadCounters(UnreadCounterStore):
+    """Counters in the `unread_counter` table, updated in the caller's transaction."""
+
+    def _increment(self, stmt):
+        return stmt.on_conflict_do_update(
+            index_elements=[UnreadCounter.user_id, UnreadCounter.conversation_key],
+            set_={"count": UnreadCounter.count + stmt.excluded.count},
+        )
+
+    async def record_messages(self, db: AsyncSession, rows: Iterable[Dict[str, Any]]) -> None:
+        dms, rooms = _batch_counts(rows)
+        if dms:
+            stmt = upsert(db, UnreadCounter).values([
+                {"user_id": receiver_id, "conversation_key": dm_key(sender_id), "count": n}
+                for (receiver_id, sender_id), n in dms.items()
+            ])
+            await db.execute(self._increment(stmt))
+        for (room_id, sender_id), n in rooms.items():
+            members = select(
+                ChatRoomMember.user_id,
+                literal(room_key(room_id), String),
+                literal(n, Integer),
+            ).where(ChatRoomMember.chatroom_id == room_id, ChatRoomMember.user_id != sender_id)
+            stmt = upsert(db, UnreadCounter).from_select(["user_id", "conversation_key", "count"], members)
+            await db.execute(self._increment(stmt))
+
+    async def dm_read(self, db: AsyncSession, user_id: int, peer_id: int, count: int) -> None:
+        await db.execute(
+            update(UnreadCounter)
+            .where(UnreadCounter.user_id == user_id, UnreadCounter.conversation_key == dm_key(peer_id))
+            .values(count=case((UnreadCounter.count > count, UnreadCounter.count - count), else_=0))
+        )
+
+    async def room_read(self, db: AsyncSession, user_id: int, room_id: int) -> None:
+        await db.execute(
+            update(UnreadCounter)
+            .where(UnreadCounter.user_id == user_id, UnreadCounter.conversation_key == room_key(room_id))
+            .values(count=remaining_room_unread(user_id, room_id))
+        )
+
+    async def get(self, db: AsyncSession, user_id: int) -> Dict[str, Dict[str, int]]:
+        result = await db.execute(
+            select(UnreadCounter.conversation_key, UnreadCounter.count)
+            .where(UnreadCounter.user_id == user_id, UnreadCounter.count > 0)
+        )
+        return split_counts(result.all())
+
+
+class RedisUnreadCounters(UnreadCounterStore):
+    """
+    Counters in a Redis hash per user (`chat:unread:<user_id>`). Updates are
+    applied as soon as the database work is issued, so a failed commit can
+    leave a count slightly high until the conversation is read.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"chat:unread:{user_id}"
+
+    async def record_messages(self, db: AsyncSession, rows: Iterable[Dict[str, Any]]) -> None:
+        dms, rooms = _batch_counts(rows)
+        room_members: Dict[int, list] = {}
+        if rooms:
+            result = await db.execute(
+                select(ChatRoomMember.chatroom_id, ChatRoomMember.user_id)
+                .where(ChatRoomMember.chatroom_id.in_({room_id for room_id, _ in rooms}))
+            )
+            for room_id, member_id in result.all():
+                room_members.setdefault(room_id, []).append(member_id)
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for (receiver_id, sender_id), n in dms.items():
+                pipe.hincrby(self._key(receiver_id), dm_key(sender_id), n)
+            for (room_id, sender_id), n in rooms.items():
+                for member_id in room_members.get(room_id, ()):
+                    if member_id != sender_id:
+                        pipe.hincrby(self._key(member_id), room_key(room_id), n)
+            await pipe.execute()
+
+    async def dm_read(self, db: AsyncSession, user_id: int, peer_id: int, count: int) -> None:
+        remaining = await self.redis.hincrby(self._key(user_id), dm_key(peer_id), -count)
+        if remaining <= 0:
+            await self.redis.hdel(self._key(user_id), dm_key(peer_id))
+
+    async def room_read(self, db: AsyncSession, user_id: int, room_id: int) -> None:
+        remaining = await db.scalar(select(remaining_room_unread(user_id, room_id)))
+        if remaining:
+            await self.redis.hset(self._key(user_id), room_key(room_id), remaining)
+        else:
+            await self.redis.hdel(self._key(user_id), room_key(room_id))
+
+    async def get(self, db: AsyncSession, user_id: int) -> Dict[str, Dict[str, int]]:
+        counts = await self.redis.hgetall(self._key(user_id))
+        return split_counts((key, int(count)) for key, count in counts.items())
+
+
+def create_unread_store() -> Optional[UnreadCounterStore]:
+    backend = settings.UNREAD_COUNTER_BACKEND
+    if not backend:
+        return None
+    if backend == "table":
+        return TableUnreadCounters()
+    if backend == "redis":
+        if not settings.REDIS_URL:
+            raise ValueError("UNREAD_COUNTER_BACKEND=redis requires REDIS_URL")
+        from redis.asyncio import Redis
+        return RedisUnreadCounters(Redis.from_url(settings.REDIS_URL, decode_responses=True))
+    raise ValueError(f"Unknown UNREAD_COUNTER_BACKEND: {backend!r}")
+
+
+unread_counters = create_unread_store()
@@ -0,0 +1,197 @@
+"""
+Resumable uploads for large attachments.
+
+A client creates a session with the file's total size, PUTs the bytes in
+any number of requests, each starting at the session's current offset,
+and completes it once the offset reaches the size. A dropped request keeps
+every byte that arrived, so the client asks for the offset and resumes from
+there instead of starting over.
+
+Each session is `<id>.json` (owner, filename, content type, size) plus
+`<id>.data` under UPLOAD_SESSION_DIR; the offset is the data file's length.
+Bytes are appended from a worker thread as they stream in, and completion
+moves the data file into the content-addressed store, so a file is never
+held in memory. Sessions idle for UPLOAD_SESSION_TTL_SECONDS are removed by
+`sweep_upload_sessions`. The files are local, so all requests of a session
+must reach the same host.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.models.upload import UploadObject
+from app.services.uploads import UploadTooLarge, store_file
+
+_UPLOAD_ID_LENGTH = 32
+
+# upload id -> lock serializing its PUTs and completion within this process
+_locks: Dict[str, asyncio.Lock] = {}
+
+
+class UploadSessionNotFound(LookupError):
+    pass
+
+
+class OffsetMismatch(ValueError):
+    """A chunk did not start at the session's current offset."""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+def _paths(upload_id: str):
+    base = os.path.join(settings.UPLOAD_SESSION_DIR, upload_id)
+    return base + ".json", base + ".data"
+
+
+def _create(upload_id: str, meta: Dict[str, Any]) -> None:
+    os.makedirs(settings.UPLOAD_SESSION_DIR, exist_ok=True)
+    meta_path, data_path = _paths(upload_id)
+    open(data_path, "wb").close()
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+def _load(upload_id: str) -> Optional[Dict[str, Any]]:
+    # Ids are generated hex; anything else cannot name a session file
+    if len(upload_id) != _UPLOAD_ID_LENGTH or not all(c in "0123456789abcdef" for c in upload_id):
+        return None
+    meta_path, data_path = _paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["offset"] = os.path.getsize(data_path)
+    except FileNotFoundError:
+        return None
+    return meta
+
+
+def _discard(upload_id: str) -> None:
+    for path in _paths(upload_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def _session(upload_id: str, user_id: int) -> Dict[str, Any]:
+    meta = await run_in_threadpool(_load, upload_id)
+    if meta is None or meta["user_id"] != user_id:
+        raise UploadSessionNotFound(upload_id)
+    return meta
+
+
+def _status(upload_id: str, meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "upload_id": upload_id,
+        "filename": meta["filename"],
+        "content_type": meta["content_type"],
+        "size": meta["size"],
+        "offset": meta["offset"],
+    }
+
+
+async def create_session(user_id: int, filename: str, content_type: Optional[str], size: int) -> Dict[str, Any]:
+    """Start a session; raises UploadTooLarge past RESUMABLE_UPLOAD_MAX_BYTES."""
+    if size > settings.RESUMABLE_UPLOAD_MAX_BYTES:
+        raise UploadTooLarge()
+    upload_id = uuid.uuid4().hex
+    meta = {"user_id": user_id, "filename": filename, "content_type": content_type, "size": size}
+    await run_in_threadpool(_create, upload_id, meta)
+    metrics.inc("upload_sessions_created_total")
+    return _status(upload_id, {**meta, "offset": 0})
+
+
+async def session_status(upload_id: str, user_id: int) -> Dict[str, Any]:
+    return _status(upload_id, await _session(upload_id, user_id))
+
+
+async def append_chunk(upload_id: str, user_id: int, offset: int, stream: AsyncIterator[bytes]) -> Dict[str, Any]:
+    """
+    Append the request body at `offset`, which must be the current one.
+    Whatever arrives before a failure stays written.
+    """
+    async with _locks.setdefault(upload_id, asyncio.Lock()):
+        meta = await _session(upload_id, user_id)
+        if offset != meta["offset"]:
+            raise OffsetMismatch(meta["offset"])
+        remaining = meta["size"] - offset
+        _, data_path = _paths(upload_id)
+        out = await run_in_threadpool(open, data_path, "ab")
+        buffer = bytearray()
+        try:
+            async for chunk in stream:
+                if len(chunk) > remaining:
+                    raise UploadTooLarge()
+                remaining -= len(chunk)
+                buffer += chunk
+                if len(buffer) >= settings.UPLOAD_CHUNK_SIZE:
+                    await run_in_threadpool(out.write, bytes(buffer))
+                    buffer.clear()
+        finally:
+            if buffer:
+                await run_in_threadpool(out.write, bytes(buffer))
+            await run_in_threadpool(out.close)
+            metrics.inc("upload_session_bytes_total", meta["size"] - offset - remaining)
+        meta["offset"] = meta["size"] - remaining
+        return _status(upload_id, meta)
+
+
+async def complete_session(db: AsyncSession, upload_id: str, user_id: int) -> UploadObject:
+    """Store a fully received session's file; raises OffsetMismatch if it is not."""
+    async with _locks.setdefault(upload_id, asyncio.Lock()):
+        meta = await _session(upload_id, user_id)
+        if meta["offset"] != meta["size"]:
+            raise OffsetMismatch(meta["offset"])
+        _, data_path = _paths(upload_id)
+        stored = await store_file(db, data_path, meta["filename"], meta["content_type"])
+        await run_in_threadpool(_discard, upload_id)
+    _locks.pop(upload_id, None)
+    metrics.inc("upload_sessions_completed_total")
+    return stored
+
+
+def _sweep(max_age: float) -> int:
+    try:
+        names = os.listdir(settings.UPLOAD_SESSION_DIR)
+    except FileNotFoundError:
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for name in names:
+        upload_id, ext = os.path.splitext(name)
+        if ext != ".json":
+            continue
+        _, data_path = _paths(upload_id)
+        try:
+            idle_since = os.path.getmtime(data_path)
+        except FileNotFoundError:
+            idle_since = 0
+        if idle_since < cutoff:
+            _discard(upload_id)
+            removed += 1
+    return removed
+
+
+async def sweep_upload_sessions(interval: float) -> None:
+    """Every `interval` seconds, delete sessions idle past UPLOAD_SESSION_TTL_SECONDS."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await run_in_threadpool(_sweep, settings.UPLOAD_SESSION_TTL_SECONDS)
+        except Exception as e:
+            print(f"Upload session sweep failed: {e}")
+            continue
+        for upload_id in [u for u, lock in _locks.items() if not lock.locked()]:
+            if not os.path.exists(_paths(upload_id)[0]):
+                del _locks[upload_id]
+        metrics.inc("upload_sessions_expired_total", removed)
@@ -0,0 +1,220 @@
+"""
+Content-addressed storage for uploaded files.
+
+The request body is parsed as it arrives and cut off once it exceeds
+UPLOAD_MAX_BYTES (plus room for the multipart envelope); Starlette spools
+file parts to a temporary file from a worker thread. `store_upload` then
+copies the spooled file into UPLOAD_DIR in UPLOAD_CHUNK_SIZE chunks, hashing
+it on the way, also in a worker thread, so the loop only ever waits on it.
+
+Files are named after the SHA-256 of their content, so identical uploads are
+stored once and share one URL that never changes meaning (served with an
+immutable Cache-Control). `upload_object.ref_count` tracks the messages
+linking to each file; `collect_garbage` removes files nobody references
+(with their previews, see app.services.previews).
+"""
+import hashlib
+import os
+import re
+import shutil
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import AsyncIterator, BinaryIO, Iterable, Optional, Tuple
+
+from sqlalchemy import bindparam, delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException
+from starlette.staticfiles import StaticFiles
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import upsert
+from app.models.upload import UploadObject
+
+UPLOAD_DIR = "app/static/uploads"
+UPLOAD_URL_PREFIX = "/static/uploads/"
+
+# Multipart boundaries and part headers around the file itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+_EXTENSION = re.compile(r"^\.[a-z0-9]{1,10}$")
+
+
+class UploadTooLarge(MultiPartException):
+    """Raised while streaming once an upload exceeds UPLOAD_MAX_BYTES."""
+
+    def __init__(self):
+        super().__init__(f"Upload exceeds {settings.UPLOAD_MAX_BYTES} bytes")
+
+
+class UploadFiles(StaticFiles):
+    """Serves UPLOAD_DIR; a content-addressed name never changes content."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+def body_limit() -> int:
+    return settings.UPLOAD_MAX_BYTES + FORM_OVERHEAD_BYTES
+
+
+async def capped(stream: AsyncIterator[bytes], limit: int) -> AsyncIterator[bytes]:
+    """Pass `stream` through, raising UploadTooLarge past `limit` bytes."""
+    received = 0
+    async for chunk in stream:
+        received += len(chunk)
+        if received > limit:
+            raise UploadTooLarge()
+        yield chunk
+
+
+def upload_filename(content: str) -> Optional[str]:
+    """The stored filename a message's content links to, if any."""
+    if content.startswith(UPLOAD_URL_PREFIX):
+        return content[len(UPLOAD_URL_PREFIX):]
+    return None
+
+
+def _extension(filename: Optional[str]) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if _EXTENSION.match(ext) else ""
+
+
+def _hash_copy(source: BinaryIO, path: str, chunk_size: int) -> Tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as out:
+            while chunk := source.read(chunk_size):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        _remove(path)
+        raise
+    return digest.hexdigest(), size
+
+
+def _hash_file(path: str, chunk_size: int) -> Tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as source:
+        while chunk := source.read(chunk_size):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _place(partial: str, path: str) -> None:
+    if os.path.exists(path):
+        # Same content is already stored under this name
+        os.remove(partial)
+    else:
+        # A rename unless the source is on another filesystem
+        shutil.move(partial, path)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _register(
+    db: AsyncSession, partial: str, sha256: str, size: int, filename: Optional[str], content_type: Optional[str]
+) -> UploadObject:
+    """Move `partial` into the store as its content's object (or drop it if known)."""
+    try:
+        existing = await db.get(UploadObject, sha256)
+        if existing is not None:
+            existing.last_uploaded_at = datetime.utcnow()
+            await db.commit()
+            metrics.inc("uploads_deduplicated_total")
+            return existing
+
+        stored_name = sha256 + _extension(filename)
+        # The file is in place before any row points at it
+        await run_in_threadpool(_place, partial, os.path.join(UPLOAD_DIR, stored_name))
+        await db.execute(
+            upsert(db, UploadObject)
+            .values(sha256=sha256, filename=stored_name, size=size, content_type=content_type)
+            .on_conflict_do_nothing(index_elements=["sha256"])
+        )
+        await db.commit()
+        stored = await db.get(UploadObject, sha256, populate_existing=True)
+        if stored.filename != stored_name:
+            # A concurrent upload of the same bytes with another extension won
+            await run_in_threadpool(_remove, os.path.join(UPLOAD_DIR, stored_name))
+        return stored
+    finally:
+        await run_in_threadpool(_remove, partial)
+        metrics.inc("uploads_total")
+        metrics.inc("upload_bytes_total", size)
+
+
+async def store_upload(db: AsyncSession, file: UploadFile) -> UploadObject:
+    """Store a parsed upload unless its content already is; returns its object."""
+    started = time.perf_counter()
+    await file.seek(0)
+    # Written under a temporary name so a failed copy never leaves a partial file
+    partial = os.path.join(UPLOAD_DIR, f".{uuid.uuid4()}.part")
+    sha256, size = await run_in_threadpool(_hash_copy, file.file, partial, settings.UPLOAD_CHUNK_SIZE)
+    stored = await _register(db, partial, sha256, size, file.filename, file.content_type)
+    metrics.inc("upload_store_seconds_total", time.perf_counter() - started)
+    return stored
+
+
+async def store_file(db: AsyncSession, path: str, filename: Optional[str], content_type: Optional[str]) -> UploadObject:
+    """Like `store_upload` for a file already on disk, which is moved (not copied)."""
+    started = time.perf_counter()
+    sha256, size = await run_in_threadpool(_hash_file, path, settings.UPLOAD_CHUNK_SIZE)
+    stored = await _register(db, path, sha256, size, filename, content_type)
+    metrics.inc("upload_store_seconds_total", time.perf_counter() - started)
+    return stored
+
+
+async def add_references(db: AsyncSession, contents: Iterable[str], delta: int = 1) -> None:
+    """
+    Adjust ref_count of the uploads that messages with `contents` link to, in
+    the caller's transaction (+1 when stored, -1 when deleted).
+    """
+    counts = Counter(filename for filename in map(upload_filename, contents) if filename)
+    if not counts:
+        return
+    table = UploadObject.__table__
+    await db.execute(
+        update(table)
+        .where(table.c.filename == bindparam("target"))
+        .values(ref_count=table.c.ref_count + bindparam("delta")),
+        [{"target": filename, "delta": count * delta} for filename, count in counts.items()],
+    )
+
+
+async def collect_garbage(db: AsyncSession, grace_seconds: Optional[int] = None) -> int:
+    """
+    Delete uploads with no referencing messages that were not uploaded
+    within the grace period (their link may not have been sent yet).
+    Returns the number of files removed.
+    """
+    grace = grace_seconds if grace_seconds is not None else settings.UPLOAD_GC_GRACE_SECONDS
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    result = await db.execute(
+        delete(UploadObject)
+        .where(UploadObject.ref_count <= 0, UploadObject.last_uploaded_at < cutoff)
+        .returning(UploadObject.filename, UploadObject.thumbnail)
+    )
+    removed = result.all()
+    await db.commit()
+    for filename, thumbnail in removed:
+        await run_in_threadpool(_remove, os.path.join(UPLOAD_DIR, filename))
+        if thumbnail:
+            await run_in_threadpool(_remove, os.path.join(UPLOAD_DIR, thumbnail))
+    metrics.inc("uploads_collected_total", len(removed))
+    return len(removed)
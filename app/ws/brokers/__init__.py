@@ -0,0 +1,41 @@
+from app.core.config import settings
+from app.ws.brokers.base import Broker
+from app.ws.brokers.memory import MemoryBroker
+
+
+def broker_backend() -> str:
+    """The backend `create_broker` builds: BROKER_BACKEND, or its default."""
+    return settings.BROKER_BACKEND or ("redis" if settings.REDIS_URL else "memory")
+
+
+def create_broker(manager) -> Broker:
+    """Build the broker selected by `settings.BROKER_BACKEND`."""
+    backend = broker_backend()
+
+    if backend == "memory":
+        return MemoryBroker(manager)
+
+    if backend == "ipc":
+        from app.ws.brokers.ipc import IPCBroker
+        return IPCBroker(manager, settings.IPC_SOCKET_DIR)
+
+    if backend == "streams":
+        from app.ws.brokers.streams import StreamsBroker
+        if settings.REDIS_URL:
+            from redis.asyncio import Redis
+            return StreamsBroker(manager, Redis.from_url(settings.REDIS_URL, decode_responses=True))
+        from app.ws.streams import InMemoryStreams
+        print("Redis not configured, using in-memory event stream.")
+        return StreamsBroker(manager, InMemoryStreams())
+
+    if backend == "redis":
+        if not settings.REDIS_URL:
+            raise ValueError("BROKER_BACKEND=redis requires REDIS_URL")
+        from redis.asyncio import Redis
+        from app.ws.brokers.pubsub import RedisPubSubBroker
+        return RedisPubSubBroker(manager, Redis.from_url(settings.REDIS_URL, decode_responses=True))
+
+    raise ValueError(f"Unknown BROKER_BACKEND: {backend!r}")
+
+
+__all__ = ["Broker", "MemoryBroker", "broker_backend", "create_broker"]
@@ -0,0 +1,46 @@
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Iterable, List, Optional
+from app.ws.envelope import Route
+
+if TYPE_CHECKING:
+    from app.ws.manager import ConnectionManager
+
+
+class Broker(ABC):
+    """
+    Moves events between server instances.
+
+    `publish` takes an already-routed, already-encoded event and makes sure
+    every instance holding a recipient calls `manager.deliver` for it
+    (including this one). Backends that track where users are connected get
+    `user_connected`/`user_disconnected` calls from the manager.
+    """
+
+    # Whether `replay` can serve resume cursors
+    supports_replay = False
+
+    def __init__(self, manager: "ConnectionManager"):
+        self.manager = manager
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    async def publish(self, route: Route, payload: str) -> None:
+        ...
+
+    async def user_connected(self, user_id: int) -> None:
+        pass
+
+    async def user_disconnected(self, user_id: int) -> None:
+        pass
+
+    async def replay(self, user_id: int, cursor: str, rooms: Iterable[int]) -> Optional[List[str]]:
+        """
+        Frames for `user_id` published after `cursor`, or None when the client
+        must resync from history instead.
+        """
+        return []
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import struct
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.ws.brokers.base import Broker
+from app.ws.envelope import Route, decode, join
+
+# Frames on the wire are a 4-byte big-endian length followed by the envelope
+FRAME_HEADER = struct.Struct(">I")
+# How often the socket directory is rescanned for new workers
+PEER_REFRESH_SECONDS = 1.0
+
+
+class Peer:
+    """
+    Outbound stream to one other worker with its own bounded queue.
+
+    Like `Connection` for clients: publishing only enqueues, and a dedicated
+    task connects and writes, so a stalled worker only delays itself. When
+    the queue is full the oldest frame is dropped.
+    """
+
+    def __init__(self, broker: "IPCBroker", path: str, max_queue: int):
+        self.broker = broker
+        self.path = path
+        self.max_queue = max_queue
+        self.queue: Deque[bytes] = deque()
+        self.ready = asyncio.Event()
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, frame: bytes) -> None:
+        if len(self.queue) >= self.max_queue:
+            self.queue.popleft()
+            metrics.inc("ipc_frames_dropped_total")
+        self.queue.append(frame)
+        self.ready.set()
+
+    async def _run(self) -> None:
+        try:
+            try:
+                _, self.writer = await asyncio.open_unix_connection(self.path)
+            except ConnectionRefusedError:
+                # Left behind by a worker that died without cleaning up
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+                return
+            while True:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                frames = b"".join(self.queue)
+                self.queue.clear()
+                self.writer.write(frames)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._forget()
+
+    def _forget(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        if self.broker.peers.get(self.path) is self:
+            # Reconnected on a later refresh if the worker is still there
+            del self.broker.peers[self.path]
+
+    def close(self) -> None:
+        self.task.cancel()
+        self._forget()
+
+
+class IPCBroker(Broker):
+    """
+    Bus for workers on one host (e.g. several uvicorn/gunicorn workers).
+
+    Each worker listens on `<IPC_SOCKET_DIR>/<node_id>.sock` and keeps a
+    stream connection to every other socket in that directory. Publishing
+    delivers locally and queues the envelope for each peer, avoiding a
+    network hop through Redis; it never waits on another worker.
+    """
+
+    def __init__(self, manager, socket_dir: str, max_queue: Optional[int] = None):
+        super().__init__(manager)
+        self.socket_dir = socket_dir
+        self.path = os.path.join(socket_dir, f"{manager.node_id}.sock")
+        self.max_queue = max_queue if max_queue is not None else settings.IPC_PEER_QUEUE_SIZE
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.peers: Dict[str, Peer] = {}
+        self._peers_checked = 0.0
+
+    async def start(self) -> None:
+        os.makedirs(self.socket_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_peer, path=self.path)
+
+    async def stop(self) -> None:
+        if self.server:
+            self.server.close()
+        for peer in list(self.peers.values()):
+            peer.close()
+        self.peers.clear()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def publish(self, route: Route, payload: str) -> None:
+        self.manager.deliver(route, payload)
+
+        self.refresh_peers()
+        if not self.peers:
+            return
+        data = join(route, payload).encode()
+        frame = FRAME_HEADER.pack(len(data)) + data
+        for peer in self.peers.values():
+            peer.send(frame)
+
+    def refresh_peers(self) -> None:
+        now = time.monotonic()
+        if now - self._peers_checked < PEER_REFRESH_SECONDS:
+            return
+        self._peers_checked = now
+
+        for name in os.listdir(self.socket_dir):
+            path = os.path.join(self.socket_dir, name)
+            if not name.endswith(".sock") or path == self.path or path in self.peers:
+                continue
+            self.peers[path] = Peer(self, path, self.max_queue)
+
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                data = await reader.readexactly(length)
+                route, payload = decode(data.decode())
+                self.manager.deliver(route, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
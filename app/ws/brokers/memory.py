@@ -0,0 +1,9 @@
+from app.ws.brokers.base import Broker
+from app.ws.envelope import Route
+
+
+class MemoryBroker(Broker):
+    """Single process: publishing is local delivery."""
+
+    async def publish(self, route: Route, payload: str) -> None:
+        self.manager.deliver(route, payload)
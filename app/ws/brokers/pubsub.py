@@ -0,0 +1,74 @@
+import asyncio
+from redis.asyncio import Redis
+from app.core.config import settings
+from app.ws.brokers.base import Broker
+from app.ws.envelope import Route, decode, join
+from app.ws.registry import CLUSTER_CHANNEL, NODE_CHANNEL, NodeRegistry
+
+
+class RedisPubSubBroker(Broker):
+    """
+    Redis pub/sub with node-targeted routing: user-targeted events are
+    published only to the channels of the nodes holding a recipient, true
+    broadcasts go to the shared cluster channel.
+    """
+
+    def __init__(self, manager, redis: Redis):
+        super().__init__(manager)
+        self.redis = redis
+        self.registry = NodeRegistry(redis, manager.node_id, settings.PRESENCE_TTL_SECONDS)
+        self.pubsub = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self.pubsub = self.redis.pubsub()
+        # Cluster-wide channel for true broadcasts plus this node's own channel
+        await self.pubsub.subscribe(CLUSTER_CHANNEL, self.registry.channel)
+
+        # Start listening in background
+        self._tasks.append(asyncio.create_task(self.listen()))
+        self._tasks.append(asyncio.create_task(self.heartbeat()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        for user_id in list(self.manager.active_connections):
+            await self.registry.unregister(user_id)
+        await self.redis.close()
+
+    async def publish(self, route: Route, payload: str) -> None:
+        envelope = join(route, payload)
+        if route.targets is None:
+            await self.redis.publish(CLUSTER_CHANNEL, envelope)
+            return
+
+        # Targeted events only go to the nodes holding a recipient's sockets
+        nodes = await self.registry.nodes_for(route.targets)
+        if self.registry.node_id in nodes:
+            nodes.discard(self.registry.node_id)
+            self.manager.deliver(route, payload)
+        for node in nodes:
+            await self.redis.publish(NODE_CHANNEL.format(node), envelope)
+
+    async def user_connected(self, user_id: int) -> None:
+        await self.registry.register(user_id)
+
+    async def user_disconnected(self, user_id: int) -> None:
+        await self.registry.unregister(user_id)
+
+    async def listen(self) -> None:
+        async for message in self.pubsub.listen():
+            if message["type"] == "message":
+                route, payload = decode(message["data"])
+                self.manager.deliver(route, payload)
+
+    async def heartbeat(self) -> None:
+        """Refresh this node's claim on its users before the registry TTL lapses."""
+        interval = max(settings.PRESENCE_TTL_SECONDS / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.registry.heartbeat(list(self.manager.active_connections))
+            except Exception as e:
+                print(f"Presence heartbeat failed: {e}")
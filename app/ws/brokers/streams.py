@@ -0,0 +1,74 @@
+import asyncio
+from typing import Iterable, List, Optional
+from app.core.config import settings
+from app.ws.brokers.base import Broker
+from app.ws.envelope import CONTROL_EVENTS, Route, decode, join
+from app.ws.streams import EventStream, ORIGIN_ID, with_cursor
+
+
+class StreamsBroker(Broker):
+    """
+    Durable bus on a capped Redis stream. Every node tails the whole stream,
+    and frames carry their entry id so clients can resume from it.
+    """
+
+    supports_replay = True
+
+    def __init__(self, manager, client):
+        super().__init__(manager)
+        self.client = client
+        self.stream = EventStream(client, settings.EVENT_STREAM_MAXLEN)
+        # Last entry delivered to local connections
+        self.last_id = ORIGIN_ID
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.last_id = await self.stream.last_id()
+        self._task = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+        await self.client.close()
+
+    async def publish(self, route: Route, payload: str) -> None:
+        # Delivered (locally too) when the listener reads it back
+        await self.stream.append(join(route, payload))
+
+    async def listen(self) -> None:
+        while True:
+            try:
+                entries = await self.stream.read(self.last_id, block_ms=5000)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Event stream read failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for entry_id, envelope in entries:
+                self.last_id = entry_id
+                route, payload = decode(envelope)
+                self.manager.deliver(route, with_cursor(payload, entry_id))
+
+    async def replay(self, user_id: int, cursor: str, rooms: Iterable[int]) -> Optional[List[str]]:
+        # Anything after this point reaches the (already registered) connection live
+        until = self.last_id
+        try:
+            entries = await self.stream.since(cursor, until, settings.WS_REPLAY_LIMIT)
+        except ValueError:
+            return None
+        if entries is None:
+            return None
+
+        frames = []
+        for entry_id, envelope in entries:
+            route, payload = decode(envelope)
+            if route.event in CONTROL_EVENTS:
+                continue
+            if route.targets is not None:
+                if user_id not in route.targets:
+                    continue
+            elif route.room_id and route.room_id not in rooms:
+                continue
+            frames.append(with_cursor(payload, entry_id))
+        return frames
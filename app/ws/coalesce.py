@@ -0,0 +1,105 @@
+"""
+Coalescing for the chattiest client events before they reach the bus.
+
+- `call.ice`: candidates trickled by one participant of a call within
+  ICE_COALESCE_WINDOW_MS go out as a single frame with a `candidates` list
+  (a lone candidate keeps the plain `candidate` field).
+- `typing.start` / `typing.stop`: at most one event per (sender, target) per
+  TYPING_COALESCE_INTERVAL_MS. Repeats of the state last sent are dropped; a
+  change within the interval is sent when it ends, latest state wins.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.schemas.ws_events import WSEvent
+from app.ws.manager import manager
+
+
+class _Typing:
+    __slots__ = ("sent", "pending")
+
+    def __init__(self, sent: str):
+        # Event name last published, and the latest one held back since
+        self.sent = sent
+        self.pending: Optional[WSEvent] = None
+
+
+class EventCoalescer:
+    def __init__(
+        self,
+        ice_window_ms: Optional[int] = None,
+        typing_interval_ms: Optional[int] = None,
+        publish: Optional[Callable[[WSEvent], Awaitable[None]]] = None,
+    ):
+        self.ice_window = (ice_window_ms if ice_window_ms is not None else settings.ICE_COALESCE_WINDOW_MS) / 1000
+        self.typing_interval = (typing_interval_ms if typing_interval_ms is not None else settings.TYPING_COALESCE_INTERVAL_MS) / 1000
+        self.publish = publish
+        # (call_id, sender_id) -> (payload of the first candidate, recipient ids, candidates)
+        self.ice: Dict[Tuple[Any, int], Tuple[Dict[str, Any], List[int], List[Any]]] = {}
+        # (sender_id, target) -> typing state, for keys published within the interval
+        self.typing: Dict[Tuple[int, Any], _Typing] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def _publish(self, event: WSEvent) -> None:
+        task = asyncio.create_task((self.publish or manager.broadcast)(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def add_ice(self, call_id: Any, sender_id: int, recipient_ids: List[int], payload: Dict[str, Any]) -> None:
+        """Queue one `call.ice` payload (already stamped with `from_user_id`)."""
+        key = (call_id, sender_id)
+        batch = self.ice.get(key)
+        if batch is None:
+            self.ice[key] = (payload, recipient_ids, [payload.get("candidate")])
+            asyncio.get_running_loop().call_later(self.ice_window, self._flush_ice, key)
+            return
+        batch[2].append(payload.get("candidate"))
+        metrics.inc("ws_ice_coalesced_total")
+
+    def _flush_ice(self, key: Tuple[Any, int]) -> None:
+        batch = self.ice.pop(key, None)
+        if batch is None:
+            return
+        payload, recipient_ids, candidates = batch
+        data = dict(payload)
+        if len(candidates) > 1:
+            del data["candidate"]
+            data["candidates"] = candidates
+        self._publish(WSEvent(event="call.ice", data=data, recipient_ids=recipient_ids))
+
+    async def typing_event(self, event: WSEvent) -> None:
+        key = (event.data.get("sender_id"), event.data.get("room_id") or event.data.get("receiver_id"))
+        state = self.typing.get(key)
+        if state is None:
+            self.typing[key] = _Typing(event.event)
+            asyncio.get_running_loop().call_later(self.typing_interval, self._release_typing, key)
+            await (self.publish or manager.broadcast)(event)
+            return
+        metrics.inc("ws_typing_coalesced_total")
+        state.pending = event if event.event != state.sent else None
+
+    def _release_typing(self, key: Tuple[int, Any]) -> None:
+        state = self.typing[key]
+        if state.pending is None:
+            del self.typing[key]
+            return
+        event, state.pending = state.pending, None
+        state.sent = event.event
+        asyncio.get_running_loop().call_later(self.typing_interval, self._release_typing, key)
+        self._publish(event)
+
+    async def close(self) -> None:
+        """Send everything still held back (on shutdown)."""
+        for key in list(self.ice):
+            self._flush_ice(key)
+        for state in self.typing.values():
+            if state.pending is not None:
+                self._publish(state.pending)
+                state.pending = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+coalescer = EventCoalescer()
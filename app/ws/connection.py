@@ -0,0 +1,123 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from fastapi import WebSocket
+from app.core.metrics import metrics
+
+# Overflow policies for a connection's outbound queue
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+# Close code sent to clients that cannot keep up (1013: "try again later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class Connection:
+    """
+    One client socket with its own bounded outbound queue.
+
+    Fan-out only ever calls the non-blocking `send`; a dedicated writer task
+    drains the queue into the socket, so a slow client only delays itself.
+    When the queue is full the overflow policy decides what happens:
+
+    - drop_oldest: discard the oldest queued frame.
+    - coalesce: frames with a coalescing key (presence, typing) replace the
+      queued frame with the same key; otherwise fall back to drop_oldest.
+    - disconnect: close the socket so the client reconnects and resyncs.
+    """
+
+    __slots__ = ("websocket", "user_id", "max_queue", "policy", "queue", "keyed", "ready", "writer", "closed")
+
+    def __init__(self, websocket: WebSocket, user_id: int, max_queue: int, policy: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.max_queue = max_queue
+        self.policy = policy
+        # Entries are [key, data] so a coalesced frame can be updated in place
+        self.queue: Deque[List] = deque()
+        self.keyed: Dict[str, List] = {}
+        self.ready = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def start(self) -> None:
+        self.writer = asyncio.create_task(self._drain())
+
+    def send(self, data: str, key: Optional[str] = None) -> None:
+        if self.closed:
+            return
+
+        if key is not None and self.policy == COALESCE:
+            entry = self.keyed.get(key)
+            if entry is not None:
+                entry[1] = data
+                metrics.inc("ws_send_coalesced_total")
+                return
+
+        if len(self.queue) >= self.max_queue:
+            if self.policy == DISCONNECT:
+                metrics.inc("ws_slow_consumer_disconnects_total")
+                self._close_slow_consumer()
+                return
+            self._pop()
+            metrics.inc("ws_send_dropped_total")
+
+        entry = [key, data]
+        self.queue.append(entry)
+        if key is not None and self.policy == COALESCE:
+            self.keyed[key] = entry
+        metrics.gauge_add("ws_send_queue_depth", 1)
+        self.ready.set()
+
+    def prepend(self, frames: List[str]) -> None:
+        """Queue replayed frames ahead of anything delivered live meanwhile."""
+        if self.closed or not frames:
+            return
+        self.queue.extendleft([None, data] for data in reversed(frames))
+        metrics.gauge_add("ws_send_queue_depth", len(frames))
+        self.ready.set()
+
+    def _pop(self) -> List:
+        entry = self.queue.popleft()
+        key = entry[0]
+        if key is not None and self.keyed.get(key) is entry:
+            del self.keyed[key]
+        metrics.gauge_add("ws_send_queue_depth", -1)
+        return entry
+
+    async def _drain(self) -> None:
+        try:
+            while True:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                _, data = self._pop()
+                await self.websocket.send_text(data)
+                metrics.inc("ws_frames_sent_total")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket is gone; the receive loop will notice and disconnect us
+            self._discard()
+
+    def _close_slow_consumer(self) -> None:
+        self._discard()
+        if self.writer is not None:
+            self.writer.cancel()
+        self.writer = asyncio.create_task(self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE))
+
+    def _discard(self) -> None:
+        self.closed = True
+        metrics.gauge_add("ws_send_queue_depth", -len(self.queue))
+        self.queue.clear()
+        self.keyed.clear()
+
+    async def close(self) -> None:
+        if self.closed:
+            # Already torn down by the writer or the overflow policy
+            return
+        self._discard()
+        if self.writer is not None:
+            self.writer.cancel()
@@ -0,0 +1,96 @@
+"""
+Wire format for events on the broker bus.
+
+An envelope is a small JSON routing header and the client payload joined by
+a newline:
+
+    {"e":"message.receive","t":[2,7],"r":null,"k":null}\n{"event":...,"data":...}
+
+The payload is serialized once by the publishing node and forwarded to
+clients byte-for-byte, so receiving nodes only `json.loads` the header and
+never re-validate the event. Routing data (`recipient_ids`) stays out of the
+payload clients see.
+"""
+import json
+from typing import NamedTuple, Optional
+from app.schemas.ws_events import WSEvent
+
+# Events addressed to one conversation: a room when `room_id` is set,
+# otherwise the receiver and (for multi-device reflection) the sender.
+CONVERSATION_EVENTS = frozenset({
+    "message.receive",
+    "message.update",
+    "message.delete",
+    "message.read_receipt",
+    "message.delivery_receipt",
+    "typing.start",
+    "typing.stop",
+    "room.created",
+})
+
+# Instance-to-instance notifications: handled by `ConnectionManager` listeners
+# and never forwarded to clients.
+ROOM_MEMBERS_CHANGED = "room.members_changed"
+CONTROL_EVENTS = frozenset({ROOM_MEMBERS_CHANGED})
+
+
+class Route(NamedTuple):
+    event: str
+    # Explicit user ids; None means the event is not user-targeted
+    targets: Optional[list[int]]
+    # Room whose local members receive the event when there are no targets
+    room_id: Optional[int]
+    # Coalescing key for slow-consumer queues (presence, typing)
+    key: Optional[str]
+
+
+def coalesce_key(event: WSEvent) -> Optional[str]:
+    """Events where only the latest queued frame per key matters to a client."""
+    if event.event == "presence.update":
+        return f"presence:{event.data.get('user_id')}"
+    if event.event in ("typing.start", "typing.stop"):
+        target = event.data.get("room_id") or event.data.get("receiver_id")
+        return f"typing:{event.data.get('sender_id')}:{target}"
+    return None
+
+
+def route_for(event: WSEvent) -> Route:
+    data = event.data if isinstance(event.data, dict) else {}
+    room_id = data.get("room_id")
+    targets = None
+
+    if event.event == "room.created":
+        room_id = data.get("id")
+
+    if event.recipient_ids:
+        targets = list(event.recipient_ids)
+    elif event.event in CONVERSATION_EVENTS and not room_id:
+        targets = []
+        for uid in (data.get("receiver_id"), data.get("sender_id")):
+            if uid and uid not in targets:
+                targets.append(uid)
+
+    return Route(event.event, targets, room_id, coalesce_key(event))
+
+
+def pack(event: WSEvent) -> tuple[Route, str]:
+    """Return the route and its client payload, serialized once."""
+    return route_for(event), event.model_dump_json(exclude={"recipient_ids"})
+
+
+def join(route: Route, payload: str) -> str:
+    header = json.dumps(
+        {"e": route.event, "t": route.targets, "r": route.room_id, "k": route.key},
+        separators=(",", ":"),
+    )
+    return header + "\n" + payload
+
+
+def encode(event: WSEvent) -> str:
+    return join(*pack(event))
+
+
+def decode(raw: str) -> tuple[Route, str]:
+    header, _, payload = raw.partition("\n")
+    h = json.loads(header)
+    return Route(h["e"], h["t"], h["r"], h["k"]), payload
@@ -1,113 +1,191 @@
 import json
 import asyncio
-from typing import Dict, Optional
+import os
+import socket
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 from fastapi import WebSocket
-from redis.asyncio import Redis
+from sqlalchemy import select
 from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models.chat import ChatRoomMember
 from app.schemas.ws_events import WSEvent
+from app.ws.brokers import Broker, MemoryBroker, create_broker
+from app.ws.connection import Connection
+from app.ws.envelope import CONTROL_EVENTS, ROOM_MEMBERS_CHANGED, Route, pack
+
+# Sent instead of a replay when the client's cursor is no longer retained
+SYNC_RESET = '{"event":"sync.reset","data":{"reason":"cursor_expired"}}'
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
-        self.redis: Redis = None
-        self.pubsub = None
+        # user_id -> every connection that user has open on this instance (one
+        # per tab/device). Tuples are replaced on connect/disconnect rather than
+        # mutated, so fan-out iterates them without copying.
+        self.active_connections: Dict[int, Tuple[Connection, ...]] = {}
+        # Room index for local users only: room_id -> user ids connected here,
+        # plus the reverse mapping so a disconnect can clean up in O(rooms).
+        self.room_members: Dict[int, Set[int]] = {}
+        self.user_rooms: Dict[int, Set[int]] = {}
+        self.node_id = settings.NODE_ID or f"{socket.gethostname()}-{os.getpid()}"
+        # In-process until `start` builds the configured backend
+        self.broker: Broker = MemoryBroker(self)
+        # event -> callbacks run for every delivered envelope of that event
+        self.listeners: Dict[str, List[Callable[[Route, str], None]]] = {}
 
-    async def connect(self, websocket: WebSocket, user_id: int):
+    async def connect(self, websocket: WebSocket, user_id: int, cursor: Optional[str] = None) -> Connection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        connection = Connection(
+            websocket,
+            user_id,
+            max_queue=settings.WS_SEND_QUEUE_SIZE,
+            policy=settings.WS_SEND_OVERFLOW_POLICY,
+        )
+        existing = self.active_connections.get(user_id, ())
+        if not existing:
+            room_ids = await self.load_user_rooms(user_id)
+            # Another device may have connected while the rooms were loading
+            existing = self.active_connections.get(user_id, ())
+            if not existing:
+                self.join_rooms(user_id, room_ids)
+        self.active_connections[user_id] = existing + (connection,)
+        # Live events queue up from here on; replay goes in front of them
+        if cursor and self.broker.supports_replay:
+            await self.replay(connection, cursor)
+        connection.start()
+        if existing:
+            return connection
+        await self.broker.user_connected(user_id)
         # Broadcast presence update
         await self.broadcast(
             WSEvent(event="presence.update", data={"user_id": user_id, "status": "online"})
         )
+        return connection
 
-    async def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+    async def disconnect(self, connection: Connection):
+        await connection.close()
+        user_id = connection.user_id
+        existing = self.active_connections.get(user_id, ())
+        remaining = tuple(c for c in existing if c is not connection)
+        if remaining:
+            self.active_connections[user_id] = remaining
+            return
+        self.active_connections.pop(user_id, None)
+        self.leave_all_rooms(user_id)
+        await self.broker.user_disconnected(user_id)
         # Broadcast presence update
         await self.broadcast(
             WSEvent(event="presence.update", data={"user_id": user_id, "status": "offline"})
         )
 
-    async def send_personal_message(self, message: str, user_id: int):
-        if user_id in self.active_connections:
-            websocket = self.active_connections[user_id]
-            await websocket.send_text(message)
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.active_connections
+
+    async def replay(self, connection: Connection, cursor: str):
+        """Queue the events a reconnecting client missed since `cursor`."""
+        user_id = connection.user_id
+        frames = await self.broker.replay(user_id, cursor, self.user_rooms.get(user_id, ()))
+        if frames is None:
+            connection.prepend([SYNC_RESET])
+            metrics.inc("ws_replay_resets_total")
+            return
+        connection.prepend(frames)
+        metrics.inc("ws_replayed_frames_total", len(frames))
+
+    async def load_user_rooms(self, user_id: int) -> list[int]:
+        """Fetch the ids of every room the user belongs to."""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(ChatRoomMember.chatroom_id).where(ChatRoomMember.user_id == user_id)
+            )
+            return [row[0] for row in result.all()]
+
+    def join_rooms(self, user_id: int, room_ids: Iterable[int]):
+        rooms = self.user_rooms.setdefault(user_id, set())
+        for room_id in room_ids:
+            self.room_members.setdefault(room_id, set()).add(user_id)
+            rooms.add(room_id)
+
+    def leave_all_rooms(self, user_id: int):
+        for room_id in self.user_rooms.pop(user_id, ()):
+            members = self.room_members.get(room_id)
+            if members is None:
+                continue
+            members.discard(user_id)
+            if not members:
+                del self.room_members[room_id]
+
+    def add_room_members(self, room_id: int, user_ids: Iterable[int]):
+        """Index new room members that are connected to this instance."""
+        for uid in user_ids:
+            if uid in self.active_connections:
+                self.join_rooms(uid, (room_id,))
+
+    def remove_room_members(self, room_id: int, user_ids: Iterable[int]):
+        members = self.room_members.get(room_id)
+        for uid in user_ids:
+            rooms = self.user_rooms.get(uid)
+            if rooms is not None:
+                rooms.discard(room_id)
+            if members is not None:
+                members.discard(uid)
+        if members is not None and not members:
+            del self.room_members[room_id]
+
+    def add_listener(self, event: str, callback: Callable[[Route, str], None]):
+        """Run `callback(route, payload)` whenever an `event` envelope arrives here."""
+        self.listeners.setdefault(event, []).append(callback)
+
+    def send_personal_message(self, message: str, user_id: int, key: Optional[str] = None):
+        for connection in self.active_connections.get(user_id, ()):
+            connection.send(message, key)
 
     async def broadcast(self, message: WSEvent):
-        """Publish message to Redis to reach all instances"""
-        if self.redis:
-            await self.redis.publish("chat:events", message.model_dump_json())
-        else:
-            # Fallback to local broadcast if Redis is not active
-            await self.local_broadcast(message.model_dump_json())
-
-    async def local_broadcast(self, data: str):
-        event = WSEvent.model_validate_json(data)
-
-        if event.recipient_ids:
-            for uid in event.recipient_ids:
-                if uid in self.active_connections:
-                    try:
-                        await self.active_connections[uid].send_text(data)
-                    except Exception:
-                        pass
+        """Publish message through the broker to reach all instances"""
+        route, payload = pack(message)
+        await self.broker.publish(route, payload)
+
+    def deliver(self, route: Route, payload: str):
+        """Hand a pre-encoded payload to the local connections the route selects."""
+        for callback in self.listeners.get(route.event, ()):
+            callback(route, payload)
+
+        if route.event == "room.created" and route.targets:
+            self.add_room_members(route.room_id, route.targets)
+
+        if route.event in CONTROL_EVENTS:
+            if route.event == ROOM_MEMBERS_CHANGED:
+                data = json.loads(payload)["data"]
+                self.add_room_members(route.room_id, data.get("added", ()))
+                self.remove_room_members(route.room_id, data.get("removed", ()))
             return
-        
-        # If it's a direct message/typing/read-receipt/update/delete, check if recipient is local
-        if event.event in ["message.receive", "typing.start", "typing.stop", "message.read_receipt", "message.update", "message.delete", "room.created"]:
-            receiver_id = event.data.get("receiver_id")
-            room_id = event.data.get("room_id")
-            
-            # If room_id exists, broadcast to all active connections (simple approach for now)
-            # Ideal: broadcast only to room members
-            if room_id:
-                for connection in self.active_connections.values():
-                    # Optimization: In a real app we would track which user is in which room
-                    try:
-                        await connection.send_text(data)
-                    except Exception:
-                        pass
-                return
-
-            if receiver_id and receiver_id in self.active_connections:
-                await self.active_connections[receiver_id].send_text(data)
-                
-            # Also send to sender (for update/delete reflection on other devices)
-            sender_id = event.data.get("sender_id")
-            if sender_id and sender_id in self.active_connections:
-                await self.active_connections[sender_id].send_text(data)
-                return
-        
-        # If it's a broadcast (like presence), send to all local connections
-        for connection in self.active_connections.values():
-            try:
-                await connection.send_text(data)
-            except Exception:
-                pass # Handle stale connections
-
-    async def start_redis(self):
-        if not settings.REDIS_URL:
-            print("Redis not configured, using in-memory broadcast.")
+
+        # Sends below only enqueue onto each connection, nothing awaits
+        if route.targets is not None:
+            for uid in route.targets:
+                self.send_personal_message(payload, uid, route.key)
             return
 
+        # Room events only go to the room's members connected to this instance
+        if route.room_id:
+            for uid in self.room_members.get(route.room_id, ()):
+                self.send_personal_message(payload, uid, route.key)
+            return
+
+        # If it's a broadcast (like presence), send to all local connections
+        for connections in self.active_connections.values():
+            for connection in connections:
+                connection.send(payload, route.key)
+
+    async def start(self):
         try:
-            self.redis = Redis.from_url(settings.REDIS_URL, decode_responses=True)
-            self.pubsub = self.redis.pubsub()
-            await self.pubsub.subscribe("chat:events")
-            
-            # Start listening in background
-            asyncio.create_task(self.redis_listener())
+            self.broker = create_broker(self)
+            await self.broker.start()
         except Exception as e:
-            print(f"Failed to connect to Redis: {e}. Using in-memory broadcast.")
-            self.redis = None
+            print(f"Failed to start {settings.BROKER_BACKEND or 'default'} broker: {e}. Using in-memory broadcast.")
+            self.broker = MemoryBroker(self)
 
-    async def redis_listener(self):
-        if not self.pubsub:
-            return
-            
-        async for message in self.pubsub.listen():
-            if message["type"] == "message":
-                data = message["data"]
-                await self.local_broadcast(data)
+    async def stop(self):
+        await self.broker.stop()
 
 manager = ConnectionManager()
@@ -0,0 +1,51 @@
+import time
+from typing import Iterable, Set
+from redis.asyncio import Redis
+
+USER_NODES_KEY = "chat:user_nodes:{}"
+NODE_CHANNEL = "chat:node:{}"
+CLUSTER_CHANNEL = "chat:events"
+
+
+class NodeRegistry:
+    """
+    Which instance holds which user's sockets, kept in Redis.
+
+    Each user has a sorted set of node ids scored by the time that node's
+    claim expires. Nodes refresh their claims on a heartbeat, so a crashed
+    node's entries age out after `ttl` seconds even if other nodes keep the
+    key itself alive.
+    """
+
+    def __init__(self, redis: Redis, node_id: str, ttl: int):
+        self.redis = redis
+        self.node_id = node_id
+        self.ttl = ttl
+
+    @property
+    def channel(self) -> str:
+        return NODE_CHANNEL.format(self.node_id)
+
+    async def register(self, user_id: int) -> None:
+        await self.heartbeat((user_id,))
+
+    async def unregister(self, user_id: int) -> None:
+        await self.redis.zrem(USER_NODES_KEY.format(user_id), self.node_id)
+
+    async def heartbeat(self, user_ids: Iterable[int]) -> None:
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for uid in user_ids:
+                key = USER_NODES_KEY.format(uid)
+                pipe.zadd(key, {self.node_id: now + self.ttl})
+                pipe.zremrangebyscore(key, "-inf", now)
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def nodes_for(self, user_ids: Iterable[int]) -> Set[str]:
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for uid in user_ids:
+                pipe.zrangebyscore(USER_NODES_KEY.format(uid), now, "+inf")
+            results = await pipe.execute()
+        return {node for nodes in results for node in nodes}
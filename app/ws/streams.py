@@ -0,0 +1,127 @@
+"""
+Durable event bus on Redis Streams.
+
+Every envelope is appended to one capped stream; each node tails it with
+XREAD and stamps the entry id onto the client payload as `cursor`. A client
+that reconnects with `?cursor=<id>` gets the events it missed replayed from
+the stream instead of refetching history.
+"""
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+STREAM_KEY = "chat:stream"
+# First id of an empty stream; everything sorts after it
+ORIGIN_ID = "0-0"
+
+
+def parse_id(entry_id: str) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def with_cursor(payload: str, entry_id: str) -> str:
+    """Append the stream id to an already-encoded `{"event":..,"data":..}` payload."""
+    return payload[:-1] + ',"cursor":"' + entry_id + '"}'
+
+
+class InMemoryStreams:
+    """
+    In-process stand-in for the subset of the Redis stream commands used by
+    `EventStream`. Backs the streams broker when REDIS_URL is unset (single
+    instance) and keeps tests independent of a Redis server.
+    """
+
+    def __init__(self):
+        self.streams: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        self.last_ids: Dict[str, Tuple[int, int]] = {}
+        self.changed = asyncio.Condition()
+
+    async def xadd(self, name: str, fields: Dict[str, Any], maxlen: Optional[int] = None, approximate: bool = True) -> str:
+        ms = int(time.time() * 1000)
+        last_ms, last_seq = self.last_ids.get(name, (0, 0))
+        new_id = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+        self.last_ids[name] = new_id
+        entry_id = f"{new_id[0]}-{new_id[1]}"
+        entries = self.streams.setdefault(name, [])
+        entries.append((entry_id, dict(fields)))
+        if maxlen is not None and len(entries) > maxlen:
+            del entries[: len(entries) - maxlen]
+        async with self.changed:
+            self.changed.notify_all()
+        return entry_id
+
+    def _after(self, name: str, entry_id: str) -> List[Tuple[str, Dict[str, Any]]]:
+        floor = parse_id(entry_id)
+        return [e for e in self.streams.get(name, []) if parse_id(e[0]) > floor]
+
+    async def xrange(self, name: str, min: str = "-", max: str = "+", count: Optional[int] = None):
+        entries = self.streams.get(name, [])
+        if min.startswith("("):
+            entries = self._after(name, min[1:])
+        elif min != "-":
+            floor = parse_id(min)
+            entries = [e for e in entries if parse_id(e[0]) >= floor]
+        if max != "+":
+            ceiling = parse_id(max)
+            entries = [e for e in entries if parse_id(e[0]) <= ceiling]
+        return entries[:count] if count else list(entries)
+
+    async def xrevrange(self, name: str, max: str = "+", min: str = "-", count: Optional[int] = None):
+        entries = list(reversed(await self.xrange(name, min, max)))
+        return entries[:count] if count else entries
+
+    async def xread(self, streams: Dict[str, str], count: Optional[int] = None, block: Optional[int] = None):
+        (name, last_id), = streams.items()
+        async with self.changed:
+            entries = self._after(name, last_id)
+            if not entries and block is not None:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), block / 1000 if block else None)
+                except asyncio.TimeoutError:
+                    return []
+                entries = self._after(name, last_id)
+        if not entries:
+            return []
+        return [[name, entries[:count] if count else entries]]
+
+    async def close(self):
+        pass
+
+
+class EventStream:
+    """Capped stream of bus envelopes on a Redis (or Redis-compatible) client."""
+
+    def __init__(self, client, maxlen: int, key: str = STREAM_KEY):
+        self.client = client
+        self.maxlen = maxlen
+        self.key = key
+
+    async def append(self, envelope: str) -> str:
+        return await self.client.xadd(self.key, {"env": envelope}, maxlen=self.maxlen, approximate=True)
+
+    async def last_id(self) -> str:
+        entries = await self.client.xrevrange(self.key, count=1)
+        return entries[0][0] if entries else ORIGIN_ID
+
+    async def read(self, after_id: str, block_ms: int, count: int = 500) -> List[Tuple[str, str]]:
+        response = await self.client.xread({self.key: after_id}, count=count, block=block_ms)
+        if not response:
+            return []
+        return [(entry_id, fields["env"]) for entry_id, fields in response[0][1]]
+
+    async def since(self, cursor: str, until: str, limit: int) -> Optional[List[Tuple[str, str]]]:
+        """
+        Entries after `cursor` up to and including `until`, or None when the
+        cursor has fallen out of retention (or more than `limit` entries were
+        missed) and the client must resync from history instead.
+        """
+        first = await self.client.xrange(self.key, count=1)
+        if first and parse_id(cursor) < parse_id(first[0][0]):
+            return None
+        if parse_id(cursor) >= parse_id(until):
+            return []
+        entries = await self.client.xrange(self.key, min=f"({cursor}", max=until, count=limit + 1)
+        if len(entries) > limit:
+            return None
+        return [(entry_id, fields["env"]) for entry_id, fields in entries]
@@ -0,0 +1,177 @@
+"""
+Benchmark the message lookup indexes (alembic revisions c3d9a1f5e842 and
+e8a2f4c61d35).
+
+Seeds a database with synthetic users, rooms and messages, then runs the
+history, unread and call-eligibility queries without the composite indexes
+and again with them, printing each query plan and its median latency.
+
+    python benchmarks/message_indexes.py --messages 2000000
+    python benchmarks/message_indexes.py --url postgresql+psycopg://localhost/bench
+
+The default target is a throwaway SQLite file; point --url at a scratch
+Postgres database to see the planner's real choices (it is wiped).
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import and_, create_engine, func, insert, select, text
+
+from app.db.base import Base  # registers every table the models reference
+from app.models.chat import ChatRoom, ChatRoomMember
+from app.models.conversation import Conversation
+from app.models.message import Message, MessageType
+from app.models.user import User
+
+NEW_INDEXES = {
+    "ix_message_room_id_timestamp",
+    "ix_message_sender_receiver_timestamp",
+    "ix_message_unread_receiver",
+    "ix_message_conversation_id_timestamp",
+}
+CHUNK = 50_000
+# The user pair the DM queries look at; seeded as conversation 1
+ME, PEER = 7, 11
+
+
+def seed(engine, users: int, rooms: int, conversations: int, messages: int) -> None:
+    rng = random.Random(42)
+    start = datetime.utcnow() - timedelta(days=365)
+    pairs = [(ME, PEER)]
+    seen = set(pairs)
+    while len(pairs) < conversations:
+        pair = tuple(sorted(rng.sample(range(1, users + 1), 2)))
+        if pair not in seen:
+            seen.add(pair)
+            pairs.append(pair)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {"id": i, "email": f"user{i}@bench.local", "hashed_password": "x", "full_name": f"User {i}"}
+            for i in range(1, users + 1)
+        ])
+        conn.execute(insert(ChatRoom), [{"id": i, "name": f"Room {i}", "is_group": True} for i in range(1, rooms + 1)])
+        conn.execute(insert(ChatRoomMember), [
+            {"chatroom_id": room_id, "user_id": user_id, "last_read_at": start + timedelta(days=300)}
+            for room_id in range(1, rooms + 1)
+            for user_id in rng.sample(range(1, users + 1), 20)
+        ])
+        conn.execute(insert(Conversation), [
+            {"id": i, "low_id": low, "high_id": high} for i, (low, high) in enumerate(pairs, start=1)
+        ])
+
+    seconds_per_row = 365 * 86400 / messages
+    for offset in range(0, messages, CHUNK):
+        rows = []
+        for n in range(offset, min(offset + CHUNK, messages)):
+            in_room = rng.random() < 0.5
+            conversation_id = None if in_room else rng.randint(1, len(pairs))
+            if in_room:
+                sender, receiver = rng.randint(1, users), None
+            else:
+                sender, receiver = rng.sample(pairs[conversation_id - 1], 2)
+            rows.append({
+                "content": "x" * 40,
+                "sender_id": sender,
+                "receiver_id": receiver,
+                "room_id": rng.randint(1, rooms) if in_room else None,
+                "conversation_id": conversation_id,
+                "message_type": MessageType.TEXT,
+                "timestamp": start + timedelta(seconds=n * seconds_per_row),
+                "is_read": rng.random() < 0.9,
+                "status": "sent",
+            })
+        with engine.begin() as conn:
+            conn.execute(insert(Message), rows)
+        print(f"  seeded {min(offset + CHUNK, messages):,} messages", flush=True)
+
+
+def queries():
+    """The statements the app runs (first history pages as built by keyset_page)."""
+    me, room_id, conversation_id = ME, 3, 1
+    return {
+        "room history": select(Message).where(Message.room_id == room_id)
+        .order_by(Message.timestamp.desc(), Message.id.desc()).limit(50),
+        "private history": select(Message).where(Message.conversation_id == conversation_id)
+        .order_by(Message.timestamp.desc(), Message.id.desc()).limit(50),
+        "unread DMs": select(Message.sender_id, func.count(Message.id)).where(
+            and_(Message.receiver_id == me, Message.is_read == False)
+        ).group_by(Message.sender_id),
+        "unread room count": select(func.count(Message.id)).where(
+            and_(Message.room_id == room_id, Message.timestamp > datetime.utcnow() - timedelta(days=65))
+        ),
+        # A DM call is allowed once the pair has a conversation
+        "can_initiate_call": select(Conversation.id).where(Conversation.low_id == ME, Conversation.high_id == PEER),
+    }
+
+
+def explain(conn, stmt) -> str:
+    compiled = stmt.compile(conn, compile_kwargs={"literal_binds": True})
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    rows = conn.execute(text(prefix + str(compiled))).all()
+    return "\n".join("    " + " ".join(str(c) for c in row) for row in rows)
+
+
+def measure(engine, stmts, repeat: int) -> dict:
+    results = {}
+    with engine.connect() as conn:
+        for name, stmt in stmts.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                conn.execute(stmt).all()
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = statistics.median(timings)
+            print(f"  {name}: {results[name]:.2f} ms (median of {repeat})")
+            print(explain(conn, stmt))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="sqlite:///bench_messages.db")
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--rooms", type=int, default=1_000)
+    parser.add_argument("--conversations", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for index in Message.__table__.indexes:
+            if index.name in NEW_INDEXES:
+                index.drop(conn)
+
+    print(f"Seeding {args.messages:,} messages into {engine.url.render_as_string(hide_password=True)}")
+    seed(engine, args.users, args.rooms, args.conversations, args.messages)
+    stmts = queries()
+
+    print("\nWithout composite indexes:")
+    before = measure(engine, stmts, args.repeat)
+
+    print("\nCreating indexes...")
+    with engine.begin() as conn:
+        for index in Message.__table__.indexes:
+            if index.name in NEW_INDEXES:
+                index.create(conn)
+        conn.execute(text("ANALYZE"))
+
+    print("\nWith composite indexes:")
+    after = measure(engine, stmts, args.repeat)
+
+    print("\nSummary (median ms):")
+    for name in stmts:
+        print(f"  {name:<20} {before[name]:>10.2f} -> {after[name]:>8.2f}  ({before[name] / max(after[name], 1e-6):.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -403,16 +403,20 @@ export const CallProvider = ({ children }: { children: ReactNode }) => {
       }
 
       if (msg.event === 'call.ice') {
-        const candidate = data.candidate as RTCIceCandidateJSON | undefined;
-        if (!candidate) return;
+        // The server batches candidates trickled close together
+        const candidates = ((data.candidates as RTCIceCandidateJSON[] | undefined) ??
+          (data.candidate ? [data.candidate as RTCIceCandidateJSON] : [])).filter(Boolean);
+        if (!candidates.length) return;
         const pc = pcRef.current;
         if (!pc || !pc.remoteDescription) {
-          pendingRemoteCandidatesRef.current.push(candidate);
+          pendingRemoteCandidatesRef.current.push(...candidates);
           return;
         }
-        pc.addIceCandidate(candidate).catch((err) => {
-          toast.error(`ICE candidate failed: ${getErrorMessage(err)}`);
-        });
+        for (const candidate of candidates) {
+          pc.addIceCandidate(candidate).catch((err) => {
+            toast.error(`ICE candidate failed: ${getErrorMessage(err)}`);
+          });
+        }
         return;
       }
 
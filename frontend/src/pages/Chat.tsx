@@ -113,6 +113,19 @@ const Chat: React.FC = () => {
 
   // Subscribe to WS events
   useEffect(() => {
+    // Receipts cover a list of message ids or everything up to a watermark
+    // eslint-disable-next-line @typescript-eslint/no-explicit-any
+    const receiptCovers = (data: any, m: Message) => {
+        if (data.up_to_id != null) {
+            // A watermark only concerns the chat it was set in
+            const sameChat = data.room_id != null
+                ? currentChat?.type === 'room' && data.room_id === currentChat.id
+                : currentChat?.type === 'user' && data.reader_id === currentChat.id;
+            return sameChat && m.sender_id === currentUserId && m.id <= data.up_to_id;
+        }
+        return (data.message_ids ?? [data.message_id]).includes(m.id);
+    };
+
     const unsubscribe = subscribe((event) => {
         if (event.event === 'message.receive') {
             const msg = event.data as Message;
@@ -180,11 +193,11 @@ const Chat: React.FC = () => {
         } else if (event.event === 'message.delivery_receipt') {
             // eslint-disable-next-line @typescript-eslint/no-explicit-any
             const data = event.data as any;
-            setMessages(prev => prev.map(m => m.id === data.message_id ? { ...m, status: 'delivered' } : m));
+            setMessages(prev => prev.map(m => receiptCovers(data, m) && m.status !== 'read' ? { ...m, status: 'delivered' } : m));
         } else if (event.event === 'message.read_receipt') {
             // eslint-disable-next-line @typescript-eslint/no-explicit-any
             const data = event.data as any;
-            setMessages(prev => prev.map(m => m.id === data.message_id ? { ...m, status: 'read', is_read: true } : m));
+            setMessages(prev => prev.map(m => receiptCovers(data, m) ? { ...m, status: 'read', is_read: true } : m));
         } else if (event.event === 'message.reaction') {
             // eslint-disable-next-line @typescript-eslint/no-explicit-any
             const data = event.data as any;
@@ -243,8 +256,6 @@ const Chat: React.FC = () => {
             delete newCounts.rooms[item.id];
             return newCounts;
         });
-        // Notify backend that we read the room
-        send('message.read', { room_id: item.id });
     }
 
     // Load History
@@ -252,6 +263,11 @@ const Chat: React.FC = () => {
         const { data } = await chatApi.getHistory(type, item.id);
         setMessages(data);
         if (data.length < 50) setHasMore(false);
+        // Notify backend that we read everything up to the latest message
+        if (data.length > 0) {
+            const upToId = data[data.length - 1].id;
+            send('message.read', type === 'room' ? { up_to_id: upToId, room_id: item.id } : { up_to_id: upToId, sender_id: item.id });
+        }
     } catch (e) { console.error(e); }
     finally { setIsHistoryLoading(false); }
   };
@@ -265,7 +281,7 @@ const Chat: React.FC = () => {
       setIsLoadingMore(true);
       
       try {
-        const { data } = await chatApi.getHistory(currentChat.type, currentChat.id, messages.length, 50);
+        const { data } = await chatApi.getHistory(currentChat.type, currentChat.id, messages[0]?.id, 50);
         
         if (data.length > 0) {
             setMessages(prev => [...data, ...prev]);
@@ -1,5 +1,5 @@
 import axios, { type AxiosInstance, type InternalAxiosRequestConfig } from 'axios';
-import type { User, ChatRoom, Message, UnreadCounts } from '../types';
+import type { User, ChatRoom, Message, UnreadCounts, InboxItem } from '../types';
 
 const api: AxiosInstance = axios.create({
   baseURL: '/api/v1',
@@ -34,8 +34,10 @@ export const chatApi = {
   getRooms: () => api.get<ChatRoom[]>('/chat/rooms'),
   createRoom: (name: string, memberIds: number[]) => api.post<ChatRoom>('/chat/rooms', { name, member_ids: memberIds }),
   getUnreadCounts: () => api.get<UnreadCounts>('/chat/unread'),
-  getHistory: (type: 'user' | 'room', id: number, skip=0, limit=50) => 
-    api.get<Message[]>(`/chat/history/${type}/${id}?skip=${skip}&limit=${limit}`),
+  getInbox: (cursor?: string, limit=50) =>
+    api.get<InboxItem[]>('/chat/inbox', { params: { limit, cursor } }),
+  getHistory: (type: 'user' | 'room', id: number, beforeId?: number, limit=50) => 
+    api.get<Message[]>(`/chat/history/${type}/${id}`, { params: { limit, before_id: beforeId } }),
   getIceServers: () => api.get<{ ice_servers: RTCIceServer[] }>('/webrtc/ice-servers'),
   uploadFile: (file: File) => {
     const formData = new FormData();
@@ -35,3 +35,12 @@ export interface UnreadCounts {
   users: Record<number, number>;
   rooms: Record<number, number>;
 }
+
+export interface InboxItem {
+  kind: 'user' | 'room';
+  id: number;
+  name?: string;
+  last_activity?: string;
+  last_message?: Message;
+  unread: number;
+}
@@ -29,6 +29,10 @@ async def prepare_db():
     async with engine_test.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
 
+@pytest.fixture
+def session_factory(prepare_db):
+    return TestingSessionLocal
+
 @pytest.fixture
 async def db_session(prepare_db) -> AsyncGenerator[AsyncSession, None]:
     async with TestingSessionLocal() as session:
@@ -40,8 +44,7 @@ async def client(db_session) -> AsyncGenerator[AsyncClient, None]:
     from app.ws.manager import manager
     from unittest.mock import AsyncMock
     
-    manager.start_redis = AsyncMock()
-    manager.redis = AsyncMock()
+    manager.start = AsyncMock()
     manager.broadcast = AsyncMock()
 
     async def override_get_db():
@@ -8,6 +8,15 @@ async def test_root(client: AsyncClient):
     assert response.status_code == 200
     assert response.json() == {"message": "Welcome to FastSock Real-time Chat API"}
 
+def test_ws_rejects_bad_token():
+    from fastapi.testclient import TestClient
+    from starlette.websockets import WebSocketDisconnect
+
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with TestClient(app).websocket_connect("/api/v1/ws/chat?token=bad") as ws:
+            ws.receive_text()
+    assert closed.value.code == 1008
+
 @pytest.mark.anyio
 async def test_create_user(client: AsyncClient):
     # Use unique email to avoid conflict
@@ -91,3 +100,261 @@ async def test_webrtc_ice_servers_requires_auth(client: AsyncClient):
     data = res.json()
     assert "ice_servers" in data
     assert isinstance(data["ice_servers"], list)
+
+
+@pytest.mark.anyio
+async def test_cached_principal_is_revoked_on_deactivation(client: AsyncClient, db_session):
+    import time
+    from app.core import security
+    from app.core.metrics import metrics
+    from app.models.user import User
+
+    admin = User(email=f"admin_{time.time()}@example.com", hashed_password="x", is_superuser=True)
+    user = User(email=f"cached_{time.time()}@example.com", hashed_password="x", full_name="Cached")
+    db_session.add_all([admin, user])
+    await db_session.commit()
+    admin_headers = {"Authorization": f"Bearer {security.create_access_token({'sub': str(admin.id)})}"}
+    headers = {"Authorization": f"Bearer {security.create_access_token({'sub': str(user.id)})}"}
+
+    hits = metrics.counters["principal_cache_hits_total"]
+    for _ in range(3):
+        res = await client.get("/api/v1/users/me", headers=headers)
+        assert res.status_code == 200
+        assert res.json()["email"] == user.email
+    assert metrics.counters["principal_cache_hits_total"] - hits == 2
+
+    res = await client.post(f"/api/v1/users/{user.id}/deactivate", headers=headers)
+    assert res.status_code == 403
+    res = await client.post(f"/api/v1/users/{user.id}/deactivate", headers=admin_headers)
+    assert res.status_code == 200
+    assert res.json()["is_active"] is False
+
+    res = await client.get("/api/v1/users/me", headers=headers)
+    assert res.status_code == 400
+
+@pytest.mark.anyio
+async def test_upload_streams_to_disk_and_enforces_size_cap(client: AsyncClient, tmp_path, monkeypatch):
+    from app.services import uploads
+
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(uploads.settings, "UPLOAD_MAX_BYTES", 4096)
+    monkeypatch.setattr(uploads.settings, "UPLOAD_CHUNK_SIZE", 1000)
+
+    response = await client.post("/api/v1/utils/upload", files={"file": ("pic.png", b"x" * 4096, "image/png")})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["size"] == 4096 and data["filename"] == "pic.png"
+    stored = tmp_path / data["url"].rsplit("/", 1)[1]
+    assert stored.read_bytes() == b"x" * 4096
+    assert [p.name for p in tmp_path.iterdir()] == [stored.name]
+
+    # Same content, same object and URL
+    again = await client.post("/api/v1/utils/upload", files={"file": ("copy.PNG", b"x" * 4096, "image/png")})
+    assert again.json()["url"] == data["url"] and again.json()["filename"] == "copy.PNG"
+    assert data["url"] == f"/static/uploads/{data['sha256']}.png"
+
+    response = await client.post("/api/v1/utils/upload", files={"file": ("big.png", b"x" * 4097, "image/png")})
+    assert response.status_code == 413
+
+    # Without a Content-Length the cap is applied while the body streams in
+    async def body():
+        yield b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a\"\r\n\r\n"
+        for _ in range(100):
+            yield b"x" * 1024
+
+    response = await client.post(
+        "/api/v1/utils/upload", content=body(), headers={"Content-Type": "multipart/form-data; boundary=b"}
+    )
+    assert response.status_code == 413
+    assert len(list(tmp_path.iterdir())) == 1
+
+@pytest.mark.anyio
+async def test_upload_references_and_garbage_collection(client: AsyncClient, db_session, session_factory, tmp_path, monkeypatch):
+    import time
+    from datetime import datetime
+    from app.core import security
+    from app.models.message import MessageType
+    from app.models.upload import UploadObject
+    from app.models.user import User
+    from app.services import uploads
+    from app.services.persistence import MessageWriter
+
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(tmp_path))
+    sender = User(email=f"uploader_{time.time()}@example.com", hashed_password="x", full_name="Uploader")
+    peer = User(email=f"viewer_{time.time()}@example.com", hashed_password="x", full_name="Viewer")
+    db_session.add_all([sender, peer])
+    await db_session.commit()
+    headers = {"Authorization": f"Bearer {security.create_access_token({'sub': str(sender.id)})}"}
+
+    kept = (await client.post("/api/v1/utils/upload", files={"file": ("a.png", b"kept", "image/png")})).json()
+    unused = (await client.post("/api/v1/utils/upload", files={"file": ("b.png", b"unused", "image/png")})).json()
+
+    writer = MessageWriter(session_factory, flush_interval_ms=1)
+    message_ids = [
+        await writer.save(content=kept["url"], sender_id=sender.id, receiver_id=peer.id,
+                          message_type=MessageType.IMAGE, timestamp=datetime.utcnow(), is_read=False, status="sent")
+        for _ in range(2)
+    ]
+    await writer.close()
+    obj = await db_session.get(UploadObject, kept["sha256"], populate_existing=True)
+    assert obj.ref_count == 2
+
+    response = await client.delete(f"/api/v1/chat/messages/{message_ids[0]}", headers=headers)
+    assert response.status_code == 200, response.text
+    obj = await db_session.get(UploadObject, kept["sha256"], populate_existing=True)
+    assert obj.ref_count == 1
+
+    # Earlier tests may have left unreferenced uploads behind too
+    assert await uploads.collect_garbage(db_session, grace_seconds=-60) >= 1
+    assert [p.name for p in tmp_path.iterdir()] == [f"{kept['sha256']}.png"]
+    assert await db_session.get(UploadObject, unused["sha256"], populate_existing=True) is None
+
+    response = await client.post("/api/v1/utils/uploads/gc", headers=headers)
+    assert response.status_code == 403
+
+@pytest.mark.anyio
+async def test_resumable_upload(client: AsyncClient, db_session, tmp_path, monkeypatch):
+    import os
+    import time
+    from app.core import security
+    from app.models.user import User
+    from app.services import upload_sessions, uploads
+
+    store, sessions = tmp_path / "store", tmp_path / "sessions"
+    store.mkdir()
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(store))
+    monkeypatch.setattr(uploads.settings, "UPLOAD_SESSION_DIR", str(sessions))
+    monkeypatch.setattr(uploads.settings, "UPLOAD_CHUNK_SIZE", 4)
+    user = User(email=f"resumer_{time.time()}@example.com", hashed_password="x", full_name="Resumer")
+    db_session.add(user)
+    await db_session.commit()
+    headers = {"Authorization": f"Bearer {security.create_access_token({'sub': str(user.id)})}"}
+    payload = b"0123456789abcdef"
+
+    response = await client.post("/api/v1/utils/uploads", json={"filename": "clip.mp4", "content_type": "video/mp4", "size": 16}, headers=headers)
+    assert response.status_code == 200
+    upload_id = response.json()["upload_id"]
+    url = f"/api/v1/utils/uploads/{upload_id}"
+
+    response = await client.put(url, params={"offset": 0}, content=payload[:10], headers=headers)
+    assert response.json()["offset"] == 10
+    response = await client.put(url, params={"offset": 4}, content=payload[4:], headers=headers)
+    assert response.status_code == 409 and response.json()["detail"]["offset"] == 10
+    response = await client.post(f"{url}/complete", headers=headers)
+    assert response.status_code == 409
+
+    assert (await client.get(url, headers=headers)).json()["offset"] == 10
+    response = await client.put(url, params={"offset": 10}, content=payload[10:] + b"!", headers=headers)
+    assert response.status_code == 413
+    response = await client.put(url, params={"offset": 10}, content=payload[10:], headers=headers)
+    assert response.json()["offset"] == 16
+
+    response = await client.post(f"{url}/complete", headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["filename"] == "clip.mp4" and data["size"] == 16
+    assert (store / f"{data['sha256']}.mp4").read_bytes() == payload
+    assert os.listdir(sessions) == []
+    assert (await client.get(url, headers=headers)).status_code == 404
+
+    # Idle sessions are swept
+    response = await client.post("/api/v1/utils/uploads", json={"filename": "x", "size": 5}, headers=headers)
+    assert len(os.listdir(sessions)) == 2
+    assert upload_sessions._sweep(-1) == 1
+    assert os.listdir(sessions) == []
+
+    response = await client.post("/api/v1/utils/uploads", json={"filename": "huge", "size": 1 << 40}, headers=headers)
+    assert response.status_code == 413
+
+@pytest.mark.anyio
+async def test_image_upload_previews(client: AsyncClient, db_session, session_factory, tmp_path, monkeypatch):
+    import io
+    import time
+    from datetime import datetime
+    from PIL import Image
+    from app.core import security
+    from app.models.message import MessageType
+    from app.models.user import User
+    from app.services import previews, uploads
+    from app.services.persistence import MessageWriter
+
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(previews, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(previews.settings, "PREVIEW_WAIT_MS", 60_000)
+    pipeline = previews.PreviewPipeline(workers=1, session_factory=session_factory)
+    monkeypatch.setattr(previews, "previews", pipeline)
+    for module in ("app.api.api_v1.endpoints.upload", "app.api.api_v1.endpoints.chat", "app.services.persistence"):
+        monkeypatch.setattr(f"{module}.previews", pipeline)
+
+    image = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 40, 40)).save(image, "PNG")
+    try:
+        response = await client.post("/api/v1/utils/upload", files={"file": ("red.png", image.getvalue(), "image/png")})
+        assert response.status_code == 200
+        url, preview = response.json()["url"], response.json()["preview"]
+        assert preview["width"] == 640 and preview["height"] == 480
+        assert len(preview["blurhash"]) == 28
+        with Image.open(tmp_path / preview["thumbnail_url"].rsplit("/", 1)[1]) as thumb:
+            assert thumb.format == "WEBP" and thumb.size == (320, 240)
+
+        # Not an image despite its content type: no preview
+        response = await client.post("/api/v1/utils/upload", files={"file": ("bad.png", b"not a png", "image/png")})
+        assert response.json()["preview"] is None
+
+        sender = User(email=f"shutter_{time.time()}@example.com", hashed_password="x", full_name="Shutter")
+        peer = User(email=f"viewer_{time.time()}@example.com", hashed_password="x", full_name="Viewer")
+        db_session.add_all([sender, peer])
+        await db_session.commit()
+        headers = {"Authorization": f"Bearer {security.create_access_token({'sub': str(peer.id)})}"}
+        writer = MessageWriter(session_factory, flush_interval_ms=1, recent=None)
+        for content, message_type in (("hello", MessageType.TEXT), (url, MessageType.IMAGE)):
+            await writer.save(content=content, sender_id=sender.id, receiver_id=peer.id, message_type=message_type,
+                              timestamp=datetime.utcnow(), is_read=False, status="sent")
+        await writer.close()
+
+        # From the database, not this process's cache
+        pipeline.ready.clear()
+        response = await client.get(f"/api/v1/chat/history/user/{sender.id}", headers=headers)
+        assert response.status_code == 200
+        assert [m["preview"] for m in response.json()] == [None, preview]
+    finally:
+        await pipeline.close()
+
+@pytest.mark.anyio
+async def test_buffered_messages_get_late_previews(session_factory):
+    import json
+    from app.services.previews import PreviewPipeline
+    from app.services.uploads import UPLOAD_URL_PREFIX
+
+    opened = []
+
+    def counting_factory():
+        opened.append(1)
+        return session_factory()
+
+    pipeline = PreviewPipeline(workers=0, session_factory=counting_factory)
+    preview = {"thumbnail_url": f"{UPLOAD_URL_PREFIX}late.thumb.webp", "blurhash": "L00000", "width": 4, "height": 3}
+    pipeline.ready.set("late.png", preview)
+    frames = [
+        json.dumps({"id": 1, "content": "hi", "preview": None}, separators=(",", ":")),
+        json.dumps({"id": 2, "content": f"{UPLOAD_URL_PREFIX}late.png", "preview": None}, separators=(",", ":")),
+    ]
+    patched = await pipeline.attach_frames(frames)
+    assert patched[0] == frames[0]
+    assert json.loads(patched[1])["preview"] == preview
+
+    # Links to files without an upload_object row are looked up once
+    assert await pipeline.lookup([f"{UPLOAD_URL_PREFIX}legacy-uuid.png"]) == {}
+    assert await pipeline.lookup([f"{UPLOAD_URL_PREFIX}legacy-uuid.png"]) == {}
+    assert len(opened) == 1
+
+
+def test_principal_versions_shared_whenever_redis_is_configured(monkeypatch):
+    from app.core.config import settings
+    from app.services.principals import create_principal_cache
+
+    monkeypatch.setattr(settings, "PRINCIPAL_CACHE_BACKEND", "")
+    monkeypatch.setattr(settings, "REDIS_URL", "redis://localhost:6379/0")
+    assert create_principal_cache().redis is not None
+    monkeypatch.setattr(settings, "REDIS_URL", "")
+    assert create_principal_cache().redis is None
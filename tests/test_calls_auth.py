@@ -1,16 +1,23 @@
 import time
+from dataclasses import replace
 from datetime import datetime
+from uuid import uuid4
 
 import pytest
 
+from app.models.call import CallSession
 from app.models.chat import ChatRoom, ChatRoomMember
-from app.models.message import Message, MessageType
+from app.models.message import MessageType
 from app.models.user import User
+from app.services.call_state import (
+    ACTIVE, END_STATUSES, CallRecorder, CallState, CallStateStore, create_call_states,
+)
 from app.services.calls import can_initiate_call
+from app.services.persistence import MessageWriter
 
 
 @pytest.mark.anyio
-async def test_can_initiate_call_requires_prior_dm(db_session):
+async def test_can_initiate_call_requires_prior_dm(db_session, session_factory):
     u1 = User(email=f"a_{time.time()}@example.com", hashed_password="x", full_name="A")
     u2 = User(email=f"b_{time.time()}@example.com", hashed_password="x", full_name="B")
     db_session.add_all([u1, u2])
@@ -20,7 +27,9 @@ async def test_can_initiate_call_requires_prior_dm(db_session):
 
     assert await can_initiate_call(db_session, u1.id, u2.id, None) is False
 
-    msg = Message(
+    # The first DM creates the pair's conversation
+    writer = MessageWriter(session_factory, flush_interval_ms=1)
+    await writer.save(
         content="hi",
         sender_id=u1.id,
         receiver_id=u2.id,
@@ -28,10 +37,10 @@ async def test_can_initiate_call_requires_prior_dm(db_session):
         timestamp=datetime.utcnow(),
         is_read=False,
     )
-    db_session.add(msg)
-    await db_session.commit()
+    await writer.close()
 
     assert await can_initiate_call(db_session, u1.id, u2.id, None) is True
+    assert await can_initiate_call(db_session, u2.id, u1.id, None) is True
 
 
 @pytest.mark.anyio
@@ -55,3 +64,76 @@ async def test_can_initiate_call_requires_room_membership(db_session):
     assert await can_initiate_call(db_session, u1.id, u2.id, room.id) is True
     assert await can_initiate_call(db_session, u1.id, u3.id, room.id) is False
 
+
+
+@pytest.mark.anyio
+async def test_call_state_store_and_recorder(db_session, session_factory):
+    u1 = User(email=f"caller_{time.time()}@example.com", hashed_password="x", full_name="Caller")
+    u2 = User(email=f"callee_{time.time()}@example.com", hashed_password="x", full_name="Callee")
+    db_session.add_all([u1, u2])
+    await db_session.commit()
+
+    store = CallStateStore()
+    recorder = CallRecorder(session_factory, flush_interval_ms=1)
+    call = CallState(call_id=str(uuid4()), caller_id=u1.id, callee_id=u2.id)
+    assert await store.create(call) is True
+    assert await store.create(call) is False
+    recorder.record(call)
+
+    found = await store.get(call.call_id)
+    assert found.peer_of(u2.id) == u1.id
+    assert found.peer_of(u2.id + 1000) is None
+    recorder.record(await store.set_status(found, ACTIVE))
+    assert (await store.get(call.call_id)).status == ACTIVE
+    recorder.record(await store.set_status(found, END_STATUSES["call.hangup"]))
+    assert await store.get(call.call_id) is None
+    await recorder.close()
+
+    row = await db_session.get(CallSession, call.call_id)
+    assert row.status == "ended"
+    assert row.started_at is not None and row.ended_at is not None
+
+
+@pytest.mark.anyio
+async def test_call_transitions_apply_in_order_and_only_once(db_session, session_factory):
+    u1 = User(email=f"order_a_{time.time()}@example.com", hashed_password="x", full_name="A")
+    u2 = User(email=f"order_b_{time.time()}@example.com", hashed_password="x", full_name="B")
+    db_session.add_all([u1, u2])
+    await db_session.commit()
+
+    call = CallState(call_id=str(uuid4()), caller_id=u1.id, callee_id=u2.id)
+    recorder = CallRecorder(session_factory, flush_interval_ms=1000)
+    # Separate flushes: each waits for the one before it
+    for status in (call.status, "rejected", ACTIVE):
+        recorder.record(replace(call, status=status))
+        recorder._start_flush()
+    await recorder.close()
+
+    row = await db_session.get(CallSession, call.call_id)
+    assert row.status == "rejected"
+    assert row.started_at is None and row.ended_at is not None
+
+    # Lifecycle events for a call the store no longer has are refused
+    assert await CallStateStore().set_status(call, ACTIVE) is None
+
+
+def test_memory_call_state_needs_a_single_process(monkeypatch):
+    from app.core.config import settings
+
+    monkeypatch.setattr(settings, "CALL_STATE_BACKEND", "")
+    monkeypatch.setattr(settings, "REDIS_URL", "")
+    monkeypatch.setattr(settings, "BROKER_BACKEND", "ipc")
+    with pytest.raises(ValueError, match="per process"):
+        create_call_states()
+
+    # The default broker is Redis pub/sub across nodes once REDIS_URL is set
+    monkeypatch.setattr(settings, "BROKER_BACKEND", "")
+    monkeypatch.setattr(settings, "REDIS_URL", "redis://localhost:6379/0")
+    monkeypatch.setattr(settings, "CALL_STATE_BACKEND", "memory")
+    with pytest.raises(ValueError, match="per process"):
+        create_call_states()
+
+    # One process: the in-memory streams broker
+    monkeypatch.setattr(settings, "BROKER_BACKEND", "streams")
+    monkeypatch.setattr(settings, "REDIS_URL", "")
+    assert create_call_states().redis is None
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock
+
+import pytest
+from httpx import AsyncClient
+
+from app.core import security
+from app.core.metrics import metrics
+from app.models.chat import ChatRoom, ChatRoomMember
+from app.models.message import Message, MessageType
+from app.models.user import User
+from app.services.conversations import ensure_conversations, pair
+from app.services.persistence import MessageWriter
+from app.services.receipts import READ, ReceiptAggregator
+from app.services.recent import MemoryRecentMessages
+
+
+async def make_user(db_session, prefix: str):
+    # Created directly: the signup/login endpoints are rate limited
+    user = User(email=f"{prefix}_{time.time()}@example.com", hashed_password="x", full_name=prefix)
+    db_session.add(user)
+    await db_session.commit()
+    token = security.create_access_token({"sub": str(user.id)})
+    return user.id, {"Authorization": f"Bearer {token}"}
+
+
+@pytest.mark.anyio
+async def test_private_history_keyset_pagination(client: AsyncClient, db_session):
+    me, headers = await make_user(db_session, "pager")
+    peer, _ = await make_user(db_session, "peer")
+    base = datetime.utcnow()
+    # Two messages share a timestamp to exercise the id tie-breaker
+    stamps = [base + timedelta(seconds=i // 2) for i in range(7)]
+    conversation_id = (await ensure_conversations(db_session, [pair(me, peer)]))[pair(me, peer)]
+    msgs = [
+        Message(content=f"m{i}", sender_id=me if i % 2 else peer, receiver_id=peer if i % 2 else me,
+                conversation_id=conversation_id, message_type=MessageType.TEXT, timestamp=ts, is_read=False)
+        for i, ts in enumerate(stamps)
+    ]
+    db_session.add_all(msgs)
+    await db_session.commit()
+
+    seen = []
+    params = {"limit": 3}
+    while True:
+        res = await client.get(f"/api/v1/chat/history/user/{peer}", params=params, headers=headers)
+        assert res.status_code == 200
+        page = [m["content"] for m in res.json()]
+        seen = page + seen
+        cursor = res.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+        params = {"limit": 3, "cursor": cursor}
+    assert seen == [f"m{i}" for i in range(7)]
+
+    res = await client.get(f"/api/v1/chat/history/user/{peer}", params={"after_id": msgs[4].id}, headers=headers)
+    assert [m["content"] for m in res.json()] == ["m5", "m6"]
+
+    res = await client.get(f"/api/v1/chat/history/user/{peer}", params={"before_id": msgs[2].id}, headers=headers)
+    assert [m["content"] for m in res.json()] == ["m0", "m1"]
+
+    res = await client.get(f"/api/v1/chat/history/user/{peer}", params={"cursor": "not-a-cursor"}, headers=headers)
+    assert res.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_inbox_lists_conversations_by_activity(client: AsyncClient, db_session, session_factory):
+    me, headers = await make_user(db_session, "inbox")
+    alice, _ = await make_user(db_session, "alice")
+    bob, _ = await make_user(db_session, "bob")
+    room = ChatRoom(name="inbox room", is_group=True, last_activity=datetime.utcnow() - timedelta(days=1))
+    db_session.add(room)
+    await db_session.flush()
+    db_session.add_all([ChatRoomMember(chatroom_id=room.id, user_id=uid) for uid in (me, bob)])
+    await db_session.commit()
+
+    writer = MessageWriter(session_factory, flush_interval_ms=1)
+    base = datetime.utcnow()
+
+    async def send(seconds, content, sender, **target):
+        await writer.save(content=content, sender_id=sender, message_type=MessageType.TEXT,
+                          timestamp=base + timedelta(seconds=seconds), is_read=False, status="sent", **target)
+
+    await send(1, "from alice", alice, receiver_id=me)
+    await send(2, "to bob", me, receiver_id=bob)
+    await send(3, "in room", bob, room_id=room.id)
+    await send(4, "again alice", alice, receiver_id=me)
+    await writer.close()
+
+    res = await client.get("/api/v1/chat/inbox", params={"limit": 2}, headers=headers)
+    assert res.status_code == 200
+    first = res.json()
+    assert [(i["kind"], i["id"]) for i in first] == [("user", alice), ("room", room.id)]
+    assert first[0]["last_message"]["content"] == "again alice"
+    assert first[0]["unread"] == 2
+    assert first[1]["name"] == "inbox room"
+    assert first[1]["unread"] == 1
+
+    res = await client.get("/api/v1/chat/inbox", params={"limit": 2, "cursor": res.headers["X-Next-Cursor"]}, headers=headers)
+    rest = res.json()
+    assert [(i["kind"], i["id"], i["unread"]) for i in rest] == [("user", bob, 0)]
+    assert rest[0]["last_message"]["content"] == "to bob"
+    assert "X-Next-Cursor" not in res.headers
+
+
+@pytest.mark.anyio
+async def test_deleting_the_last_message_moves_the_inbox_pointer_back(client: AsyncClient, db_session, session_factory):
+    me, headers = await make_user(db_session, "retreat")
+    peer, _ = await make_user(db_session, "retreatpeer")
+    room = ChatRoom(name="retreat room", is_group=True)
+    db_session.add(room)
+    await db_session.flush()
+    db_session.add_all([ChatRoomMember(chatroom_id=room.id, user_id=uid) for uid in (me, peer)])
+    await db_session.commit()
+
+    writer = MessageWriter(session_factory, flush_interval_ms=1)
+    base = datetime.utcnow()
+    ids = {}
+    for seconds, content, target in ((1, "older dm", {"receiver_id": peer}), (2, "newer dm", {"receiver_id": peer}),
+                                     (3, "older room", {"room_id": room.id}), (4, "newer room", {"room_id": room.id})):
+        ids[content] = await writer.save(content=content, sender_id=me, message_type=MessageType.TEXT,
+                                         timestamp=base + timedelta(seconds=seconds), is_read=False, status="sent", **target)
+    await writer.close()
+
+    for content in ("newer dm", "newer room"):
+        assert (await client.delete(f"/api/v1/chat/messages/{ids[content]}", headers=headers)).status_code == 200
+
+    items = (await client.get("/api/v1/chat/inbox", headers=headers)).json()
+    assert [(i["kind"], i["last_message"]["content"]) for i in items] == [("room", "older room"), ("user", "older dm")]
+    assert datetime.fromisoformat(items[1]["last_activity"]).replace(tzinfo=None) == base + timedelta(seconds=1)
+
+
+@pytest.mark.anyio
+async def test_sync_returns_changes_since_cursor(client: AsyncClient, db_session, session_factory):
+    me, headers = await make_user(db_session, "syncer")
+    peer, peer_headers = await make_user(db_session, "syncpeer")
+    res = await client.get("/api/v1/chat/sync", headers=headers)
+    cursor = res.json()["cursor"]
+
+    writer = MessageWriter(session_factory, flush_interval_ms=1)
+    ids = []
+    for content in ("one", "two", "three"):
+        ids.append(await writer.save(content=content, sender_id=peer, receiver_id=me, message_type=MessageType.TEXT,
+                                     timestamp=datetime.utcnow(), is_read=False, status="sent"))
+    await writer.close()
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=AsyncMock())
+    aggregator.add_watermark(READ, me, ids[0], peer_id=peer)
+    await aggregator.close()
+
+    assert (await client.put(f"/api/v1/chat/messages/{ids[1]}", json={"content": "two!"}, headers=peer_headers)).status_code == 200
+    assert (await client.delete(f"/api/v1/chat/messages/{ids[2]}", headers=peer_headers)).status_code == 200
+    res = await client.post("/api/v1/chat/rooms", json={"name": "synced", "member_ids": [peer]}, headers=headers)
+    room_id = res.json()["id"]
+
+    res = await client.get("/api/v1/chat/sync", params={"since": cursor, "limit": 2}, headers=headers)
+    page = res.json()
+    assert page["has_more"] is True
+    assert [m["content"] for m in page["messages"]] == ["one", "two!"]
+
+    res = await client.get("/api/v1/chat/sync", params={"since": cursor}, headers=headers)
+    body = res.json()
+    assert body["has_more"] is False
+    assert [m["content"] for m in body["messages"]] == ["one", "two!"]
+    assert body["deleted_ids"] == [ids[2]]
+    assert [r["up_to_id"] for r in body["receipts"]] == [ids[0]]
+    assert [r["id"] for r in body["rooms"]] == [room_id]
+
+    res = await client.get("/api/v1/chat/sync", params={"since": body["cursor"]}, headers=headers)
+    assert res.json()["messages"] == [] and res.json()["cursor"] == body["cursor"]
+    res = await client.get("/api/v1/chat/sync", params={"since": "bogus"}, headers=headers)
+    assert res.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_first_page_served_from_recent_messages(client: AsyncClient, db_session, session_factory):
+    me, headers = await make_user(db_session, "hot")
+    peer, peer_headers = await make_user(db_session, "hotpeer")
+    writer = MessageWriter(session_factory, flush_interval_ms=1)
+
+    async def send(content, sender, receiver):
+        message_id = await writer.save(content=content, sender_id=sender, receiver_id=receiver, message_type=MessageType.TEXT,
+                                       timestamp=datetime.utcnow(), is_read=False, status="sent")
+        return message_id
+
+    first = await send("first", peer, me)
+    url = f"/api/v1/chat/history/user/{peer}"
+    from_sql = (await client.get(url, headers=headers)).json()
+    assert [m["content"] for m in from_sql] == ["first"]
+
+    hits = metrics.counters["recent_messages_hits_total"]
+    second = await send("second", me, peer)
+    assert (await client.put(f"/api/v1/chat/messages/{first}", json={"content": "first!"}, headers=peer_headers)).status_code == 200
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=AsyncMock())
+    aggregator.add_watermark(READ, me, first, peer_id=peer)
+    await aggregator.close()
+
+    cached = (await client.get(url, headers=headers)).json()
+    assert metrics.counters["recent_messages_hits_total"] - hits == 1
+    assert [(m["id"], m["content"], m["is_read"]) for m in cached] == [(first, "first!", True), (second, "second", False)]
+
+    # Deeper pages and the same page from SQL agree with the buffer
+    res = await client.get(url, params={"limit": 1}, headers=headers)
+    assert [m["id"] for m in res.json()] == [second]
+    older = await client.get(url, params={"limit": 1, "cursor": res.headers["X-Next-Cursor"]}, headers=headers)
+    assert older.json() == cached[:1]
+
+    assert (await client.delete(f"/api/v1/chat/messages/{second}", headers=headers)).status_code == 200
+    assert [m["id"] for m in (await client.get(url, headers=headers)).json()] == [first]
+    await writer.close()
+
+
+@pytest.mark.anyio
+async def test_fill_that_raced_a_write_is_dropped():
+    store = MemoryRecentMessages(per_conversation=10, max_bytes=1 << 20)
+    key = ("dm", 1)
+    now = datetime.utcnow()
+    before_edit = ((now, 1), '{"id":1,"content":"old"}')
+
+    version = await store.version(key)
+    # The edit commits and patches the (not yet filled) buffer while the query runs
+    await store.replace(key, 1, ((now, 1), '{"id":1,"content":"new"}'))
+    await store.fill(key, [before_edit], exhausted=True, version=version)
+    assert await store.page(key, 10) is None
+
+    await store.fill(key, [before_edit], exhausted=True, version=await store.version(key))
+    assert await store.page(key, 10) == [before_edit]
+
+
+@pytest.mark.anyio
+async def test_export_streams_ndjson_and_resumes(client: AsyncClient, db_session, session_factory, monkeypatch):
+    from app.services import export
+
+    monkeypatch.setattr(export, "AsyncSessionLocal", session_factory)
+    monkeypatch.setattr(export.settings, "EXPORT_BATCH_SIZE", 2)
+    me, headers = await make_user(db_session, "exporter")
+    peer, _ = await make_user(db_session, "exportpeer")
+    other, _ = await make_user(db_session, "bystander")
+
+    writer = MessageWriter(session_factory, flush_interval_ms=1)
+    for i in range(5):
+        await writer.save(content=f"e{i}", sender_id=me if i % 2 else peer, receiver_id=peer if i % 2 else me,
+                          message_type=MessageType.TEXT, is_read=False, status="sent")
+    await writer.save(content="elsewhere", sender_id=other, receiver_id=peer,
+                      message_type=MessageType.TEXT, is_read=False, status="sent")
+    await writer.close()
+
+    res = await client.get("/api/v1/chat/export", headers=headers)
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert [m["content"] for m in lines] == [f"e{i}" for i in range(5)]
+    assert lines[0]["message_type"] == "text"
+
+    res = await client.get(f"/api/v1/chat/export/user/{peer}", params={"after_id": lines[2]["id"]}, headers=headers)
+    assert [json.loads(line)["content"] for line in res.text.splitlines()] == ["e3", "e4"]
+
+    res = await client.get(f"/api/v1/chat/export/user/{other}", headers=headers)
+    assert res.text == ""
+
+    monkeypatch.setattr(export, "_slots", asyncio.Semaphore(0))
+    res = await client.get("/api/v1/chat/export", headers=headers)
+    assert res.status_code == 429
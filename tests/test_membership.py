@@ -0,0 +1,196 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock
+
+import pytest
+from redis.exceptions import WatchError
+
+from app.models.chat import ChatRoom, ChatRoomMember
+from app.models.user import User
+from app.schemas.ws_events import WSEvent
+from app.services.membership import RoomMembershipCache
+from app.ws.manager import ConnectionManager
+
+
+class CountingSessions:
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.opened = 0
+
+    def __call__(self):
+        self.opened += 1
+        return self.session_factory()
+
+
+class GatedSessions:
+    """Sessions whose first use waits until `gate` is set."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.gate = asyncio.Event()
+        self.entered = asyncio.Event()
+
+    @asynccontextmanager
+    async def __call__(self):
+        self.entered.set()
+        await self.gate.wait()
+        async with self.session_factory() as session:
+            yield session
+
+
+class FakeRedis:
+    """Strings and sets, with WATCH on a transactional pipeline."""
+
+    def __init__(self):
+        self.data = {}
+        self.writes = {}
+
+    def _wrote(self, key):
+        self.writes[key] = self.writes.get(key, 0) + 1
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    async def incr(self, key):
+        self.data[key] = str(int(self.data.get(key) or 0) + 1)
+        self._wrote(key)
+        return int(self.data[key])
+
+    async def delete(self, key):
+        self._wrote(key)
+        return 1 if self.data.pop(key, None) is not None else 0
+
+    async def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(str(m) for m in members)
+        self._wrote(key)
+
+    async def expire(self, key, seconds):
+        return key in self.data
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = {}
+        self.queued = []
+        self.buffering = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def watch(self, *keys):
+        self.watched = {key: self.redis.writes.get(key, 0) for key in keys}
+        self.buffering = False
+
+    def multi(self):
+        self.buffering = True
+
+    async def execute(self):
+        if any(self.redis.writes.get(key, 0) != count for key, count in self.watched.items()):
+            raise WatchError("watched key changed")
+        return [await getattr(self.redis, name)(*args) for name, args in self.queued]
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        def call(*args):
+            if not self.buffering:
+                return command(*args)
+            self.queued.append((name, args))
+            return self
+
+        return call
+
+
+@pytest.mark.anyio
+async def test_load_that_raced_a_change_is_discarded(db_session, session_factory):
+    user = User(email=f"race_{time.time()}@example.com", hashed_password="x", full_name="Race")
+    room = ChatRoom(name="raced", is_group=True)
+    db_session.add_all([user, room])
+    await db_session.flush()
+    db_session.add(ChatRoomMember(chatroom_id=room.id, user_id=user.id))
+    await db_session.commit()
+
+    bus = ConnectionManager()
+    redis = FakeRedis()
+    sessions = GatedSessions(session_factory)
+    cache = RoomMembershipCache(sessions, max_size=10, ttl=60, redis=redis, bus=bus)
+    other = RoomMembershipCache(session_factory, max_size=10, ttl=60, redis=redis, bus=bus)
+
+    load = asyncio.create_task(cache.get(room.id))
+    await sessions.entered.wait()
+    # The membership changes on another instance while the query is pending
+    await other.changed(room.id, removed=[user.id])
+    sessions.gate.set()
+    assert await load == (user.id,)
+
+    # Neither the shared set nor the local copy kept what the load read
+    assert await redis.smembers(f"chat:room_members:{room.id}") == set()
+    assert cache.local.get(room.id) is None
+
+    # A load that did not race is shared
+    assert await other.get(room.id) == (user.id,)
+    assert await redis.smembers(f"chat:room_members:{room.id}") == {str(user.id)}
+
+
+@pytest.mark.anyio
+async def test_creating_a_room_invalidates_its_members(client, db_session, monkeypatch):
+    from app.core import security
+    from app.services import membership
+
+    user = User(email=f"creator_{time.time()}@example.com", hashed_password="x", full_name="Creator")
+    db_session.add(user)
+    await db_session.commit()
+    changed = AsyncMock()
+    monkeypatch.setattr(membership.room_members, "changed", changed)
+
+    headers = {"Authorization": f"Bearer {security.create_access_token({'sub': str(user.id)})}"}
+    res = await client.post("/api/v1/chat/rooms", json={"name": "fresh", "member_ids": []}, headers=headers)
+    assert res.status_code == 200
+    changed.assert_awaited_once_with(res.json()["id"], added=[user.id])
+
+
+@pytest.mark.anyio
+async def test_members_are_cached_and_evicted_on_every_instance(db_session, session_factory):
+    users = [User(email=f"m{i}_{time.time()}@example.com", hashed_password="x", full_name=f"M{i}") for i in range(3)]
+    room = ChatRoom(name="cached", is_group=True)
+    db_session.add_all(users + [room])
+    await db_session.flush()
+    db_session.add_all([ChatRoomMember(chatroom_id=room.id, user_id=u.id) for u in users[:2]])
+    await db_session.commit()
+
+    bus = ConnectionManager()
+    sessions = CountingSessions(session_factory)
+    cache = RoomMembershipCache(sessions, max_size=10, ttl=60, bus=bus)
+    other = RoomMembershipCache(session_factory, max_size=10, ttl=60, bus=bus)
+
+    # Concurrent misses share one query, later lookups need none
+    results = await asyncio.gather(*[cache.get(room.id) for _ in range(5)])
+    assert results == [tuple(sorted(u.id for u in users[:2]))] * 5
+    assert await cache.get(room.id) == results[0]
+    assert sessions.opened == 1
+    await other.get(room.id)
+
+    db_session.add(ChatRoomMember(chatroom_id=room.id, user_id=users[2].id))
+    await db_session.commit()
+    await cache.changed(room.id, added=[users[2].id])
+
+    expected = tuple(sorted(u.id for u in users))
+    assert await cache.get(room.id) == expected
+    assert await other.get(room.id) == expected
+    assert sessions.opened == 2
+
+    # Room creation evicts too
+    await bus.broadcast(WSEvent(event="room.created", data={"id": room.id}, recipient_ids=[users[0].id]))
+    await cache.get(room.id)
+    assert sessions.opened == 3
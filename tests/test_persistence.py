@@ -0,0 +1,107 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+from app.core.metrics import metrics
+from app.models.conversation import Conversation
+from app.models.message import Message, MessageType
+from app.models.user import User
+from app.services.persistence import MessageWriter
+
+
+@pytest.mark.anyio
+async def test_message_writer_batches_inserts(db_session, session_factory):
+    u1 = User(email=f"w1_{time.time()}@example.com", hashed_password="x", full_name="W1")
+    u2 = User(email=f"w2_{time.time()}@example.com", hashed_password="x", full_name="W2")
+    db_session.add_all([u1, u2])
+    await db_session.commit()
+
+    writer = MessageWriter(session_factory, flush_interval_ms=50, batch_size=3)
+    batches_before = metrics.counters["message_insert_batches_total"]
+
+    ids = await asyncio.gather(*[
+        writer.save(
+            content=f"msg {i}",
+            sender_id=u1.id,
+            receiver_id=u2.id,
+            message_type=MessageType.TEXT,
+            timestamp=datetime.utcnow(),
+            is_read=False,
+        )
+        for i in range(5)
+    ])
+    await writer.close()
+
+    assert len(set(ids)) == 5
+    # One full batch of 3 plus the remaining 2 flushed by the timer
+    assert metrics.counters["message_insert_batches_total"] - batches_before == 2
+
+    result = await db_session.execute(select(Message.id, Message.content).where(Message.id.in_(ids)))
+    contents = dict(result.all())
+    assert [contents[i] for i in ids] == [f"msg {i}" for i in range(5)]
+
+    # Every row points at the pair's conversation, which tracks the newest one
+    conversation = (await db_session.execute(select(Conversation).where(Conversation.low_id == min(u1.id, u2.id)))).scalar_one()
+    assert (conversation.low_id, conversation.high_id) == tuple(sorted((u1.id, u2.id)))
+    assert conversation.last_message_id == max(ids)
+    result = await db_session.execute(select(Message.conversation_id).where(Message.id.in_(ids)))
+    assert set(result.scalars().all()) == {conversation.id}
+
+
+@pytest.mark.anyio
+async def test_message_writer_isolates_a_bad_row(db_session, session_factory):
+    u1 = User(email=f"b1_{time.time()}@example.com", hashed_password="x", full_name="B1")
+    u2 = User(email=f"b2_{time.time()}@example.com", hashed_password="x", full_name="B2")
+    db_session.add_all([u1, u2])
+    await db_session.commit()
+
+    writer = MessageWriter(session_factory, flush_interval_ms=50, batch_size=3)
+    results = await asyncio.gather(*[
+        writer.save(
+            content=content,
+            sender_id=u1.id,
+            receiver_id=u2.id,
+            message_type=MessageType.TEXT,
+            timestamp=datetime.utcnow(),
+            is_read=False,
+        )
+        # NULL content violates a constraint, like a nonexistent receiver would
+        for content in ("before", None, "after")
+    ], return_exceptions=True)
+    await writer.close()
+
+    assert isinstance(results[1], Exception)
+    saved = dict((await db_session.execute(select(Message.id, Message.content).where(Message.id.in_([results[0], results[2]])))).all())
+    assert saved == {results[0]: "before", results[2]: "after"}
+
+
+@pytest.mark.anyio
+async def test_message_writer_acks_before_buffering(db_session, session_factory):
+    from app.services.recent import MemoryRecentMessages
+
+    u1 = User(email=f"a1_{time.time()}@example.com", hashed_password="x", full_name="A1")
+    u2 = User(email=f"a2_{time.time()}@example.com", hashed_password="x", full_name="A2")
+    db_session.add_all([u1, u2])
+    await db_session.commit()
+
+    release = asyncio.Event()
+
+    class SlowBuffer(MemoryRecentMessages):
+        async def add(self, key, entry):
+            await release.wait()
+            await super().add(key, entry)
+
+    recent = SlowBuffer(per_conversation=10, max_bytes=1 << 20)
+    writer = MessageWriter(session_factory, flush_interval_ms=1, recent=recent)
+    message_id = await asyncio.wait_for(
+        writer.save(content="fast", sender_id=u1.id, receiver_id=u2.id, message_type=MessageType.TEXT,
+                    timestamp=datetime.utcnow(), is_read=False),
+        timeout=5,
+    )
+    assert recent.size == 0
+    release.set()
+    await writer.close()
+    assert [position[1] for buffer in recent.buffers.values() for position, _ in buffer.entries] == [message_id]
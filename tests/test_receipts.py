@@ -0,0 +1,180 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app.models.chat import ChatRoom, ChatRoomMember
+from app.models.message import Message, MessageType
+from app.models.user import User
+from app.services.receipts import DELIVERED, READ, ReceiptAggregator
+
+
+async def make_users(db, *names):
+    users = [User(email=f"{n}_{time.time()}@example.com", hashed_password="x", full_name=n) for n in names]
+    db.add_all(users)
+    await db.commit()
+    return users
+
+
+async def make_dm(db, sender, receiver, count):
+    msgs = [
+        Message(content=f"m{i}", sender_id=sender.id, receiver_id=receiver.id, message_type=MessageType.TEXT,
+                timestamp=datetime.utcnow(), is_read=False, status="sent")
+        for i in range(count)
+    ]
+    db.add_all(msgs)
+    await db.commit()
+    return msgs
+
+
+@pytest.mark.anyio
+async def test_per_message_receipts_are_coalesced(db_session, session_factory):
+    alice, bob = await make_users(db_session, "alice", "bob")
+    msgs = await make_dm(db_session, alice, bob, 3)
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=publish)
+    for m in msgs:
+        aggregator.add(DELIVERED, bob.id, m.id, alice.id)
+        aggregator.add(READ, bob.id, m.id, alice.id)
+    await aggregator.close()
+
+    result = await db_session.execute(select(Message.status, Message.is_read).where(Message.id.in_([m.id for m in msgs])).execution_options(populate_existing=True))
+    assert set(result.all()) == {("read", True)}
+    assert sorted(e.event for e in published) == ["message.delivery_receipt", "message.read_receipt"]
+    read = next(e for e in published if e.event == "message.read_receipt")
+    assert read.data["message_ids"] == sorted(m.id for m in msgs)
+    assert read.data["receiver_id"] == alice.id
+
+
+@pytest.mark.anyio
+async def test_watermarks_for_dm_and_room(db_session, session_factory):
+    alice, bob = await make_users(db_session, "wa", "wb")
+    msgs = await make_dm(db_session, alice, bob, 4)
+    room = ChatRoom(name="r", is_group=True)
+    db_session.add(room)
+    await db_session.flush()
+    member = ChatRoomMember(chatroom_id=room.id, user_id=bob.id, last_read_at=datetime.utcnow() - timedelta(days=1))
+    room_msg = Message(content="hi room", sender_id=alice.id, room_id=room.id, timestamp=datetime.utcnow())
+    db_session.add_all([member, room_msg])
+    await db_session.commit()
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=publish)
+    aggregator.add_watermark(READ, bob.id, msgs[1].id, peer_id=alice.id)
+    aggregator.add_watermark(READ, bob.id, msgs[2].id, peer_id=alice.id)
+    aggregator.add_watermark(READ, bob.id, room_msg.id, room_id=room.id)
+    await aggregator.close()
+
+    result = await db_session.execute(select(Message.id, Message.is_read).where(Message.id.in_([m.id for m in msgs])).execution_options(populate_existing=True))
+    assert dict(result.all()) == {msgs[0].id: True, msgs[1].id: True, msgs[2].id: True, msgs[3].id: False}
+    await db_session.refresh(member)
+    assert member.last_read_at.replace(tzinfo=None) == room_msg.timestamp.replace(tzinfo=None)
+    assert [e.data["up_to_id"] for e in published] == [msgs[2].id, room_msg.id]
+
+
+@pytest.mark.anyio
+async def test_receipts_go_to_the_real_sender_of_changed_rows(db_session, session_factory):
+    alice, bob, eve = await make_users(db_session, "sa", "sb", "se")
+    msgs = await make_dm(db_session, alice, bob, 2)
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=publish)
+    # Bob names the wrong sender; Eve acknowledges messages that are not hers to read
+    aggregator.add(READ, bob.id, msgs[0].id, eve.id)
+    aggregator.add(READ, eve.id, msgs[1].id, alice.id)
+    aggregator.add_watermark(READ, eve.id, msgs[1].id, peer_id=alice.id)
+    await aggregator.close()
+
+    assert [(e.data["reader_id"], e.data["receiver_id"], e.data["message_ids"]) for e in published] == [
+        (bob.id, alice.id, [msgs[0].id])
+    ]
+
+
+@pytest.mark.anyio
+async def test_room_message_receipts_require_membership(db_session, session_factory):
+    alice, eve = await make_users(db_session, "ma", "me")
+    room = ChatRoom(name="r", is_group=True)
+    db_session.add(room)
+    await db_session.flush()
+    room_msg = Message(content="members only", sender_id=alice.id, room_id=room.id, timestamp=datetime.utcnow(),
+                       is_read=False, status="sent")
+    db_session.add(room_msg)
+    await db_session.commit()
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=publish)
+    aggregator.add(DELIVERED, eve.id, room_msg.id, alice.id)
+    aggregator.add(READ, eve.id, room_msg.id, alice.id)
+    await aggregator.close()
+
+    await db_session.refresh(room_msg)
+    assert (room_msg.status, room_msg.is_read) == ("sent", False)
+    assert published == []
+
+
+@pytest.mark.anyio
+async def test_room_watermark_requires_membership_and_a_room_message(db_session, session_factory):
+    alice, bob, eve = await make_users(db_session, "ra", "rb", "re")
+    room = ChatRoom(name="r", is_group=True)
+    other = ChatRoom(name="o", is_group=True)
+    db_session.add_all([room, other])
+    await db_session.flush()
+    member = ChatRoomMember(chatroom_id=room.id, user_id=bob.id, last_read_at=datetime.utcnow() - timedelta(days=1))
+    room_msg = Message(content="in room", sender_id=alice.id, room_id=room.id, timestamp=datetime.utcnow())
+    elsewhere = Message(content="elsewhere", sender_id=alice.id, room_id=other.id, timestamp=datetime.utcnow() + timedelta(days=1))
+    db_session.add_all([member, room_msg, elsewhere])
+    await db_session.commit()
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=publish)
+    aggregator.add_watermark(READ, bob.id, elsewhere.id, room_id=room.id)
+    aggregator.add_watermark(READ, eve.id, room_msg.id, room_id=room.id)
+    await aggregator.close()
+
+    await db_session.refresh(member)
+    assert member.last_read_at.replace(tzinfo=None) < room_msg.timestamp.replace(tzinfo=None)
+    assert published == []
+
+
+@pytest.mark.anyio
+async def test_failed_flush_is_requeued(db_session, session_factory):
+    alice, bob = await make_users(db_session, "fa", "fb")
+    msgs = await make_dm(db_session, alice, bob, 2)
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    calls = []
+
+    def flaky_factory():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError("database unavailable")
+        return session_factory()
+
+    aggregator = ReceiptAggregator(flaky_factory, flush_interval_ms=1, publish=publish)
+    aggregator.add(READ, bob.id, msgs[0].id, alice.id)
+    await aggregator.flush()
+    assert published == [] and aggregator.messages
+    aggregator.add(READ, bob.id, msgs[1].id, alice.id)
+    await aggregator.close()
+
+    assert [e.data["message_ids"] for e in published] == [sorted(m.id for m in msgs)]
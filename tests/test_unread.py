@@ -0,0 +1,72 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models.chat import ChatRoom, ChatRoomMember
+from app.models.message import MessageType
+from app.models.user import User
+from app.services.persistence import MessageWriter
+from app.services.receipts import READ, ReceiptAggregator
+from app.services.unread import TableUnreadCounters, create_unread_store, query_unread_counts
+
+
+async def noop_publish(event):
+    pass
+
+
+@pytest.mark.anyio
+async def test_table_counters_match_grouped_query(db_session, session_factory):
+    alice, bob, carol = users = [
+        User(email=f"{n}_{time.time()}@example.com", hashed_password="x", full_name=n)
+        for n in ("ua", "ub", "uc")
+    ]
+    db_session.add_all(users)
+    await db_session.flush()
+    room = ChatRoom(name="unread", is_group=True)
+    db_session.add(room)
+    await db_session.flush()
+    an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+    db_session.add_all([
+        ChatRoomMember(chatroom_id=room.id, user_id=u.id, last_read_at=an_hour_ago) for u in users
+    ])
+    await db_session.commit()
+
+    counters = TableUnreadCounters()
+    writer = MessageWriter(session_factory, flush_interval_ms=10, batch_size=50, counters=counters)
+
+    async def send(sender, **target):
+        return await writer.save(
+            content="hi", sender_id=sender.id, message_type=MessageType.TEXT,
+            timestamp=datetime.utcnow(), is_read=False, status="sent", **target,
+        )
+
+    dm_ids = [await send(alice, receiver_id=bob.id) for _ in range(3)]
+    await send(carol, receiver_id=bob.id)
+    room_ids = [await send(alice, room_id=room.id) for _ in range(2)]
+    await writer.close()
+
+    expected = {"users": {str(alice.id): 3, str(carol.id): 1}, "rooms": {str(room.id): 2}}
+    assert await query_unread_counts(db_session, bob.id) == expected
+    assert await counters.get(db_session, bob.id) == expected
+    # The sender's own room messages are not unread for them
+    assert await counters.get(db_session, alice.id) == {"users": {}, "rooms": {}}
+
+    aggregator = ReceiptAggregator(session_factory, flush_interval_ms=1000, publish=noop_publish, counters=counters)
+    aggregator.add(READ, bob.id, dm_ids[0], alice.id)
+    aggregator.add_watermark(READ, bob.id, room_ids[-1], room_id=room.id)
+    aggregator.add_watermark(READ, bob.id, dm_ids[-1], peer_id=carol.id)
+    await aggregator.close()
+
+    expected = {"users": {str(alice.id): 2, str(carol.id): 1}, "rooms": {}}
+    assert await query_unread_counts(db_session, bob.id) == expected
+    assert await counters.get(db_session, bob.id) == expected
+
+
+def test_redis_counters_require_redis_url(monkeypatch):
+    from app.core.config import settings
+
+    monkeypatch.setattr(settings, "UNREAD_COUNTER_BACKEND", "redis")
+    monkeypatch.setattr(settings, "REDIS_URL", "")
+    with pytest.raises(ValueError, match="requires REDIS_URL"):
+        create_unread_store()
@@ -0,0 +1,403 @@
+import asyncio
+import json
+
+import pytest
+
+from app.schemas.ws_events import WSEvent
+from app.ws.coalesce import EventCoalescer
+from app.ws.connection import COALESCE, DISCONNECT, DROP_OLDEST, Connection
+from app.ws.envelope import decode, encode
+from app.ws.manager import ConnectionManager
+from app.ws.registry import CLUSTER_CHANNEL, NODE_CHANNEL, USER_NODES_KEY, NodeRegistry
+from app.ws.brokers.ipc import IPCBroker
+from app.ws.brokers.pubsub import RedisPubSubBroker
+from app.ws.brokers.streams import StreamsBroker
+from app.ws.streams import InMemoryStreams
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+
+
+class StalledWebSocket(FakeWebSocket):
+    async def send_text(self, data: str):
+        await asyncio.Event().wait()
+
+
+class FakeRedis:
+    """The sorted-set and publish commands NodeRegistry and the pub/sub broker use."""
+
+    def __init__(self):
+        self.zsets = {}
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    async def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
+
+    async def zremrangebyscore(self, key, low, high):
+        zset = self.zsets.get(key, {})
+        for member in [m for m, score in zset.items() if float(low) <= score <= float(high)]:
+            del zset[member]
+
+    async def zrangebyscore(self, key, low, high):
+        return [m for m, score in self.zsets.get(key, {}).items() if float(low) <= score <= float(high)]
+
+    async def expire(self, key, seconds):
+        pass
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append(getattr(self.redis, name)(*args))
+
+    async def execute(self):
+        return [await call for call in self.calls]
+
+
+def make_manager(rooms_by_user):
+    manager = ConnectionManager()
+
+    async def load_user_rooms(user_id):
+        return rooms_by_user.get(user_id, [])
+
+    manager.load_user_rooms = load_user_rooms
+    return manager
+
+
+async def drain():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def events(ws, name):
+    parsed = [WSEvent.model_validate_json(d) for d in ws.sent]
+    return [e for e in parsed if e.event == name]
+
+
+@pytest.mark.anyio
+async def test_room_events_reach_only_local_members():
+    manager = make_manager({1: [10], 2: [10], 3: [20]})
+    sockets = {uid: FakeWebSocket() for uid in (1, 2, 3)}
+    for uid, ws in sockets.items():
+        await manager.connect(ws, uid)
+
+    await manager.broadcast(WSEvent(event="message.update", data={"id": 5, "room_id": 10, "sender_id": 1}))
+    await drain()
+
+    assert len(events(sockets[1], "message.update")) == 1
+    assert len(events(sockets[2], "message.update")) == 1
+    assert events(sockets[3], "message.update") == []
+
+
+@pytest.mark.anyio
+async def test_room_index_follows_room_creation_and_disconnect():
+    manager = make_manager({})
+    sockets = {uid: FakeWebSocket() for uid in (1, 2)}
+    connections = {uid: await manager.connect(ws, uid) for uid, ws in sockets.items()}
+
+    await manager.broadcast(WSEvent(event="room.created", data={"id": 30, "name": "r", "is_group": True}, recipient_ids=[1, 2, 99]))
+    assert manager.room_members[30] == {1, 2}
+
+    await manager.disconnect(connections[2])
+    assert manager.room_members[30] == {1}
+    assert 2 not in manager.user_rooms
+
+    await manager.broadcast(WSEvent(event="typing.start", data={"sender_id": 2, "room_id": 30}))
+    await drain()
+    assert len(events(sockets[1], "typing.start")) == 1
+
+
+@pytest.mark.anyio
+async def test_multiple_devices_per_user():
+    manager = make_manager({1: [10]})
+    phone, laptop, other = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    await manager.connect(other, 2)
+    phone_conn = await manager.connect(phone, 1)
+    laptop_conn = await manager.connect(laptop, 1)
+    await drain()
+
+    # self + the first device of user 1
+    assert len(events(other, "presence.update")) == 2
+
+    await manager.broadcast(WSEvent(event="message.receive", data={"id": 1, "sender_id": 2, "receiver_id": 1}))
+    await drain()
+    assert len(events(phone, "message.receive")) == 1
+    assert len(events(laptop, "message.receive")) == 1
+
+    await manager.disconnect(phone_conn)
+    await drain()
+    assert manager.is_online(1)
+    assert manager.room_members[10] == {1}
+    assert len(events(other, "presence.update")) == 2
+
+    await manager.disconnect(laptop_conn)
+    await drain()
+    assert not manager.is_online(1)
+    assert 10 not in manager.room_members
+    offline = events(other, "presence.update")[-1]
+    assert offline.data == {"user_id": 1, "status": "offline"}
+
+
+@pytest.mark.anyio
+async def test_slow_consumer_does_not_block_others():
+    manager = make_manager({})
+    slow, fast = StalledWebSocket(), FakeWebSocket()
+    await manager.connect(slow, 1)
+    await manager.connect(fast, 2)
+
+    for i in range(3):
+        await manager.broadcast(WSEvent(event="user.created", data={"id": i}))
+    await drain()
+
+    assert len(events(fast, "user.created")) == 3
+
+
+@pytest.mark.anyio
+async def test_overflow_policies():
+    drop = Connection(StalledWebSocket(), 1, max_queue=2, policy=DROP_OLDEST)
+    for data in ("a", "b", "c"):
+        drop.send(data)
+    assert [entry[1] for entry in drop.queue] == ["b", "c"]
+
+    coalesce = Connection(StalledWebSocket(), 1, max_queue=2, policy=COALESCE)
+    coalesce.send("typing-1", key="typing:1:2")
+    coalesce.send("msg")
+    coalesce.send("typing-2", key="typing:1:2")
+    assert [entry[1] for entry in coalesce.queue] == ["typing-2", "msg"]
+
+    ws = FakeWebSocket()
+    disconnect = Connection(ws, 1, max_queue=1, policy=DISCONNECT)
+    disconnect.send("a")
+    disconnect.send("b")
+    await drain()
+    assert disconnect.closed
+    assert ws.closed_with == 1013
+
+
+def test_envelope_routes_without_leaking_recipients():
+    event = WSEvent(event="message.receive", data={"id": 1, "room_id": 4, "sender_id": 1}, recipient_ids=[1, 2])
+    route, payload = decode(encode(event))
+
+    assert route.targets == [1, 2]
+    assert route.room_id == 4
+    assert "recipient_ids" not in payload
+    assert WSEvent.model_validate_json(payload).data["id"] == 1
+
+    dm, _ = decode(encode(WSEvent(event="typing.start", data={"sender_id": 1, "receiver_id": 2})))
+    assert dm.targets == [2, 1]
+    assert dm.key == "typing:1:2"
+
+
+async def start_stream_manager(rooms_by_user, maxlen=100):
+    manager = make_manager(rooms_by_user)
+    manager.broker = StreamsBroker(manager, InMemoryStreams())
+    manager.broker.stream.maxlen = maxlen
+    await manager.broker.start()
+    return manager
+
+
+@pytest.mark.anyio
+async def test_stream_replays_missed_events_from_cursor():
+    manager = await start_stream_manager({1: [10], 2: [10]})
+    first = FakeWebSocket()
+    conn = await manager.connect(first, 1)
+    await manager.connect(FakeWebSocket(), 2)
+    await manager.broadcast(WSEvent(event="message.receive", data={"id": 1, "sender_id": 2, "receiver_id": 1}))
+    await drain()
+    cursor = json.loads(first.sent[-1])["cursor"]
+
+    await manager.disconnect(conn)
+    await manager.broadcast(WSEvent(event="message.receive", data={"id": 2, "sender_id": 2, "receiver_id": 1}))
+    await manager.broadcast(WSEvent(event="message.receive", data={"id": 3, "sender_id": 2, "receiver_id": 9}))
+    await manager.broadcast(WSEvent(event="message.update", data={"id": 4, "room_id": 10, "sender_id": 2}))
+    await drain()
+
+    second = FakeWebSocket()
+    await manager.connect(second, 1, cursor=cursor)
+    await drain()
+    replayed = [json.loads(d) for d in second.sent]
+    messages = [e for e in replayed if e["event"].startswith("message.")]
+    assert [(e["event"], e["data"]["id"]) for e in messages] == [("message.receive", 2), ("message.update", 4)]
+    assert all("cursor" in e for e in messages)
+
+    await manager.stop()
+
+
+@pytest.mark.anyio
+async def test_stream_resets_expired_cursor():
+    manager = await start_stream_manager({}, maxlen=2)
+    for i in range(5):
+        await manager.broadcast(WSEvent(event="user.created", data={"id": i}))
+    await drain()
+
+    ws = FakeWebSocket()
+    await manager.connect(ws, 1, cursor="1-0")
+    await drain()
+    assert json.loads(ws.sent[0])["event"] == "sync.reset"
+
+    await manager.stop()
+
+
+@pytest.mark.anyio
+async def test_ipc_broker_reaches_other_workers(tmp_path):
+    workers = []
+    for node_id in ("w1", "w2"):
+        manager = make_manager({})
+        manager.node_id = node_id
+        manager.broker = IPCBroker(manager, str(tmp_path))
+        await manager.broker.start()
+        workers.append(manager)
+    first, second = workers
+    ws = FakeWebSocket()
+    await second.connect(ws, 2)
+
+    await first.broadcast(WSEvent(event="message.receive", data={"id": 1, "sender_id": 1, "receiver_id": 2}))
+    for _ in range(20):
+        await asyncio.sleep(0.01)
+        if events(ws, "message.receive"):
+            break
+    assert len(events(ws, "message.receive")) == 1
+
+    for manager in workers:
+        await manager.stop()
+
+
+@pytest.mark.anyio
+async def test_ipc_stalled_peer_does_not_block_publish(tmp_path):
+    # A "worker" that accepts the connection but never reads from it
+    stalled = await asyncio.start_unix_server(lambda reader, writer: None, path=str(tmp_path / "stalled.sock"))
+    manager = make_manager({})
+    manager.node_id = "w1"
+    manager.broker = IPCBroker(manager, str(tmp_path), max_queue=2)
+    await manager.broker.start()
+
+    big = "x" * 100_000
+    for i in range(50):
+        await asyncio.wait_for(manager.broadcast(WSEvent(event="user.created", data={"id": i, "pad": big})), 0.5)
+        await asyncio.sleep(0)
+    peer = manager.broker.peers[str(tmp_path / "stalled.sock")]
+    assert len(peer.queue) <= 2
+
+    await manager.stop()
+    stalled.close()
+
+
+@pytest.mark.anyio
+async def test_coalescer_batches_ice_and_throttles_typing():
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    coalescer = EventCoalescer(ice_window_ms=10, typing_interval_ms=30, publish=publish)
+    for i in range(3):
+        coalescer.add_ice("c1", 1, [2], {"call_id": "c1", "candidate": {"n": i}, "from_user_id": 1})
+    coalescer.add_ice("c1", 2, [1], {"call_id": "c1", "candidate": {"n": 9}, "from_user_id": 2})
+
+    def typing(name):
+        return WSEvent(event=name, data={"sender_id": 1, "receiver_id": 2})
+
+    for name in ("typing.start", "typing.start", "typing.stop", "typing.start", "typing.stop"):
+        await coalescer.typing_event(typing(name))
+    assert [e.event for e in published] == ["typing.start"]
+
+    await asyncio.sleep(0.05)
+    ice = [e for e in published if e.event == "call.ice"]
+    assert [e.data["candidates"] for e in ice if e.recipient_ids == [2]] == [[{"n": 0}, {"n": 1}, {"n": 2}]]
+    assert [e.data["candidate"] for e in ice if e.recipient_ids == [1]] == [{"n": 9}]
+    assert [e.event for e in published if e.event.startswith("typing")] == ["typing.start", "typing.stop"]
+
+    await asyncio.sleep(0.05)
+    assert coalescer.typing == {}
+    await coalescer.close()
+
+
+@pytest.mark.anyio
+async def test_node_registry_claims_expire(monkeypatch):
+    from app.ws import registry
+
+    redis = FakeRedis()
+    node_a, node_b = NodeRegistry(redis, "a", ttl=30), NodeRegistry(redis, "b", ttl=30)
+    await node_a.register(1)
+    await node_b.register(1)
+    await node_b.register(2)
+    assert await node_a.nodes_for([1]) == {"a", "b"}
+    assert await node_a.nodes_for([2, 3]) == {"b"}
+
+    await node_b.unregister(1)
+    assert await node_a.nodes_for([1]) == {"a"}
+
+    # A node that stops heartbeating (e.g. crashed) ages out of the set
+    now = registry.time.time()
+    monkeypatch.setattr(registry, "time", type("Clock", (), {"time": staticmethod(lambda: now + 20)}))
+    await node_a.heartbeat([1])
+    monkeypatch.setattr(registry, "time", type("Clock", (), {"time": staticmethod(lambda: now + 40)}))
+    assert await node_a.nodes_for([1, 2]) == {"a"}
+    # and is pruned by the next heartbeat touching the user
+    await node_a.heartbeat([1])
+    assert set(redis.zsets[USER_NODES_KEY.format(1)]) == {"a"}
+
+
+@pytest.mark.anyio
+async def test_pubsub_routes_targeted_events_to_recipient_nodes():
+    redis = FakeRedis()
+    managers = {}
+    for node_id in ("a", "b"):
+        manager = make_manager({})
+        manager.node_id = node_id
+        manager.broker = RedisPubSubBroker(manager, redis)
+        managers[node_id] = manager
+    local, remote = FakeWebSocket(), FakeWebSocket()
+    await managers["a"].connect(local, 1)
+    await managers["b"].connect(remote, 2)
+    redis.published.clear()
+
+    # Recipient on this node: delivered directly, nothing published
+    await managers["a"].broadcast(WSEvent(event="message.receive", data={"id": 1, "sender_id": 2, "receiver_id": 1}, recipient_ids=[1]))
+    await drain()
+    assert len(events(local, "message.receive")) == 1
+    assert redis.published == []
+
+    # Recipient elsewhere: only that node's channel
+    await managers["a"].broadcast(WSEvent(event="message.receive", data={"id": 2, "sender_id": 1, "receiver_id": 2}, recipient_ids=[2]))
+    assert [channel for channel, _ in redis.published] == [NODE_CHANNEL.format("b")]
+    assert len(events(local, "message.receive")) == 1
+
+    # Offline recipient: published nowhere
+    redis.published.clear()
+    await managers["a"].broadcast(WSEvent(event="message.receive", data={"id": 3, "sender_id": 1, "receiver_id": 9}, recipient_ids=[9]))
+    assert redis.published == []
+
+    # Untargeted events fall back to the cluster channel
+    await managers["a"].broadcast(WSEvent(event="user.created", data={"id": 7}))
+    assert [channel for channel, _ in redis.published] == [CLUSTER_CHANNEL]